@@ -9,6 +9,9 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 sns.set()
 
+import timing_tools as tt
+
+
 def date_time():
     '''
     get date and time in string format '_yymmdd_hhmm'
@@ -88,7 +91,11 @@ def save(datasets, types, names,  path, saving_time = None, doit = False, verbos
     
     
         
-def preprocess_text_data(dataframe, verbose = True):
+def preprocess_text_data(dataframe, verbose = True, lemma_table = None):
+    '''
+    lemma_table (lemma_table_tools.LemmaTable) is used and completed for the lemmatization,
+    pass the same table for every split to save it with the fitted transformers.
+    '''
     
     df = dataframe.copy()
     
@@ -98,37 +105,52 @@ def preprocess_text_data(dataframe, verbose = True):
         print("Column 'designation' has been renamed as 'title' \n")
     
     
+    nb_rows = df.shape[0]
+
     # Feature engineering: title_descr
-    concatenate_variables(df, 'title', 'description', nans_to = '', separator =' \n ', \
-                          concat_col_name = 'title_descr', drop = False, verbose = verbose)
+    with tt.stage('concatenate_variables', items = nb_rows):
+        concatenate_variables(df, 'title', 'description', nans_to = '', separator =' \n ', \
+                              concat_col_name = 'title_descr', drop = False, verbose = verbose)
 
     
     # HTML parse & lower case
-    html_parsing(df, 'title_descr', verbose = verbose)
+    with tt.stage('html_parsing', items = nb_rows):
+        html_parsing(df, 'title_descr', verbose = verbose)
    
 
      # Tokenize and lemmatize
     import nltk
     nltk.download('wordnet', quiet = True)
     from nltk.tokenize import RegexpTokenizer
-    from nltk.stem import WordNetLemmatizer
+    import lemma_table_tools as ltt
     
     tokenizer = RegexpTokenizer(r'\w{3,}')
-    lemmatizer = WordNetLemmatizer()
+    lemmatizer = lemma_table if lemma_table is not None else ltt.LemmaTable()
 
-    get_lemmatized_tokens(df, 'title_descr', tokenizer, 'lemma_tokens', lemmatizer, uniques = True, verbose = verbose)
+    with tt.stage('tokenize_lemmatize', items = nb_rows):
+        tokens = get_lemmatized_tokens(df, 'title_descr', tokenizer, 'lemma_tokens', lemmatizer, uniques = True, to_lists = False, verbose = verbose)
     
     
     ## Get language
-    get_language(df, 'title_descr', correct = True, get_probs = False, verbose = verbose)
+    with tt.stage('get_language', items = nb_rows):
+        get_language(df, 'title_descr', correct = True, get_probs = False, verbose = verbose)
     
     
     ## Remove stop words according to language
-    remove_stop_words(df, 'lemma_tokens', 'lemma_tokens', 'language', verbose = verbose)
+    with tt.stage('remove_stop_words', items = nb_rows):
+        tokens = remove_stop_words(df, 'lemma_tokens', 'lemma_tokens', 'language', verbose = verbose,
+                                   tokens = tokens, to_lists = False)
     
     
     ## feature engineering token_length
-    get_token_length(df, 'lemma_tokens', 'text_token_len', verbose = verbose)
+    with tt.stage('get_token_length', items = nb_rows):
+        get_token_length(df, 'lemma_tokens', 'text_token_len', verbose = verbose, tokens = tokens)
+
+    ## the token ids are turned back into lists of strings once, for the TF-IDF vectorizer
+    ## (column kept at its place, before 'language')
+    with tt.stage('token_lists', items = nb_rows):
+        lemma_tokens = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
+        df.insert(df.columns.get_loc('language'), 'lemma_tokens', lemma_tokens)
     
     
     return df
@@ -170,21 +192,13 @@ def concatenate_variables(df, col1, col2, nans_to, separator, concat_col_name, d
 def html_parsing(df, col_to_parse, verbose = False):
     '''
     HTML parse and lower case text content in col_to_parse
+    (same text as BeautifulSoup(text, "lxml").get_text(), see html_tools)
     '''
-    from bs4 import BeautifulSoup
+    import html_tools as htt
 
-    import warnings
-    from bs4 import MarkupResemblesLocatorWarning #GuessedAtParserWarning
-    warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-    
-    
     t0 = time.time()
-    
-#     with warnings.catch_warnings():     ## disable warnings when BeautifulSoup encounters just plain text.
-#         warnings.simplefilter("ignore")
-#         warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-        
-    df[col_to_parse] = [BeautifulSoup(text, "lxml").get_text().lower() for text in df.loc[:,col_to_parse]]  #lxml, html.parser
+
+    df[col_to_parse] = htt.parse_html(df.loc[:,col_to_parse])
 
     t1 = time.time()
     
@@ -194,12 +208,14 @@ def html_parsing(df, col_to_parse, verbose = False):
 
 
 
-def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True):
+def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True, to_lists = True):
     '''
     For each row creates a list of tokens obtained from 'col_to_tokenize' column by tokenizing the text.
     Then lemmatize each word in the list, for each row.
-    If unique = True, remove duplicated from each list of lemmas using set(). Keep the order of the words in list.
+    If unique = True, remove duplicated from each list of lemmas (on the token ids, see token_ids_tools). Keep the order of the words in list.
     Store list of lemmas in a new variable 'tokenized_col'
+    If to_lists = False, 'tokenized_col' is not set: the lemmas are only returned as token ids
+    (token_ids_tools.RaggedTokens) for the next stages.
     '''    
     
     t0 = time.time()
@@ -207,11 +223,15 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
     all_token_list = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
     all_lemmatized_list = [ [lemmatizer.lemmatize(t) for t in token_list] for token_list in all_token_list ]
 
-    if uniques :    
-        df[tokenized_col] = [sorted( set(lemma_list), key=lemma_list.index ) for lemma_list in all_lemmatized_list ]
-    else:    
+    tokens = None
+    if uniques or not to_lists:
+        import token_ids_tools as tit
+        tokens = tit.from_lists(all_lemmatized_list)
+        tokens = tit.dedupe(tokens) if uniques else tokens
+
+    if to_lists:
         #df[tokenized_col] = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
-        df[tokenized_col] = all_lemmatized_list
+        df[tokenized_col] = all_lemmatized_list if tokens is None else tokens.to_lists()
 
     t1 = time.time()
     
@@ -219,6 +239,8 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
         print(f"Column '{col_to_tokenize}' has been successfully tokenized.")
         print("\t Tokenization + Lemmatization takes %0.2f seconds \n" %(t1-t0))
 
+    return tokens
+
         
         
 
@@ -300,39 +322,48 @@ def import_stop_words(language):
 
 
     
-def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False):
+def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False, tokens = None, to_lists = True):
     '''
     Remove the stop words from each token list in df[col_to_clean] according to the detected language df['language']
     Store the cleaned token list in a new variable df[col_result]
-    If col_result result does not exist in dataframe, intialize with empty strings (object dtype)
+    The stop words of all the rows are removed at once on the token ids (see token_ids_tools)
+    tokens (RaggedTokens) is used instead of df[col_to_clean] if given, to_lists = False leaves df[col_result]
+    unset. Returns the cleaned RaggedTokens.
     '''
+    import token_ids_tools as tit
 
     t0 = time.time()
     
-    new_name = col_result 
-    if new_name not in df.columns:
-        df[new_name] = ''  # initilize col as 'object' type
-    
-    for i, token_list, language in zip(df.index, df[col_to_clean], df[col_language]):
+    ## stop words imported once per language present
+    stop_words = {str(language) : import_stop_words(language) for language in set(df[col_language])}
+    tokens = tit.from_lists(df[col_to_clean]) if tokens is None else tokens
+    tokens = tit.remove_stop_words(tokens, df[col_language], stop_words)
     
-        stop_words = import_stop_words(language)        
-        df.at[i, new_name] = [token for token in token_list if token not in stop_words]
+    if to_lists:
+        df[col_result] = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
     
     t1 = time.time()
         
     if verbose:
         print("Removing stop-words takes %0.2f seconds. \n" %(t1-t0))
+
+    return tokens
     
 
     
 
-def get_token_length(df, col_with_tokens, col_with_length, verbose = False):
+def get_token_length(df, col_with_tokens, col_with_length, verbose = False, tokens = None):
     '''
     Creates a new variable measuring the number of tokens in column col_with_tokens
+    (or in tokens, RaggedTokens, if given)
     '''
     t0 = time.time()
     
-    df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    if tokens is None:
+        df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    else:
+        import token_ids_tools as tit
+        df[col_with_length] = tit.get_lengths(tokens)
     
     t1 = time.time()
     
@@ -610,13 +641,16 @@ def preprocess_image_data(df, threshold, new_pixel_nb, path, output ='array', ve
         # load image
         file = path + "image_" + str(df.loc[idx,'imageid'])+"_product_" \
                                                + str(df.loc[idx,'productid'])+".jpg"
-        image = cv2.imread(file)
+        with tt.stage('image_read', items = 1):
+            image = cv2.imread(file)
         
         # crop image 
-        cropped_image = crop_image(image, threshold = threshold)
+        with tt.stage('image_crop', items = 1):
+            cropped_image = crop_image(image, threshold = threshold)
         
         # resize image (downscale)
-        resized_image = cv2.resize(cropped_image, (new_pixel_nb, new_pixel_nb))
+        with tt.stage('image_resize', items = 1):
+            resized_image = cv2.resize(cropped_image, (new_pixel_nb, new_pixel_nb))
     
         # vectorize image (3D -> 1D) and append to general array
         img_array[i,...] = resized_image.reshape(new_pixel_nb*new_pixel_nb*3)
@@ -1910,19 +1944,73 @@ def get_sample_fusion_data(sample_text_hl_output, sample_image_hl_output, text_h
 
 
 
-def decode_predictions(sample_pred_vector, target_encoder):
-    ## reverse one hot encoding
-    sample_pred_label = sample_pred_vector.argmax(axis = 1)
+class LabelDecoder:
+    '''
+    Decode model output vectors into product type codes and class names.
+    Built once from the fitted target encoder and the product_class table, it maps
+    the model output index i to codes[i] (prdtypecode) and classes[i] (prodtype)
+    through flat arrays, so decoding a batch is plain array indexing.
+    '''
 
+    def __init__(self, target_encoder, product_class):
+        ## LabelEncoder.inverse_transform(i) is classes_[i]
+        self.codes = np.asarray(target_encoder.classes_)
 
-    ## revert label encoder, get predcited code
-    # target_encoder = joblib.load("../../fm/Splitted_datasets/Images_224px/Preprocessed_text_data/2308281220_text_target_encoder")
-    sample_pred_code = target_encoder.inverse_transform(sample_pred_label)[0]
-    
-    ## get redicted class name
-    product_class = pd.read_csv('../../datasets/product_class.csv', sep = ';')
-    product_class.drop('target', axis = 1, inplace = True)
-    sample_pred_class = product_class[product_class['prdtypecode']==sample_pred_code]['prodtype'].values
+        class_by_code = dict(zip(product_class['prdtypecode'], product_class['prodtype']))
+        self.classes = np.array([class_by_code.get(code, 'unknown') for code in self.codes], dtype = object)
+
+
+    def decode(self, pred_vectors):
+        '''
+        Top-1 codes and classes for each row of pred_vectors.
+        '''
+        labels = np.atleast_2d(pred_vectors).argmax(axis = 1)
+
+        return self.codes[labels], self.classes[labels]
+
+
+    def top_k(self, pred_vectors, k = 3):
+        '''
+        Top-k codes, classes and confidences for each row of pred_vectors, 
+        sorted by decreasing confidence. Outputs have shape (Nb_rows, k).
+        '''
+        pred_vectors = np.atleast_2d(pred_vectors)
+        k = min(k, pred_vectors.shape[1])
+
+        ## unordered top-k per row, then sort only those k columns
+        top_labels = np.argpartition(pred_vectors, -k, axis = 1)[:, -k:]
+        top_confidences = np.take_along_axis(pred_vectors, top_labels, axis = 1)
+
+        order = np.argsort(-top_confidences, axis = 1)
+        top_labels = np.take_along_axis(top_labels, order, axis = 1)
+        top_confidences = np.take_along_axis(top_confidences, order, axis = 1)
+
+        return self.codes[top_labels], self.classes[top_labels], top_confidences
+
+
+
+def get_label_decoder(target_encoder, product_class_file, sep = ';'):
+    '''
+    Build a LabelDecoder from the target encoder and the product_class csv file.
+    '''
+    product_class = pd.read_csv(product_class_file, sep = sep)
+
+    return LabelDecoder(target_encoder, product_class)
+
+
+
+def decode_predictions(sample_pred_vector, target_encoder, decoder = None):
+    '''
+    Predicted code and class name of the first row of sample_pred_vector.
+    Pass a prebuilt decoder to avoid reading the product_class table on every call.
+    '''
+    if decoder is None:
+        decoder = get_label_decoder(target_encoder, '../../datasets/product_class.csv')
+
+    pred_codes, pred_classes = decoder.decode(sample_pred_vector)
+
+    sample_pred_code = pred_codes[0]
+    sample_pred_class = pred_classes[:1]
     
     return sample_pred_code, sample_pred_class
 
@@ -87,7 +87,11 @@ def save(datasets, types, names,  path, doit = False, verbose = True):
     
     
         
-def preprocess_text_data(dataframe, verbose = True):
+def preprocess_text_data(dataframe, verbose = True, lemma_table = None):
+    '''
+    lemma_table (lemma_table_tools.LemmaTable) is used and completed for the lemmatization,
+    pass the same table for every split to save it with the fitted transformers.
+    '''
     
     df = dataframe.copy()
     
@@ -109,12 +113,12 @@ def preprocess_text_data(dataframe, verbose = True):
     import nltk
     nltk.download('wordnet', quiet = True)
     from nltk.tokenize import RegexpTokenizer
-    from nltk.stem import WordNetLemmatizer
+    import lemma_table_tools as ltt
     
     tokenizer = RegexpTokenizer(r'\w{3,}')
-    lemmatizer = WordNetLemmatizer()
+    lemmatizer = lemma_table if lemma_table is not None else ltt.LemmaTable()
 
-    get_lemmatized_tokens(df, 'title_descr', tokenizer, 'lemma_tokens', lemmatizer, uniques = True)
+    tokens = get_lemmatized_tokens(df, 'title_descr', tokenizer, 'lemma_tokens', lemmatizer, uniques = True, to_lists = False)
     
     
     ## Get language
@@ -122,11 +126,17 @@ def preprocess_text_data(dataframe, verbose = True):
     
     
     ## Remove stop words according to language
-    remove_stop_words(df, 'lemma_tokens', 'lemma_tokens', 'language', verbose = verbose)
+    tokens = remove_stop_words(df, 'lemma_tokens', 'lemma_tokens', 'language', verbose = verbose,
+                               tokens = tokens, to_lists = False)
     
     
     ## feature engineering token_length
-    get_token_length(df, 'lemma_tokens', 'text_token_len', verbose = verbose)
+    get_token_length(df, 'lemma_tokens', 'text_token_len', verbose = verbose, tokens = tokens)
+
+    ## the token ids are turned back into lists of strings once, for the TF-IDF vectorizer
+    ## (column kept at its place, before 'language')
+    lemma_tokens = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
+    df.insert(df.columns.get_loc('language'), 'lemma_tokens', lemma_tokens)
     
     
     return df
@@ -168,21 +178,13 @@ def concatenate_variables(df, col1, col2, nans_to, separator, concat_col_name, d
 def html_parsing(df, col_to_parse, verbose = False):
     '''
     HTML parse and lower case text content in col_to_parse
+    (same text as BeautifulSoup(text, "lxml").get_text(), see html_tools)
     '''
-    from bs4 import BeautifulSoup
+    import html_tools as htt
 
-    import warnings
-    from bs4 import MarkupResemblesLocatorWarning #GuessedAtParserWarning
-    warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-    
-    
     t0 = time.time()
-    
-#     with warnings.catch_warnings():     ## disable warnings when BeautifulSoup encounters just plain text.
-#         warnings.simplefilter("ignore")
-#         warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-        
-    df[col_to_parse] = [BeautifulSoup(text, "lxml").get_text().lower() for text in df.loc[:,col_to_parse]]  #lxml, html.parser
+
+    df[col_to_parse] = htt.parse_html(df.loc[:,col_to_parse])
 
     t1 = time.time()
     
@@ -192,12 +194,14 @@ def html_parsing(df, col_to_parse, verbose = False):
 
 
 
-def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True):
+def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True, to_lists = True):
     '''
     For each row creates a list of tokens obtained from 'col_to_tokenize' column by tokenizing the text.
     Then lemmatize each word in the list, for each row.
-    If unique = True, remove duplicated from each list of lemmas using set(). Keep the order of the words in list.
+    If unique = True, remove duplicated from each list of lemmas (on the token ids, see token_ids_tools). Keep the order of the words in list.
     Store list of lemmas in a new variable 'tokenized_col'
+    If to_lists = False, 'tokenized_col' is not set: the lemmas are only returned as token ids
+    (token_ids_tools.RaggedTokens) for the next stages.
     '''    
     
     t0 = time.time()
@@ -205,11 +209,15 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
     all_token_list = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
     all_lemmatized_list = [ [lemmatizer.lemmatize(t) for t in token_list] for token_list in all_token_list ]
 
-    if uniques :    
-        df[tokenized_col] = [sorted( set(lemma_list), key=lemma_list.index ) for lemma_list in all_lemmatized_list ]
-    else:    
+    tokens = None
+    if uniques or not to_lists:
+        import token_ids_tools as tit
+        tokens = tit.from_lists(all_lemmatized_list)
+        tokens = tit.dedupe(tokens) if uniques else tokens
+
+    if to_lists:
         #df[tokenized_col] = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
-        df[tokenized_col] = all_lemmatized_list
+        df[tokenized_col] = all_lemmatized_list if tokens is None else tokens.to_lists()
 
     t1 = time.time()
     
@@ -217,6 +225,8 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
         print(f"Column '{col_to_tokenize}' has been successfully tokenized.")
         print("\t Tokenization + Lemmatization takes %0.2f seconds \n" %(t1-t0))
 
+    return tokens
+
         
         
 
@@ -298,39 +308,48 @@ def import_stop_words(language):
 
 
     
-def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False):
+def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False, tokens = None, to_lists = True):
     '''
     Remove the stop words from each token list in df[col_to_clean] according to the detected language df['language']
     Store the cleaned token list in a new variable df[col_result]
-    If col_result result does not exist in dataframe, intialize with empty strings (object dtype)
+    The stop words of all the rows are removed at once on the token ids (see token_ids_tools)
+    tokens (RaggedTokens) is used instead of df[col_to_clean] if given, to_lists = False leaves df[col_result]
+    unset. Returns the cleaned RaggedTokens.
     '''
+    import token_ids_tools as tit
 
     t0 = time.time()
     
-    new_name = col_result 
-    if new_name not in df.columns:
-        df[new_name] = ''  # initilize col as 'object' type
+    ## stop words imported once per language present
+    stop_words = {str(language) : import_stop_words(language) for language in set(df[col_language])}
+    tokens = tit.from_lists(df[col_to_clean]) if tokens is None else tokens
+    tokens = tit.remove_stop_words(tokens, df[col_language], stop_words)
     
-    for i, token_list, language in zip(df.index, df[col_to_clean], df[col_language]):
-    
-        stop_words = import_stop_words(language)        
-        df.at[i, new_name] = [token for token in token_list if token not in stop_words]
+    if to_lists:
+        df[col_result] = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
     
     t1 = time.time()
         
     if verbose:
         print("Removing stop-words takes %0.2f seconds. \n" %(t1-t0))
+
+    return tokens
     
 
     
 
-def get_token_length(df, col_with_tokens, col_with_length, verbose = False):
+def get_token_length(df, col_with_tokens, col_with_length, verbose = False, tokens = None):
     '''
     Creates a new variable measuring the number of tokens in column col_with_tokens
+    (or in tokens, RaggedTokens, if given)
     '''
     t0 = time.time()
     
-    df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    if tokens is None:
+        df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    else:
+        import token_ids_tools as tit
+        df[col_with_length] = tit.get_lengths(tokens)
     
     t1 = time.time()
     
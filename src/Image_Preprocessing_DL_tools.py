@@ -4,6 +4,8 @@ import os
 import cv2
 import time
 
+import timing_tools as tt
+
 ################################################################################################################
 
 def date_time():
@@ -97,17 +99,21 @@ def crop_resize_images(df, threshold, new_pixel_nb, path, new_dir, verbose = Fal
         filename = "image_" + str(df.loc[idx,'imageid'])+"_product_" + str(df.loc[idx,'productid'])+".jpg"
 
         file = path + filename
-        image = cv2.imread(file)
+        with tt.stage('image_read', items = 1):
+            image = cv2.imread(file)
         
         # crop image 
-        cropped_image = crop_image(image, threshold = threshold)
+        with tt.stage('image_crop', items = 1):
+            cropped_image = crop_image(image, threshold = threshold)
         
         # resize image (downscale)
-        resized_image = cv2.resize(cropped_image, (new_pixel_nb, new_pixel_nb))
+        with tt.stage('image_resize', items = 1):
+            resized_image = cv2.resize(cropped_image, (new_pixel_nb, new_pixel_nb))
       
         # save array as a new image in newly created folder, same image name
         new_file = new_dir + '/' + filename
-        cv2.imwrite( new_file, resized_image)
+        with tt.stage('image_write', items = 1):
+            cv2.imwrite( new_file, resized_image)
 #         print(new_file)
     
         if verbose:
@@ -1,3 +1,4 @@
+import re
 import numpy as np
 import pandas as pd
 import time
@@ -115,19 +116,12 @@ def get_html_tags():
     return html_tags
     
 
+## one search for '<' followed by any of the tags, instead of one search per tag
+HTML_TAG_DETECTOR = re.compile('<(?:' + '|'.join(re.escape(tag) for tag in get_html_tags()) + ')')
+
+
 def has_html_tag(text):
-    import re
-    
-    html_tags = get_html_tags()
-    
-    cnt = 0
-    for tag in html_tags:
-        pattern = '<' + tag
-        result  = re.search(pattern, text)
-        if result:
-            cnt += 1
-      
-    return True if (cnt >= 1) else False
+    return HTML_TAG_DETECTOR.search(text) is not None
     
 
 def get_html_encoding_proportion(df, drop = False):
@@ -159,17 +153,13 @@ def get_html_encoding_proportion(df, drop = False):
 def html_parsing(df, col_to_parse, verbose = False):
     '''
     HTML parse and lower case text content in col_to_parse
+    (same text as BeautifulSoup(text, "lxml").get_text(), see html_tools)
     '''
-    from bs4 import BeautifulSoup
+    import html_tools as htt
 
-    import warnings
-    from bs4 import MarkupResemblesLocatorWarning #GuessedAtParserWarning
-    warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-    
-    
     t0 = time.time()
-        
-    df[col_to_parse] = [BeautifulSoup(text, "lxml").get_text().lower() for text in df.loc[:,col_to_parse]]  #lxml, html.parser
+
+    df[col_to_parse] = htt.parse_html(df.loc[:,col_to_parse])
 
     t1 = time.time()
     
@@ -257,12 +247,14 @@ def plot_language_distribution(df, Nb_2show):
         
 
 
-def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True):
+def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True, to_lists = True):
     '''
     For each row creates a list of tokens obtained from 'col_to_tokenize' column by tokenizing the text.
     Then lemmatize each word in the list, for each row.
-    If unique = True, remove duplicated from each list of lemmas using set(). Keep the order of the words in list.
+    If unique = True, remove duplicated from each list of lemmas (on the token ids, see token_ids_tools). Keep the order of the words in list.
     Store list of lemmas in a new variable 'tokenized_col'
+    If to_lists = False, 'tokenized_col' is not set: the lemmas are only returned as token ids
+    (token_ids_tools.RaggedTokens) for the next stages.
     '''    
     
     t0 = time.time()
@@ -270,11 +262,15 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
     all_token_list = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
     all_lemmatized_list = [ [lemmatizer.lemmatize(t) for t in token_list] for token_list in all_token_list ]
 
-    if uniques :    
-        df[tokenized_col] = [sorted( set(lemma_list), key=lemma_list.index ) for lemma_list in all_lemmatized_list ]
-    else:    
+    tokens = None
+    if uniques or not to_lists:
+        import token_ids_tools as tit
+        tokens = tit.from_lists(all_lemmatized_list)
+        tokens = tit.dedupe(tokens) if uniques else tokens
+
+    if to_lists:
         #df[tokenized_col] = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
-        df[tokenized_col] = all_lemmatized_list
+        df[tokenized_col] = all_lemmatized_list if tokens is None else tokens.to_lists()
 
     t1 = time.time()
     
@@ -282,6 +278,8 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
         print(f"Column '{col_to_tokenize}' has been successfully tokenized.")
         print("\t Tokenization + Lemmatization takes %0.2f seconds \n" %(t1-t0))
 
+    return tokens
+
 
     
 def import_stop_words(language):
@@ -316,28 +314,32 @@ def import_stop_words(language):
 
         
         
-def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False):
+def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False, tokens = None, to_lists = True):
     '''
     Remove the stop words from each token list in df[col_to_clean] according to the detected language df['language']
     Store the cleaned token list in a new variable df[col_result]
-    If col_result result does not exist in dataframe, intialize with empty strings (object dtype)
+    The stop words of all the rows are removed at once on the token ids (see token_ids_tools)
+    tokens (RaggedTokens) is used instead of df[col_to_clean] if given, to_lists = False leaves df[col_result]
+    unset. Returns the cleaned RaggedTokens.
     '''
+    import token_ids_tools as tit
 
     t0 = time.time()
     
-    new_name = col_result 
-    if new_name not in df.columns:
-        df[new_name] = ''  # initilize col as 'object' type
+    ## stop words imported once per language present
+    stop_words = {str(language) : import_stop_words(language) for language in set(df[col_language])}
+    tokens = tit.from_lists(df[col_to_clean]) if tokens is None else tokens
+    tokens = tit.remove_stop_words(tokens, df[col_language], stop_words)
     
-    for i, token_list, language in zip(df.index, df[col_to_clean], df[col_language]):
-    
-        stop_words = import_stop_words(language)        
-        df.at[i, new_name] = [token for token in token_list if token not in stop_words]
+    if to_lists:
+        df[col_result] = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
     
     t1 = time.time()
         
     if verbose:
         print("Removing stop-words takes %0.2f seconds. \n" %(t1-t0))
+
+    return tokens
     
 
 
@@ -350,14 +352,15 @@ def get_category_top_words(df, product_class, Nb_top_words):
     
     
 def create_category_pool(df, product_class):
-    cat_tokens = {}
-    for categ in product_class['prdtypecode']:
-        token_pool = []
+    '''
+    Pool of the lemma tokens of all the products of each category, built on the token ids (see token_ids_tools).
+    '''
+    import token_ids_tools as tit
 
-        for token_list in df[df['prdtypecode'] == categ]['lemma_tokens']:
-            token_pool += token_list  
+    tokens = tit.from_lists(df['lemma_tokens'])
+    pools, categories = tit.pool_by_category(tokens, df['prdtypecode'], list(product_class['prdtypecode']))
 
-        cat_tokens[str(categ)] = token_pool
+    cat_tokens = {str(categ) : token_pool for categ, token_pool in zip(categories, pools.to_lists())}
 
     return cat_tokens
 
@@ -403,13 +406,18 @@ def display_category_top_words(product_class, to_show = 'all'):
 
         
         
-def get_token_length(df, col_with_tokens, col_with_length, verbose = False):
+def get_token_length(df, col_with_tokens, col_with_length, verbose = False, tokens = None):
     '''
     Creates a new variable measuring the number of tokens in column col_with_tokens
+    (or in tokens, RaggedTokens, if given)
     '''
     t0 = time.time()
     
-    df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    if tokens is None:
+        df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    else:
+        import token_ids_tools as tit
+        df[col_with_length] = tit.get_lengths(tokens)
     
     t1 = time.time()
     
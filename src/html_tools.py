@@ -0,0 +1,328 @@
+'''
+Fast HTML to text conversion, equivalent to BeautifulSoup(text, "lxml").get_text().
+
+BeautifulSoup builds a Python tree of every title_descr string, markup or not. Here:
+    - rows without any '<', '&' or control character (most of the catalog) are plain text: only the
+      leading blanks that lxml skips are removed
+    - simple, well-formed markup (common formatting tags properly nested and closed, HTML 4 named
+      entities such as the French &eacute; &egrave; &ccedil; &oelig;, numeric references) goes through
+      a streaming tag / entity stripper
+    - anything else (tables, raw-text tags like <script> or <pre>, comments, stray or implicitly
+      closed tags, ambiguous entities...) falls back to lxml, streamed into a target that keeps the
+      strings exactly as BeautifulSoup does without building any tree.
+
+    import html_tools as htt
+    texts = htt.parse_html(texts)           # [BeautifulSoup(t, "lxml").get_text().lower() for t in texts]
+    report = htt.check_parity(texts)        # compare with BeautifulSoup on a corpus
+'''
+
+import re
+import time
+import warnings
+import threading
+from html.entities import name2codepoint
+
+
+
+## rows without any of these characters are plain text
+MARKUP_DETECTOR = re.compile('[<&\r\x00-\x08\x0b\x0c\x0e-\x1f\x7f\ufeff]')
+
+## characters that libxml2 versions do not all handle the same way
+UNSAFE_CHARACTERS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\x7f\ufeff]')
+
+## blanks skipped by lxml at the start of a document
+LEADING_BLANKS = ' \t\n'
+
+## BeautifulSoup replaces the strings made of these characters only by '\n' or ' '
+ASCII_SPACES = ' \t\n\r\x0c'
+
+## tags left to the stripper (see get_html_tags in Text_preprocessing_tools), tables and any tag
+## changing how text is parsed or kept (script, style, pre, textarea...) go to lxml
+INLINE_TAGS = frozenset(['a', 'abbr', 'b', 'big', 'cite', 'code', 'em', 'font', 'i', 'small', 'span',
+                         'strong', 'sub', 'sup', 'u', 's', 'strike', 'tt'])
+BLOCK_TAGS = frozenset(['div', 'p', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'center'])
+VOID_TAGS = frozenset(['br', 'img', 'hr'])
+TAG_KINDS = dict([(tag, 'inline') for tag in INLINE_TAGS] + [(tag, 'block') for tag in BLOCK_TAGS] + [(tag, 'void') for tag in VOID_TAGS])
+
+## named entities of HTML 4, including the French letters of get_html_tags
+ENTITIES = {name : chr(codepoint) for name, codepoint in name2codepoint.items()}
+
+## start tag (quoted attribute values may contain '>'), end tag, or any other '<'
+TOKENIZER = re.compile(r'''<([a-zA-Z][a-zA-Z0-9]*)(?=[\s/>])((?:\s*=\s*(?:"[^"]*"|'[^']*')|[^<>"'])*)>'''
+                       r'|</([a-zA-Z][a-zA-Z0-9]*)\s*>'
+                       r'|<')
+
+## '&' followed by something an HTML parser may read as a reference
+REFERENCE = re.compile(r'&(?:([a-zA-Z][a-zA-Z0-9]*);|#([0-9]{1,7});|#[xX]([0-9a-fA-F]{1,6});|[a-zA-Z#])')
+
+
+
+class _Fallback(Exception):
+    pass
+
+
+
+def is_safe_codepoint(codepoint):
+    '''
+    Numeric references decoded to the same character by every HTML parser (no C0 / C1 controls,
+    surrogates, noncharacters or out of range values, which are remapped or replaced).
+    '''
+    return (codepoint in (0x09, 0x0a) or 0x20 <= codepoint <= 0x7e or 0xa0 <= codepoint <= 0xd7ff
+            or 0xe000 <= codepoint <= 0xfdcf or 0xfdf0 <= codepoint <= 0xfffd
+            or (0x10000 <= codepoint <= 0x10ffff and codepoint & 0xfffe != 0xfffe))
+
+
+
+def _decode_reference(match):
+    name, decimal, hexadecimal = match.groups()
+
+    if name is not None:
+        if name in ENTITIES:
+            return ENTITIES[name]
+    elif decimal is not None or hexadecimal is not None:
+        codepoint = int(decimal, 10) if decimal is not None else int(hexadecimal, 16)
+        if is_safe_codepoint(codepoint):
+            return chr(codepoint)
+
+    ## unknown entity or reference without ';', decoded differently by each libxml2 version
+    raise _Fallback()
+
+
+
+def _decode_string(string):
+    '''
+    Entity decoded text between two tags, collapsed like BeautifulSoup if it is only made of spaces.
+    '''
+    if '&' in string:
+        string = REFERENCE.sub(_decode_reference, string)
+
+    if not string.strip(ASCII_SPACES):
+        return '\n' if '\n' in string else ' '
+
+    return string
+
+
+
+def is_well_formed(start_tags, attributes, end_tags):
+    '''
+    True if the tags found by TOKENIZER are all known, properly nested and explicitly closed, i.e. if
+    every parser emits a start / end event exactly at each of them.
+    '''
+    open_tags = []
+
+    for start_tag, attribute, end_tag in zip(start_tags, attributes, end_tags):
+        if start_tag is not None:
+            kind = TAG_KINDS.get(start_tag) or TAG_KINDS.get(start_tag.lower())
+            if kind == 'void':
+                continue
+            if kind is None or attribute.endswith('/'):
+                return False
+            start_tag = start_tag.lower()
+            if start_tag in open_tags or (kind == 'block' and 'p' in open_tags):
+                return False        # implicitly closed by the parser
+            open_tags.append(start_tag)
+        elif end_tag is not None:
+            if not open_tags or open_tags.pop() != end_tag.lower():
+                return False
+        else:
+            return False            # '<' that is not a tag
+
+    return True
+
+
+
+def strip_markup(text):
+    '''
+    Text content of a simple, well-formed HTML fragment, or None if it needs a full HTML parser.
+    '''
+    if UNSAFE_CHARACTERS.search(text):
+        return None
+
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    ## one pass: text between the tags, then the 3 groups of each tag
+    parts = TOKENIZER.split(text.lstrip(LEADING_BLANKS))
+
+    if not is_well_formed(parts[1::4], parts[2::4], parts[3::4]):
+        return None
+
+    try:
+        return ''.join([string if '&' not in string and string.strip(ASCII_SPACES) else _decode_string(string)
+                        for string in parts[::4] if string])
+    except _Fallback:
+        return None
+
+
+
+class _TextTarget:
+    '''
+    lxml parser target keeping the strings of the document as BeautifulSoup does: consecutive data
+    joined, whitespace-only strings replaced by '\n' or ' ' (except in <pre> and <textarea>),
+    comments, doctypes, processing instructions and <script>, <style>, <template> contents dropped.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.strings = []
+        self.current = []
+        self.containers = 0
+        self.preserve = 0
+
+
+    def _end_data(self):
+        if self.current:
+            string = ''.join(self.current)
+            self.current = []
+            if not self.preserve and not string.strip(ASCII_SPACES):
+                string = '\n' if '\n' in string else ' '
+            if not self.containers:
+                self.strings.append(string)
+
+
+    def start(self, tag, attrib):
+        self._end_data()
+        if tag in ('script', 'style', 'template'):
+            self.containers += 1
+        elif tag in ('pre', 'textarea'):
+            self.preserve += 1
+
+
+    def end(self, tag):
+        self._end_data()
+        if tag in ('script', 'style', 'template'):
+            self.containers -= 1
+        elif tag in ('pre', 'textarea'):
+            self.preserve -= 1
+
+
+    def data(self, data):
+        self.current.append(data)
+
+
+    def comment(self, text):
+        self._end_data()
+
+
+    def pi(self, target, data = None):
+        self._end_data()
+
+
+    def doctype(self, name, pubid, system):
+        self._end_data()
+
+
+    def close(self):
+        self._end_data()
+        text = ''.join(self.strings)
+        self.reset()
+
+        return text
+
+
+
+_parsers = threading.local()
+
+
+
+def get_lxml_text(text):
+    '''
+    BeautifulSoup(text, "lxml").get_text() through lxml alone (one parser per thread).
+    '''
+    from lxml import etree
+
+    if getattr(_parsers, 'parser', None) is None:
+        _parsers.target = _TextTarget()
+        _parsers.parser = etree.HTMLParser(target = _parsers.target, recover = True)
+
+    ## BeautifulSoup drops a leading byte order mark before parsing
+    if text.startswith('\ufeff'):
+        text = text[1:]
+
+    try:
+        _parsers.parser.feed(text)
+        return _parsers.parser.close()
+    except Exception:
+        _parsers.parser = None
+        raise
+
+
+
+def get_text(text):
+    '''
+    BeautifulSoup(text, "lxml").get_text(), without building a tree.
+    '''
+    if not MARKUP_DETECTOR.search(text):
+        return text.lstrip(LEADING_BLANKS)
+
+    stripped = strip_markup(text)
+    if stripped is not None:
+        return stripped
+
+    try:
+        return get_lxml_text(text)
+    except Exception:
+        from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+        warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
+
+        return BeautifulSoup(text, "lxml").get_text()
+
+
+
+def parse_html(texts, lower = True):
+    '''
+    Text content of each HTML string of texts, lower cased if lower = True.
+    '''
+    if lower:
+        return [get_text(text).lower() for text in texts]
+
+    return [get_text(text) for text in texts]
+
+
+
+def get_path(text):
+    '''
+    Way get_text converts text: 'plain', 'stripped' or 'lxml'.
+    '''
+    if not MARKUP_DETECTOR.search(text):
+        return 'plain'
+
+    return 'stripped' if strip_markup(text) is not None else 'lxml'
+
+
+
+def check_parity(texts, verbose = True):
+    '''
+    Compare parse_html with BeautifulSoup(text, "lxml").get_text().lower() on texts.
+    Returns {'paths' : number of texts per path, 'mismatches' : list of (index, expected, result),
+    'bs4_time', 'html_tools_time' (seconds), 'speedup'}.
+    '''
+    from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+    warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
+
+    texts = list(texts)
+
+    t0 = time.perf_counter()
+    expected = [BeautifulSoup(text, "lxml").get_text().lower() for text in texts]
+    t1 = time.perf_counter()
+    result = parse_html(texts)
+    t2 = time.perf_counter()
+
+    paths = {'plain' : 0, 'stripped' : 0, 'lxml' : 0}
+    for text in texts:
+        paths[get_path(text)] += 1
+
+    mismatches = [(i, e, r) for i, (e, r) in enumerate(zip(expected, result)) if e != r]
+
+    report = {'paths' : paths, 'mismatches' : mismatches, 'bs4_time' : t1 - t0, 'html_tools_time' : t2 - t1,
+              'speedup' : (t1 - t0) / max(t2 - t1, 1e-9)}
+
+    if verbose:
+        print("%d texts, by path: %s" %(len(texts), paths))
+        print("%d mismatches with BeautifulSoup" %len(mismatches))
+        print("BeautifulSoup %0.3f s, html_tools %0.3f s (x%0.1f)" %(report['bs4_time'], report['html_tools_time'], report['speedup']))
+
+    return report
@@ -0,0 +1,180 @@
+'''
+Stage-level timing of preprocessing, training and serving code.
+
+Wrap a job (a request, a batch, a notebook cell) in collect_timings() and every stage()
+executed inside it, at any depth, is recorded in the returned StageTimer:
+
+    with tt.collect_timings('request') as timer:
+        pt.get_predictions(title, description, image)
+    timer.report()      # dict, or timer.to_json()
+
+Outside collect_timings(), stage() does nothing, so instrumented functions cost nothing extra.
+Work submitted to other threads is recorded if it runs in a copy of the context (see run_in_context).
+'''
+
+import time
+import json
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+
+
+_current_timer = contextvars.ContextVar('current_timer', default = None)
+
+
+
+class StageTimer:
+    '''
+    Collects one record per executed stage: wall time, CPU time (whole process),
+    number of items processed and throughput (items per second).
+    '''
+
+    def __init__(self, name = None):
+        self.name = name
+        self.records = []
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+
+    @contextmanager
+    def stage(self, name, items = None):
+        '''
+        Time the enclosed block as stage 'name'. The yielded record can be updated, e.g.
+        record['items'] = n when the number of items is only known at the end.
+        '''
+        record = {'stage' : name, 'items' : items}
+
+        wall_0 = time.perf_counter()
+        cpu_0 = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.perf_counter() - wall_0
+            record['cpu_time'] = time.process_time() - cpu_0
+            record['start'] = wall_0 - self._t0
+            record['thread'] = threading.current_thread().name
+
+            with self._lock:
+                self.records.append(record)
+
+
+    def summary(self):
+        '''
+        Records aggregated per stage name (calls, wall / CPU time, items, throughput).
+        '''
+        stages = {}
+        with self._lock:
+            records = list(self.records)
+
+        for record in records:
+            stage = stages.setdefault(record['stage'], {'calls' : 0, 'wall_time' : 0.0, 'cpu_time' : 0.0, 'items' : None})
+            stage['calls'] += 1
+            stage['wall_time'] += record['wall_time']
+            stage['cpu_time'] += record['cpu_time']
+            if record['items'] is not None:
+                stage['items'] = (stage['items'] or 0) + record['items']
+
+        for stage in stages.values():
+            stage['throughput'] = stage['items'] / stage['wall_time'] if (stage['items'] and stage['wall_time'] > 0) else None
+
+        return stages
+
+
+    def report(self):
+        return {'name' : self.name,
+                'elapsed' : time.perf_counter() - self._t0,
+                'stages' : self.summary(),
+                'records' : list(self.records)}
+
+
+    def to_json(self, file = None):
+        content = json.dumps(self.report(), indent = 2, default = str)
+
+        if file is not None:
+            with open(file, 'w') as f:
+                f.write(content)
+
+        return content
+
+
+    def print_summary(self):
+        print("Timing report: %s" %(self.name or ''))
+        for name, stage in self.summary().items():
+            throughput = "%10.1f items/s" %stage['throughput'] if stage['throughput'] is not None else ''
+            print("\t %-28s %4d calls  wall %8.3f s  cpu %8.3f s  %s"
+                  %(name, stage['calls'], stage['wall_time'], stage['cpu_time'], throughput))
+
+
+
+@contextmanager
+def collect_timings(name = None, timer = None):
+    '''
+    Activate a StageTimer for the enclosed block (nested blocks keep recording into it
+    unless a new timer is given).
+    '''
+    if timer is None:
+        timer = _current_timer.get() or StageTimer(name)
+
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+
+def get_current_timer():
+    return _current_timer.get()
+
+
+
+@contextmanager
+def stage(name, items = None):
+    '''
+    Record the enclosed block in the active StageTimer, if any.
+    '''
+    timer = _current_timer.get()
+
+    if timer is None:
+        yield {'stage' : name, 'items' : items}
+        return
+
+    with timer.stage(name, items = items) as record:
+        yield record
+
+
+
+def timed_stage(name = None, items = None):
+    '''
+    Decorator version of stage(). items is an optional function of the call arguments
+    returning the number of items processed, e.g. items = lambda df, *a, **k: df.shape[0].
+    '''
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            nb_items = items(*args, **kwargs) if items is not None else None
+            with stage(stage_name, items = nb_items):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+
+def run_in_context(function):
+    '''
+    Wrap function so that it runs in a copy of the current context (keeps the active timer
+    when the function is submitted to a thread pool).
+    '''
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,215 @@
+'''
+Ragged integer representation of token lists (e.g. the lemma_tokens column).
+
+A column of Python lists of strings costs a list object per row and a pointer (plus often a string
+object) per token, and every stage on it is a Python loop. RaggedTokens stores the same lists as:
+    ids         int32 array of all the tokens, row after row
+    offsets     int64 array of nb_rows + 1 positions, row i is ids[offsets[i] : offsets[i + 1]]
+    vocabulary  dict token -> id shared by every RaggedTokens built on it (ids follow insertion order)
+
+Deduplication, stop-word removal, length counting and per-category pooling are NumPy operations
+on ids and offsets. The memory is of the same order as the lists on a real vocabulary (the vocabulary
+strings dominate, see benchmark_tools token_ids): the gain is the time of the stages, so the ids are
+kept from one stage to the next and turned back into lists once, for the TF-IDF vectorizer
+(as in preprocess_text_data):
+
+    import token_ids_tools as tit
+    tokens = tit.from_lists(df['lemma_tokens'])
+    tokens = tit.remove_stop_words(tit.dedupe(tokens), df['language'], stop_words)
+    df['lemma_tokens'] = tokens.to_lists()
+    df['text_token_len'] = tit.get_lengths(tokens)
+'''
+
+import sys
+import itertools
+
+import numpy as np
+
+
+
+class RaggedTokens:
+    '''
+    Token lists as one int32 id array, row offsets and a shared vocabulary (see module docstring).
+    '''
+
+    def __init__(self, ids, offsets, vocabulary):
+        self.ids = np.asarray(ids, dtype = np.int32)
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        self.vocabulary = vocabulary
+
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+
+    def get_row_ids(self):
+        '''
+        Row index of every token.
+        '''
+        return np.repeat(np.arange(len(self), dtype = np.int64), np.diff(self.offsets))
+
+
+    def get_tokens(self):
+        '''
+        Array of the vocabulary strings, indexed by id.
+        '''
+        tokens = np.empty(len(self.vocabulary), dtype = object)
+        tokens[:] = list(self.vocabulary)
+
+        return tokens
+
+
+    def to_lists(self):
+        '''
+        Back to one list of token strings per row.
+        '''
+        flat = self.get_tokens()[self.ids].tolist()
+        offsets = self.offsets.tolist()
+
+        return [flat[start : end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+    def select(self, keep):
+        '''
+        RaggedTokens with only the tokens where the boolean mask keep is True, rows kept in place.
+        '''
+        lengths = np.bincount(self.get_row_ids()[keep], minlength = len(self))
+
+        return RaggedTokens(self.ids[keep], get_offsets(lengths), self.vocabulary)
+
+
+    def get_nbytes(self):
+        '''
+        Memory of the ids, offsets and vocabulary (dict and strings), in bytes.
+        '''
+        return (self.ids.nbytes + self.offsets.nbytes + sys.getsizeof(self.vocabulary)
+                + sum(sys.getsizeof(token) for token in self.vocabulary))
+
+
+
+def get_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = offsets[1:])
+
+    return offsets
+
+
+
+def from_lists(token_lists, vocabulary = None):
+    '''
+    RaggedTokens of an iterable of token lists. New tokens are added to vocabulary (a new one
+    if None): pass the vocabulary of the train split to encode the other splits with the same ids.
+    '''
+    token_lists = list(token_lists)
+    vocabulary = {} if vocabulary is None else vocabulary
+
+    lengths = np.fromiter((len(tokens) for tokens in token_lists), dtype = np.int64, count = len(token_lists))
+    add = vocabulary.setdefault
+
+    ## setdefault gives the id of a known token, or registers a new one with the next id
+    ids = np.fromiter((add(token, len(vocabulary)) for token in itertools.chain.from_iterable(token_lists)),
+                      dtype = np.int32, count = int(lengths.sum()))
+
+    return RaggedTokens(ids, get_offsets(lengths), vocabulary)
+
+
+
+def to_lists(tokens):
+    return tokens.to_lists()
+
+
+
+def get_lengths(tokens):
+    '''
+    Number of tokens of each row.
+    '''
+    return np.diff(tokens.offsets)
+
+
+
+def dedupe(tokens):
+    '''
+    Remove the repeated tokens of each row, keeping the first occurrences in their order
+    (same as sorted(set(l), key = l.index) on every list).
+    '''
+    keys = tokens.get_row_ids() * len(tokens.vocabulary) + tokens.ids
+
+    ## np.unique sorts with a stable sort when return_index = True: first occurrence of each key
+    _, first = np.unique(keys, return_index = True)
+    keep = np.zeros(tokens.ids.shape[0], dtype = bool)
+    keep[first] = True
+
+    return tokens.select(keep)
+
+
+
+def get_stop_word_mask(tokens, stop_words):
+    '''
+    Boolean array over the vocabulary, True for the ids of the stop words (iterable of strings).
+    '''
+    mask = np.zeros(len(tokens.vocabulary), dtype = bool)
+    ids = [tokens.vocabulary[word] for word in stop_words if word in tokens.vocabulary]
+    mask[ids] = True
+
+    return mask
+
+
+
+def remove_stop_words(tokens, languages, stop_words):
+    '''
+    Remove from each row the stop words of its language.
+        languages  : language of each row
+        stop_words : dict language -> stop words, the entry None (if any) is used for the other languages
+    '''
+    languages = np.asarray([str(language) for language in languages])
+    unique_languages, language_codes = np.unique(languages, return_inverse = True)
+
+    ## one stop-word mask over the vocabulary per language, looked up for every token at once
+    is_stop = np.zeros((len(unique_languages), len(tokens.vocabulary)), dtype = bool)
+    for code, language in enumerate(unique_languages):
+        is_stop[code] = get_stop_word_mask(tokens, stop_words.get(language, stop_words.get(None, ())))
+
+    token_languages = language_codes[tokens.get_row_ids()]
+
+    return tokens.select(~is_stop[token_languages, tokens.ids])
+
+
+
+def pool_by_category(tokens, row_categories, categories = None):
+    '''
+    One row per category with the tokens of all its rows, in row order (the token pool of each
+    category). categories sets the order of the output rows (default: sorted unique categories),
+    rows of other categories are left out. Returns (RaggedTokens, categories).
+    '''
+    if categories is None:
+        categories = list(np.unique(np.asarray(row_categories)))
+
+    index = {category : code for code, category in enumerate(categories)}
+    codes = np.fromiter((index.get(category, -1) for category in row_categories), dtype = np.int64,
+                        count = len(tokens))
+
+    ## rows sorted by category with a stable sort (row order kept inside a category), then the
+    ## token ranges of the sorted rows gathered without sorting the tokens themselves
+    rows = np.flatnonzero(codes >= 0)
+    rows = rows[np.argsort(codes[rows], kind = 'stable')]
+    lengths = get_lengths(tokens)[rows]
+    row_offsets = get_offsets(lengths)
+    order = np.arange(row_offsets[-1]) + np.repeat(tokens.offsets[rows] - row_offsets[:-1], lengths)
+
+    pool_lengths = np.bincount(codes[rows], weights = lengths, minlength = len(categories)).astype(np.int64)
+
+    return RaggedTokens(tokens.ids[order], get_offsets(pool_lengths), tokens.vocabulary), categories
+
+
+
+def get_list_nbytes(token_lists):
+    '''
+    Memory of a column of token lists: the list objects and every distinct string object, in bytes.
+    '''
+    nbytes, strings = 0, {}
+    for token_list in token_lists:
+        nbytes += sys.getsizeof(token_list)
+        for token in token_list:
+            strings[id(token)] = token
+
+    return nbytes + sum(sys.getsizeof(token) for token in strings.values())
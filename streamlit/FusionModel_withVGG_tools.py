@@ -5,38 +5,34 @@ import warnings
 import math
 import numpy as np
 import pandas as pd
-from scipy import sparse
-from scipy.sparse import hstack
-import cv2
 import joblib
 
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set()
-
 from datetime import date, datetime
 
-from re import S
-import nltk
-nltk.download('wordnet', quiet = True)
-from nltk.tokenize import RegexpTokenizer
-from nltk.stem import WordNetLemmatizer
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning #GuessedAtParserWarning
-from langid.langid import LanguageIdentifier, model, set_languages
+import timing_tools as tt
 
-from sklearn.preprocessing import LabelEncoder, MinMaxScaler, OneHotEncoder
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import classification_report 
+## heavy dependencies (TensorFlow, cv2, nltk, bs4, langid, spaCy, sklearn, plotting) are imported
+## inside the functions that use them, so that importing this module for serving stays fast
+
+
+
+_plotting_ready = False
+
+def import_plotting():
+    '''
+    matplotlib and seaborn, imported on first use (seaborn style is set once).
+    '''
+    global _plotting_ready
+
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    if not _plotting_ready:
+        sns.set()
+        _plotting_ready = True
+
+    return plt, sns
 
-from tensorflow.keras.utils import to_categorical
-from tensorflow.keras.layers import Input, Dense, Dropout, Flatten, BatchNormalization, Activation
-from tensorflow.keras.layers import Conv2D, MaxPooling2D, GlobalAveragePooling2D
-from tensorflow.keras.models import Model, Sequential, load_model
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, EarlyStopping, LearningRateScheduler
-from tensorflow.keras.applications.vgg16 import preprocess_input
-from tensorflow.keras.applications.vgg16 import VGG16
-    
 
 
 def date_time():
@@ -56,6 +52,7 @@ def save(datasets, types, names,  path, saving_time = None, doit = False, verbos
     Save each dataframe in dataframes with the respective name in names.
     Save at the specified path. 
     '''
+    from scipy import sparse
           
     if doit == True:
         if saving_time is None:
@@ -112,8 +109,18 @@ def save(datasets, types, names,  path, saving_time = None, doit = False, verbos
     
     
         
-def preprocess_text_data(dataframe, verbose = True):
-    
+def preprocess_text_data(dataframe, verbose = True, nb_workers = 1, chunk_size = None, lemma_table = None):
+    '''
+    nb_workers > 1 (or None for all the cores) preprocesses chunks of rows in parallel processes,
+    with the same output (see text_runtime_tools.preprocess_text_parallel).
+    lemma_table (lemma_table_tools.LemmaTable) is used and completed for the lemmatization,
+    pass the same table for every split to save it with the fitted transformers.
+    '''
+    if nb_workers != 1:
+        import text_runtime_tools as trt
+        return trt.preprocess_text_parallel(dataframe, nb_workers = nb_workers, chunk_size = chunk_size,
+                                            allow_download = True, lemma_table = lemma_table, verbose = verbose)
+
     df = dataframe.copy()
     
     # rename variable 
@@ -122,32 +129,52 @@ def preprocess_text_data(dataframe, verbose = True):
         print("Column 'designation' has been renamed as 'title' \n")
     
     
+    nb_rows = df.shape[0]
+
     # Feature engineering: title_descr
-    concatenate_variables(df, 'title', 'description', nans_to = '', separator =' \n ', \
-                          concat_col_name = 'title_descr', drop = False, verbose = verbose)
+    with tt.stage('concatenate_variables', items = nb_rows):
+        concatenate_variables(df, 'title', 'description', nans_to = '', separator =' \n ', \
+                              concat_col_name = 'title_descr', drop = False, verbose = verbose)
 
     
     # HTML parse & lower case
-    html_parsing(df, 'title_descr', verbose = verbose)
+    with tt.stage('html_parsing', items = nb_rows):
+        html_parsing(df, 'title_descr', verbose = verbose)
    
 
     # Tokenize and lemmatize
+    import nltk
+    nltk.download('wordnet', quiet = True)
+    from nltk.tokenize import RegexpTokenizer
+    import lemma_table_tools as ltt
+
     tokenizer = RegexpTokenizer(r'\w{3,}')
-    lemmatizer = WordNetLemmatizer()
+    lemmatizer = lemma_table if lemma_table is not None else ltt.LemmaTable()
 
-    get_lemmatized_tokens(df, 'title_descr', tokenizer, 'lemma_tokens', lemmatizer, uniques = True, verbose = verbose)
+    with tt.stage('tokenize_lemmatize', items = nb_rows):
+        tokens = get_lemmatized_tokens(df, 'title_descr', tokenizer, 'lemma_tokens', lemmatizer, uniques = True, to_lists = False, verbose = verbose)
     
     
     ## Get language
-    get_language(df, 'title_descr', correct = True, get_probs = False, verbose = verbose)
+    with tt.stage('get_language', items = nb_rows):
+        get_language(df, 'title_descr', correct = True, get_probs = False, verbose = verbose)
     
     
     ## Remove stop words according to language
-    remove_stop_words(df, 'lemma_tokens', 'lemma_tokens', 'language', verbose = verbose)
+    with tt.stage('remove_stop_words', items = nb_rows):
+        tokens = remove_stop_words(df, 'lemma_tokens', 'lemma_tokens', 'language', verbose = verbose,
+                                   tokens = tokens, to_lists = False)
     
     
     ## feature engineering token_length
-    get_token_length(df, 'lemma_tokens', 'text_token_len', verbose = verbose)
+    with tt.stage('get_token_length', items = nb_rows):
+        get_token_length(df, 'lemma_tokens', 'text_token_len', verbose = verbose, tokens = tokens)
+
+    ## the token ids are turned back into lists of strings once, for the TF-IDF vectorizer
+    ## (column kept at its place, before 'language')
+    with tt.stage('token_lists', items = nb_rows):
+        lemma_tokens = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
+        df.insert(df.columns.get_loc('language'), 'lemma_tokens', lemma_tokens)
     
     
     return df
@@ -189,17 +216,13 @@ def concatenate_variables(df, col1, col2, nans_to, separator, concat_col_name, d
 def html_parsing(df, col_to_parse, verbose = False):
     '''
     HTML parse and lower case text content in col_to_parse
+    (same text as BeautifulSoup(text, "lxml").get_text(), see html_tools)
     '''
-    warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-    
-    
+    import html_tools as htt
+
     t0 = time.time()
-    
-#     with warnings.catch_warnings():     ## disable warnings when BeautifulSoup encounters just plain text.
-#         warnings.simplefilter("ignore")
-#         warnings.filterwarnings('ignore', category = MarkupResemblesLocatorWarning)
-        
-    df[col_to_parse] = [BeautifulSoup(text, "lxml").get_text().lower() for text in df.loc[:,col_to_parse]]  #lxml, html.parser
+
+    df[col_to_parse] = htt.parse_html(df.loc[:,col_to_parse])
 
     t1 = time.time()
     
@@ -209,12 +232,14 @@ def html_parsing(df, col_to_parse, verbose = False):
 
 
 
-def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True):
+def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmatizer, uniques = False, verbose = True, to_lists = True):
     '''
     For each row creates a list of tokens obtained from 'col_to_tokenize' column by tokenizing the text.
     Then lemmatize each word in the list, for each row.
-    If unique = True, remove duplicated from each list of lemmas using set(). Keep the order of the words in list.
+    If unique = True, remove duplicated from each list of lemmas (on the token ids, see token_ids_tools). Keep the order of the words in list.
     Store list of lemmas in a new variable 'tokenized_col'
+    If to_lists = False, 'tokenized_col' is not set: the lemmas are only returned as token ids
+    (token_ids_tools.RaggedTokens) for the next stages.
     '''    
     
     t0 = time.time()
@@ -222,11 +247,15 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
     all_token_list = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
     all_lemmatized_list = [ [lemmatizer.lemmatize(t) for t in token_list] for token_list in all_token_list ]
 
-    if uniques :    
-        df[tokenized_col] = [sorted( set(lemma_list), key=lemma_list.index ) for lemma_list in all_lemmatized_list ]
-    else:    
+    tokens = None
+    if uniques or not to_lists:
+        import token_ids_tools as tit
+        tokens = tit.from_lists(all_lemmatized_list)
+        tokens = tit.dedupe(tokens) if uniques else tokens
+
+    if to_lists:
         #df[tokenized_col] = [tokenizer.tokenize(text) for text in df.loc[:,col_to_tokenize]]
-        df[tokenized_col] = all_lemmatized_list
+        df[tokenized_col] = all_lemmatized_list if tokens is None else tokens.to_lists()
 
     t1 = time.time()
     
@@ -234,10 +263,13 @@ def get_lemmatized_tokens(df, col_to_tokenize, tokenizer, tokenized_col, lemmati
         print(f"Column '{col_to_tokenize}' has been successfully tokenized.")
         print("\t Tokenization + Lemmatization takes %0.2f seconds \n" %(t1-t0))
 
+    return tokens
+
         
         
 
 def get_language(df, text_col, correct = False, get_probs = False, verbose = True):
+    from langid.langid import LanguageIdentifier, model
     
     ## Main language identification
     ## instantiate identifier to get probabilities
@@ -312,39 +344,48 @@ def import_stop_words(language):
 
 
     
-def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False):
+def remove_stop_words(df, col_to_clean, col_result, col_language, verbose = False, tokens = None, to_lists = True):
     '''
     Remove the stop words from each token list in df[col_to_clean] according to the detected language df['language']
     Store the cleaned token list in a new variable df[col_result]
-    If col_result result does not exist in dataframe, intialize with empty strings (object dtype)
+    The stop words of all the rows are removed at once on the token ids (see token_ids_tools)
+    tokens (RaggedTokens) is used instead of df[col_to_clean] if given, to_lists = False leaves df[col_result]
+    unset. Returns the cleaned RaggedTokens.
     '''
+    import token_ids_tools as tit
 
     t0 = time.time()
     
-    new_name = col_result 
-    if new_name not in df.columns:
-        df[new_name] = ''  # initilize col as 'object' type
-    
-    for i, token_list, language in zip(df.index, df[col_to_clean], df[col_language]):
+    ## stop words imported once per language present
+    stop_words = {str(language) : import_stop_words(language) for language in set(df[col_language])}
+    tokens = tit.from_lists(df[col_to_clean]) if tokens is None else tokens
+    tokens = tit.remove_stop_words(tokens, df[col_language], stop_words)
     
-        stop_words = import_stop_words(language)        
-        df.at[i, new_name] = [token for token in token_list if token not in stop_words]
+    if to_lists:
+        df[col_result] = pd.Series(tokens.to_lists(), index = df.index, dtype = object)
     
     t1 = time.time()
         
     if verbose:
         print("Removing stop-words takes %0.2f seconds. \n" %(t1-t0))
+
+    return tokens
     
 
     
 
-def get_token_length(df, col_with_tokens, col_with_length, verbose = False):
+def get_token_length(df, col_with_tokens, col_with_length, verbose = False, tokens = None):
     '''
     Creates a new variable measuring the number of tokens in column col_with_tokens
+    (or in tokens, RaggedTokens, if given)
     '''
     t0 = time.time()
     
-    df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    if tokens is None:
+        df[col_with_length] = [len(token_list) for token_list in df[col_with_tokens] ]
+    else:
+        import token_ids_tools as tit
+        df[col_with_length] = tit.get_lengths(tokens)
     
     t1 = time.time()
     
@@ -384,6 +425,8 @@ def transform_target(y_train, y_val, y_test):
     '''
     transform target varibale as needed for the choosen model.
     '''
+    from sklearn.preprocessing import LabelEncoder
+    from tensorflow.keras.utils import to_categorical
 
     ## Label encoder
     target_encoder = LabelEncoder()
@@ -408,6 +451,7 @@ def transform_features(X_train, X_val, X_test):
     Select features to keep.
     Transform data to Nd-array to feed into the model
     '''
+    from scipy.sparse import hstack
     
     # scale_text_token_len
     text_len_scaled_train, text_len_scaled_val, text_len_scaled_test, scaler = scale_feature(X_train, X_val, X_test, 'text_token_len')
@@ -437,6 +481,7 @@ def scale_feature(X_train, X_val, X_test, col_to_scale):
     '''
     Scale feature using the specified scaler.
     '''
+    from sklearn.preprocessing import MinMaxScaler
 
     scaler = MinMaxScaler()
 
@@ -452,6 +497,7 @@ def encode_feature(X_train, X_val, X_test, col_to_encode):
     One Hot encode categorical feature.
     Returns a matrix (sparse)
     '''
+    from sklearn.preprocessing import OneHotEncoder
 
     encoder = OneHotEncoder(handle_unknown='ignore') #ignore, infrequent_if_exist
 
@@ -468,6 +514,7 @@ def vectorize_feature(X_train, X_val, X_test, col_to_vectorize):
     vectorize text using custom tokenizer.
     retruns a sparece matrix.
     '''
+    from sklearn.feature_extraction.text import TfidfVectorizer
 
     warnings.filterwarnings('ignore', category = UserWarning)
 
@@ -515,6 +562,8 @@ def initialize_NN(Nb_features, Nb_classes):
     '''
     Initialize simple NN according to the data dimensions passed as arguments.
     '''    
+    from tensorflow.keras.layers import Dense, Dropout, Input
+    from tensorflow.keras.models import Model
     
     ## instantiate layers
     inputs = Input(shape = Nb_features, name = "input")
@@ -542,6 +591,7 @@ def initialize_NN(Nb_features, Nb_classes):
 
 
 def compile_text_model(model, lr_0):
+    from tensorflow.keras.optimizers import Adam
 
     optimizer = Adam(learning_rate = lr_0)
 
@@ -570,6 +620,7 @@ def save_model(model, name, path, fitting_time = None, doit = False):
         
 
 def reload_model(model_fullname, path, doit = False):
+    from tensorflow.keras.models import load_model
 
     if doit:
         model_filename =  path + model_fullname 
@@ -587,6 +638,7 @@ def reload_model(model_fullname, path, doit = False):
 
 
 def preprocess_image_data(df, threshold, new_pixel_nb, path, output ='array', verbose = False):
+    import cv2
     
     if ('productid' not in df.columns) or ('imageid' not in df.columns):
         print("Image data cannot be found from information on the dataframe. Try with another dataset.")
@@ -601,13 +653,16 @@ def preprocess_image_data(df, threshold, new_pixel_nb, path, output ='array', ve
         # load image
         file = path + "image_" + str(df.loc[idx,'imageid'])+"_product_" \
                                                + str(df.loc[idx,'productid'])+".jpg"
-        image = cv2.imread(file)
+        with tt.stage('image_read', items = 1):
+            image = cv2.imread(file)
         
         # crop image 
-        cropped_image = crop_image(image, threshold = threshold)
+        with tt.stage('image_crop', items = 1):
+            cropped_image = crop_image(image, threshold = threshold)
         
         # resize image (downscale)
-        resized_image = cv2.resize(cropped_image, (new_pixel_nb, new_pixel_nb))
+        with tt.stage('image_resize', items = 1):
+            resized_image = cv2.resize(cropped_image, (new_pixel_nb, new_pixel_nb))
     
         # vectorize image (3D -> 1D) and append to general array
         img_array[i,...] = resized_image.reshape(new_pixel_nb*new_pixel_nb*3)
@@ -810,6 +865,8 @@ def initialize_image_model(model_type, image_shape, Nb_classes):
 
 
 def initialize_NN_image(image_shape, Nb_classes):
+    from tensorflow.keras.layers import Dense, Dropout, Flatten, GlobalAveragePooling2D
+    from tensorflow.keras.models import Sequential
 
     head_model = Sequential()
     # ##>>> batch normalization layer ? before Dropout
@@ -829,6 +886,8 @@ def initialize_NN_image(image_shape, Nb_classes):
 
 
 def initialize_CNN(image_shape, Nb_classes):
+    from tensorflow.keras.layers import Conv2D, Dense, Dropout, Flatten, Input, MaxPooling2D
+    from tensorflow.keras.models import Model
 
     ## instantiate layers
     inputs = Input(shape = image_shape, name = "input")
@@ -902,6 +961,7 @@ def initialize_CNN(image_shape, Nb_classes):
 
 
 def compile_image_model(model, lr_0):
+    from tensorflow.keras.optimizers import Adam
 
     optimizer = Adam(learning_rate = lr_0)
 
@@ -926,6 +986,7 @@ def get_callbacks(checkpoint_path):
 
 
 def get_model_checkpoint(checkpoint_path):
+    from tensorflow.keras.callbacks import ModelCheckpoint
     
     checkpoint = ModelCheckpoint(
                                 filepath=checkpoint_path,
@@ -938,6 +999,7 @@ def get_model_checkpoint(checkpoint_path):
     
     
 def get_early_stopping():
+    from tensorflow.keras.callbacks import EarlyStopping
 
     early_stopping = EarlyStopping(monitor = 'val_loss',
                                    patience = 5,
@@ -947,6 +1009,7 @@ def get_early_stopping():
    
     
 def get_reduceLRonPlateau():
+    from tensorflow.keras.callbacks import ReduceLROnPlateau
 
     lr_plateau = ReduceLROnPlateau(monitor = 'val_loss',
                                    patience=5,
@@ -958,6 +1021,7 @@ def get_reduceLRonPlateau():
 
 
 def LR_scheduler():
+    from tensorflow.keras.callbacks import LearningRateScheduler
            
     ## Try different functions for the learning rate decay:
     
@@ -1014,6 +1078,7 @@ def get_exp_schedule(decay_rate, initial_wait):
     
 
 def plot_lr_schedule(schedules, names, lr0, epochs):
+    plt, sns = import_plotting()
     
     art = sns.color_palette()
     labels = []
@@ -1076,6 +1141,7 @@ def plot_lr_schedule(schedules, names, lr0, epochs):
 ##### Fusion model ###########################
 
 def remove_classification_head(parent_model):
+    from tensorflow.keras.models import Model
 
     x = parent_model.layers[-2].output
 
@@ -1087,6 +1153,7 @@ def remove_classification_head(parent_model):
 
 
 def get_headless_predictions_scaled(headless_model, data):
+    from sklearn.preprocessing import MinMaxScaler
     
     headless_X_train = headless_model.predict( data['X_train'] )
     headless_X_val   = headless_model.predict( data['X_val']   )
@@ -1139,6 +1206,8 @@ def initialize_fusion_model_NN(Nb_features, Nb_classes):
     '''
     Initialize simple NN according to the data dimensions passed as arguments.
     '''
+    from tensorflow.keras.layers import BatchNormalization, Dense, Dropout, Input
+    from tensorflow.keras.models import Sequential
     
     fusion_model = Sequential()
     fusion_model.add( Input(shape = Nb_features, name = "input") )
@@ -1177,6 +1246,8 @@ def initialize_fusion_model_with_params(Nb_features, Nb_classes, u1, u2, drop0,
     '''
     Initialize simple NN according to the data dimensions passed as arguments.
     '''
+    from tensorflow.keras.layers import BatchNormalization, Dense, Dropout, Input
+    from tensorflow.keras.models import Sequential
     
     fusion_model = Sequential()
     fusion_model.add( Input(shape = Nb_features, name = "input") )
@@ -1211,6 +1282,7 @@ def initialize_fusion_model_with_params(Nb_features, Nb_classes, u1, u2, drop0,
 
 
 def compile_fusion_model(model, lr_0):
+    from tensorflow.keras.optimizers import Adam
 
     optimizer = Adam(learning_rate = lr_0)
 
@@ -1230,6 +1302,7 @@ def plot_training_history(training_history, N_epochs, AccRange = None, LossRange
     '''
     simple plot of the training and validation accuracy vs epochs
     '''
+    plt, sns = import_plotting()
     
     x_epochs = np.arange(1,N_epochs + 1,1)
 
@@ -1298,6 +1371,7 @@ def get_confusionMatrix(y_test_vectors, y_pred_vectors, target_encoder, categori
 
 
 def plot_confusionMatrix(cm):
+    plt, sns = import_plotting()
 
     print(cm.shape)
     
@@ -1318,6 +1392,7 @@ def plot_confusionMatrix(cm):
 
 
 def get_classificationReport(y_test_vectors, y_pred_vectors, target_encoder, categories):
+    from sklearn.metrics import classification_report
 
     ## reverse One-hot-encoding
     y_pred_class = y_pred_vectors.argmax(axis = 1)
@@ -1344,6 +1419,7 @@ def get_classificationReport(y_test_vectors, y_pred_vectors, target_encoder, cat
 
 
 def plot_classificationReport_cl(micro_cr, classes = None, ticks = None):
+    plt, sns = import_plotting()
         
     art = sns.color_palette()
 
@@ -1373,6 +1449,7 @@ def plot_classificationReport_cl(micro_cr, classes = None, ticks = None):
     return
 
 def plot_classificationReport(micro_cr):
+    plt, sns = import_plotting()
     
     art = sns.color_palette()
 
@@ -1402,6 +1479,7 @@ def plot_classificationReport(micro_cr):
 
 
 def plot_classificationReport_extract(micro_cr, nb_classes, nb_2show):
+    plt, sns = import_plotting()
     art = sns.color_palette()
 
     fig, axs = plt.subplots(1,2,figsize = (5.833,9/nb_classes*nb_2show),gridspec_kw={'width_ratios': [3.0, 2.0]})
@@ -1541,6 +1619,7 @@ def hyperparam_optimization_fusion_model(Nb_epochs, lr_0, X_train, yy_train, X_v
 
 
 def plot_best_accuracies_vs_hyperparams(results):
+    plt, sns = import_plotting()
 
     ## unpack necessary parameters for plot
     d0_units = [ item[0] for item in results['param_trained']]
@@ -1590,6 +1669,7 @@ def plot_best_accuracies_vs_hyperparams(results):
 
 
 def plot_all_training_histories(results,Nb_epochs):
+    plt, sns = import_plotting()
     x_epochs = np.arange(1,Nb_epochs+1,1)
     training_history = results['train_histories']
 
@@ -1682,6 +1762,7 @@ def results_2_dataframe(results):
 #####################   Bar plot comparison of models ##################################################
 
 def plot_model_performance_comparison(fusion_vs_base_df):
+    plt, sns = import_plotting()
 
     art = sns.color_palette()
 
@@ -1749,6 +1830,8 @@ def show_sample(sample, text = True, image = True):
 
 
 def show_image(file):
+    import cv2
+    plt, sns = import_plotting()
 
     image = cv2.imread(file)
     print(" Image shape:", image.shape)
@@ -1762,6 +1845,8 @@ def show_image(file):
 
 
 def preprocess_sample_image(sample):
+    import cv2
+    from tensorflow.keras.applications.vgg16 import preprocess_input
     sample_image = cv2.imread(sample.image_file.values[0])
     sample_image_cropped = crop_image(sample_image, threshold = 230)
     sample_image_resized = cv2.resize(sample_image_cropped, (224,224))
@@ -1780,6 +1865,8 @@ def preprocess_sample_image(sample):
 
 
 def get_image_models_packed(headless_model_path, headless_model_name):
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.applications.vgg16 import VGG16
 
     ## get convolution layers from VGG
     headless_VGG = VGG16(weights = 'imagenet', include_top = False)
@@ -1800,6 +1887,7 @@ def get_image_models_packed(headless_model_path, headless_model_name):
 
 
 def transform_sample_text(sample_text_preprocessed, token_len_scaler, language_encoder, lemmas_vectorizer, verbose = False):
+    from scipy.sparse import hstack
         
     ## Reload text transformers
 
@@ -1848,19 +1936,73 @@ def get_sample_fusion_data(sample_text_hl_output, sample_image_hl_output, text_h
 
 
 
-def decode_predictions(sample_pred_vector, target_encoder):
-    ## reverse one hot encoding
-    sample_pred_label = sample_pred_vector.argmax(axis = 1)
+class LabelDecoder:
+    '''
+    Decode model output vectors into product type codes and class names.
+    Built once from the fitted target encoder and the product_class table, it maps
+    the model output index i to codes[i] (prdtypecode) and classes[i] (prodtype)
+    through flat arrays, so decoding a batch is plain array indexing.
+    '''
 
+    def __init__(self, target_encoder, product_class):
+        ## LabelEncoder.inverse_transform(i) is classes_[i]
+        self.codes = np.asarray(target_encoder.classes_)
 
-    ## revert label encoder, get predcited code
-    # target_encoder = joblib.load("../../fm/Splitted_datasets/Images_224px/Preprocessed_text_data/2308281220_text_target_encoder")
-    sample_pred_code = target_encoder.inverse_transform(sample_pred_label)[0]
-    
-    ## get redicted class name
-    product_class = pd.read_csv('../../datasets/product_class.csv', sep = ';')
-    product_class.drop('target', axis = 1, inplace = True)
-    sample_pred_class = product_class[product_class['prdtypecode']==sample_pred_code]['prodtype'].values
+        class_by_code = dict(zip(product_class['prdtypecode'], product_class['prodtype']))
+        self.classes = np.array([class_by_code.get(code, 'unknown') for code in self.codes], dtype = object)
+
+
+    def decode(self, pred_vectors):
+        '''
+        Top-1 codes and classes for each row of pred_vectors.
+        '''
+        labels = np.atleast_2d(pred_vectors).argmax(axis = 1)
+
+        return self.codes[labels], self.classes[labels]
+
+
+    def top_k(self, pred_vectors, k = 3):
+        '''
+        Top-k codes, classes and confidences for each row of pred_vectors, 
+        sorted by decreasing confidence. Outputs have shape (Nb_rows, k).
+        '''
+        pred_vectors = np.atleast_2d(pred_vectors)
+        k = min(k, pred_vectors.shape[1])
+
+        ## unordered top-k per row, then sort only those k columns
+        top_labels = np.argpartition(pred_vectors, -k, axis = 1)[:, -k:]
+        top_confidences = np.take_along_axis(pred_vectors, top_labels, axis = 1)
+
+        order = np.argsort(-top_confidences, axis = 1)
+        top_labels = np.take_along_axis(top_labels, order, axis = 1)
+        top_confidences = np.take_along_axis(top_confidences, order, axis = 1)
+
+        return self.codes[top_labels], self.classes[top_labels], top_confidences
+
+
+
+def get_label_decoder(target_encoder, product_class_file, sep = ';'):
+    '''
+    Build a LabelDecoder from the target encoder and the product_class csv file.
+    '''
+    product_class = pd.read_csv(product_class_file, sep = sep)
+
+    return LabelDecoder(target_encoder, product_class)
+
+
+
+def decode_predictions(sample_pred_vector, target_encoder, decoder = None):
+    '''
+    Predicted code and class name of the first row of sample_pred_vector.
+    Pass a prebuilt decoder to avoid reading the product_class table on every call.
+    '''
+    if decoder is None:
+        decoder = get_label_decoder(target_encoder, '../../datasets/product_class.csv')
+
+    pred_codes, pred_classes = decoder.decode(sample_pred_vector)
+
+    sample_pred_code = pred_codes[0]
+    sample_pred_class = pred_classes[:1]
     
     return sample_pred_code, sample_pred_class
 
@@ -0,0 +1,169 @@
+'''
+Admission control in front of the micro-batched prediction pipeline.
+
+Every request gets a deadline. Before queueing it, the controller estimates when the micro-batcher
+would return its prediction (queue depth, mean batch service time). If the queue is full or the
+deadline cannot be met, the request is degraded to a text-only prediction (headless text model +
+text-only head, no VGG16 image branch) flagged with degraded = True, or shed with RequestShed when
+no degraded path is available or it is saturated too.
+'''
+
+import time
+import queue
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+
+
+
+class RequestShed(RuntimeError):
+    '''
+    The request was rejected to protect the service (reason in .reason).
+    '''
+
+    def __init__(self, reason):
+        super().__init__("request shed: %s" %reason)
+        self.reason = reason
+
+
+
+class AdmissionController:
+    '''
+    Bounded admission of single-product requests into a MicroBatcher.
+        max_queue_size        : queued products above which new requests are not admitted
+        default_deadline      : seconds granted to a request that does not bring its own deadline
+        degraded_fn           : function(list of products) -> list of prediction dicts, run in the
+                                calling thread for requests that cannot be served in time (None: shed them)
+        max_degraded_inflight : concurrent degraded predictions, above which requests are shed
+    '''
+
+    def __init__(self, batcher, degraded_fn = None, max_queue_size = 256, default_deadline = 10.0,
+                 max_degraded_inflight = 8):
+        self.batcher = batcher
+        self.degraded_fn = degraded_fn
+        self.max_queue_size = max_queue_size
+        self.default_deadline = default_deadline
+        self.max_degraded_inflight = max_degraded_inflight
+
+        self._degraded_slots = threading.BoundedSemaphore(max_degraded_inflight)
+        self._lock = threading.Lock()
+        self.stats = {'requests' : 0, 'admitted' : 0, 'served' : 0, 'deadline_missed' : 0,
+                      'shed' : {}, 'degraded' : {}}
+
+
+    def _count(self, name, reason = None):
+        with self._lock:
+            if reason is None:
+                self.stats[name] += 1
+            else:
+                self.stats[name][reason] = self.stats[name].get(reason, 0) + 1
+
+
+    def estimate_wait(self):
+        '''
+        Expected time (seconds) before a product queued now gets its prediction.
+        '''
+        batch_time = self.batcher.get_batch_time()
+        nb_batches_ahead = self.batcher.queue_depth() // self.batcher.max_batch_size
+
+        return self.batcher.max_wait + (nb_batches_ahead + 1) * batch_time
+
+
+    def get_deadline(self, timeout = None):
+        return time.perf_counter() + (timeout if timeout is not None else self.default_deadline)
+
+
+    def _get_refusal(self, deadline):
+        '''
+        Reason not to queue one more product (None if it can be admitted).
+        '''
+        if self.batcher.queue_depth() >= self.max_queue_size:
+            return 'queue_full'
+
+        if time.perf_counter() + self.estimate_wait() > deadline:
+            return 'deadline'
+
+        return None
+
+
+    def predict_many(self, products, deadline = None):
+        '''
+        Prediction dicts of a list of products, served by the full pipeline when it can be done
+        before deadline (time.perf_counter() value), degraded otherwise. Raises RequestShed.
+        '''
+        if deadline is None:
+            deadline = self.get_deadline()
+
+        results = [None] * len(products)
+        pending, refused = [], []
+
+        for i, product in enumerate(products):
+            self._count('requests')
+
+            reason = self._get_refusal(deadline)
+            if reason is None:
+                try:
+                    pending.append((i, self.batcher.submit(product)))
+                    self._count('admitted')
+                except queue.Full:
+                    reason = 'queue_full'
+
+            if reason is not None:
+                refused.append((i, reason))
+
+        for i, future in pending:
+            try:
+                results[i] = dict(future.result(timeout = max(0.0, deadline - time.perf_counter())), degraded = False)
+                self._count('served')
+            except FutureTimeout:
+                ## the batcher skips cancelled items that are still queued
+                future.cancel()
+                self._count('deadline_missed')
+                refused.append((i, 'deadline_missed'))
+
+        if refused:
+            degraded = self._degrade([products[i] for i, _ in refused], [reason for _, reason in refused])
+            for (i, _), result in zip(refused, degraded):
+                results[i] = result
+
+        return results
+
+
+    def predict(self, product, deadline = None):
+        return self.predict_many([product], deadline = deadline)[0]
+
+
+    def _degrade(self, products, reasons):
+        if self.degraded_fn is None:
+            for reason in reasons:
+                self._count('shed', reason)
+            raise RequestShed(reasons[0])
+
+        if not self._degraded_slots.acquire(blocking = False):
+            for _ in reasons:
+                self._count('shed', 'degraded_path_busy')
+            raise RequestShed('degraded_path_busy')
+
+        try:
+            results = self.degraded_fn(products)
+        finally:
+            self._degraded_slots.release()
+
+        for reason in reasons:
+            self._count('degraded', reason)
+
+        return [dict(result, degraded = True, degraded_reason = reason, modalities = ['text'])
+                for result, reason in zip(results, reasons)]
+
+
+    def get_stats(self):
+        with self._lock:
+            stats = {key : dict(value) if isinstance(value, dict) else value for key, value in self.stats.items()}
+
+        stats['shed_total'] = sum(stats['shed'].values())
+        stats['degraded_total'] = sum(stats['degraded'].values())
+        stats['queue_depth'] = self.batcher.queue_depth()
+        stats['max_queue_size'] = self.max_queue_size
+        stats['estimated_wait'] = self.estimate_wait()
+        stats['default_deadline'] = self.default_deadline
+
+        return stats
@@ -0,0 +1,424 @@
+'''
+Micro-benchmarks of the serving path. Run from the streamlit folder, e.g.:
+    python benchmark_tools.py predict_overhead
+    python benchmark_tools.py import_time
+    python benchmark_tools.py text_preprocessing
+    python benchmark_tools.py html_parsing
+    python benchmark_tools.py text_parallel
+    python benchmark_tools.py token_ids
+'''
+
+import sys
+import json
+import time
+import subprocess
+
+import numpy as np
+
+
+
+def time_calls(function, nb_calls = 50, nb_warm_up = 3):
+    '''
+    Per-call wall time statistics (seconds) of function() over nb_calls calls, after nb_warm_up calls.
+    '''
+    for _ in range(nb_warm_up):
+        function()
+
+    times = np.empty(nb_calls)
+    for i in range(nb_calls):
+        t0 = time.perf_counter()
+        function()
+        times[i] = time.perf_counter() - t0
+
+    return {'mean' : float(times.mean()),
+            'p50' : float(np.percentile(times, 50)),
+            'p95' : float(np.percentile(times, 95)),
+            'min' : float(times.min())}
+
+
+
+def print_report(title, rows, columns):
+    '''
+    Print a list of dicts as a plain text table.
+    '''
+    print(title)
+    print(' | '.join('%14s' % c for c in columns))
+    for row in rows:
+        print(' | '.join('%14.6g' % row[c] if isinstance(row[c], float) else '%14s' % row[c] for c in columns))
+    print()
+
+
+
+def benchmark_predict_overhead(model_keys = None, batch_sizes = (1, 8, 32), nb_calls = 50, verbose = True):
+    '''
+    Per-call latency of Keras model.predict versus the compiled inference wrapper
+    (project_tools.get_compiled_model) for each serving model and batch size.
+    '''
+    import project_tools as pt
+
+    if model_keys is None:
+        model_keys = ['hl_txt_model', 'fusion', 'hl_img_model']
+
+    rows = []
+    for model_key in model_keys:
+        model = pt.get_trained_model(model_key)
+        compiled = pt.get_compiled_model(model_key)
+
+        for batch_size in batch_sizes:
+            inputs = [np.random.rand(batch_size, *spec.shape[1:]).astype(np.float32) for spec in compiled.input_signature]
+            model_inputs = inputs[0] if len(inputs) == 1 else inputs
+
+            keras_stats = time_calls(lambda: model.predict(model_inputs, verbose = 0), nb_calls = nb_calls)
+            compiled_stats = time_calls(lambda: compiled(inputs), nb_calls = nb_calls)
+
+            rows.append({'model' : model_key,
+                         'batch_size' : batch_size,
+                         'predict_ms' : keras_stats['p50'] * 1000,
+                         'compiled_ms' : compiled_stats['p50'] * 1000,
+                         'overhead_ms' : (keras_stats['p50'] - compiled_stats['p50']) * 1000,
+                         'speedup' : keras_stats['p50'] / compiled_stats['p50']})
+
+    if verbose:
+        print_report("Keras predict vs compiled inference (median per call)", rows,
+                     ['model', 'batch_size', 'predict_ms', 'compiled_ms', 'overhead_ms', 'speedup'])
+
+    return rows
+
+
+
+## cold start scenarios: statements run in a fresh interpreter
+IMPORT_SCENARIOS = {'app' : "import streamlit, pandas, numpy, project_tools",
+                    'worker' : "import service_tools",
+                    'worker_ready' : "import service_tools, project_tools as pt; pt.warm_up_transformers(); pt.warm_up_models()"}
+
+HEAVY_MODULES = ['tensorflow', 'cv2', 'matplotlib', 'seaborn', 'sklearn', 'nltk', 'bs4', 'langid', 'spacy']
+
+_IMPORT_PROBE = '''
+import sys, time, json
+t0 = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - t0
+print(json.dumps({'elapsed' : elapsed, 'loaded' : [m for m in sys.argv[2:] if m in sys.modules]}))
+'''
+
+
+def time_cold_start(statement, nb_runs = 3):
+    '''
+    Wall time of statement in fresh interpreters (median of nb_runs) and the heavy modules it loaded.
+    '''
+    times, loaded = [], []
+    for _ in range(nb_runs):
+        result = subprocess.run([sys.executable, '-c', _IMPORT_PROBE, statement] + HEAVY_MODULES,
+                                capture_output = True, text = True)
+        if result.returncode != 0:
+            return {'error' : result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'}
+
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(probe['elapsed'])
+        loaded = probe['loaded']
+
+    return {'elapsed' : float(np.median(times)), 'loaded' : loaded}
+
+
+
+def benchmark_import_time(scenarios = None, nb_runs = 3, verbose = True):
+    '''
+    Cold start of the streamlit app modules and of a bare prediction worker (service_tools),
+    and time until a worker has its models loaded ('worker_ready', needs the trained artifacts).
+    Also lists which heavy dependencies each scenario pulls in at import.
+    '''
+    if scenarios is None:
+        scenarios = list(IMPORT_SCENARIOS.keys())
+
+    rows = []
+    for scenario in scenarios:
+        stats = time_cold_start(IMPORT_SCENARIOS[scenario], nb_runs = nb_runs)
+
+        rows.append({'scenario' : scenario,
+                     'cold_start_s' : stats.get('elapsed', float('nan')),
+                     'heavy_modules' : ','.join(stats.get('loaded', [])) or '-',
+                     'error' : stats.get('error', '-')})
+
+    if verbose:
+        print_report("Cold start (median of %d fresh interpreters)" %nb_runs, rows,
+                     ['scenario', 'cold_start_s', 'heavy_modules', 'error'])
+
+    return rows
+
+
+
+def make_text_batch(nb_products, seed = 123, fr_rate = 0.8):
+    '''
+    Text dataframe (title, description) of synthetic products, see loadtest_tools.
+    '''
+    import loadtest_tools as lt
+    import project_tools as pt
+
+    rng = np.random.default_rng(seed)
+    languages = ['fr' if rng.random() < fr_rate else 'en' for _ in range(nb_products)]
+
+    return pt.wrap_text_input([lt.make_title(rng, language) for language in languages],
+                              [lt.make_description(rng, language) for language in languages])
+
+
+
+def benchmark_text_preprocessing(batch_sizes = (1, 8, 32), nb_calls = 20, verbose = True):
+    '''
+    Per-request text branch latency up to the text model input (preprocessing + TF-IDF / encoders)
+    with fm.preprocess_text_data (resources set up on every call) versus the preloaded
+    text_runtime_tools.TextPreprocessor, and whether both give the same preprocessed text.
+    '''
+    import FusionModel_withVGG_tools as fm
+    import project_tools as pt
+    import text_runtime_tools as trt
+
+    transformers = [pt.get_transformer(key) for key in ['token_len_scaler', 'language_encoder', 'lemmas_vectorizer']]
+
+    t0 = time.perf_counter()
+    runtime = trt.TextPreprocessor()
+    init_time = time.perf_counter() - t0
+
+    rows = []
+    for batch_size in batch_sizes:
+        text_df = make_text_batch(batch_size)
+
+        before = time_calls(lambda: fm.transform_sample_text(fm.preprocess_text_data(text_df, verbose = False), *transformers),
+                            nb_calls = nb_calls)
+        after = time_calls(lambda: fm.transform_sample_text(runtime.process(text_df), *transformers), nb_calls = nb_calls)
+
+        rows.append({'batch_size' : batch_size,
+                     'before_ms' : before['p50'] * 1000,
+                     'after_ms' : after['p50'] * 1000,
+                     'before_p95_ms' : before['p95'] * 1000,
+                     'after_p95_ms' : after['p95'] * 1000,
+                     'speedup' : before['p50'] / after['p50'],
+                     'same_output' : str(trt.check_parity(text_df, runtime))})
+
+    if verbose:
+        print("TextPreprocessor initialization (once per process): %0.3f s" %init_time)
+        print_report("Text branch up to the model input: preprocess_text_data vs TextPreprocessor (median of %d calls)" %nb_calls,
+                     rows, ['batch_size', 'before_ms', 'after_ms', 'before_p95_ms', 'after_p95_ms', 'speedup', 'same_output'])
+
+    return rows
+
+
+
+def benchmark_html_parsing(nb_products = 5000, verbose = True):
+    '''
+    HTML parsing of title_descr with BeautifulSoup(text, "lxml") versus html_tools, with the number
+    of rows taking each path of html_tools and the rows whose text differs.
+    '''
+    import html_tools as htt
+
+    text_df = make_text_batch(nb_products)
+    texts = list(text_df['title'].fillna('') + ' \n ' + text_df['description'].fillna(''))
+
+    report = htt.check_parity(texts, verbose = False)
+
+    rows = [{'nb_products' : nb_products,
+             'bs4_ms' : report['bs4_time'] * 1000,
+             'html_tools_ms' : report['html_tools_time'] * 1000,
+             'speedup' : report['speedup'],
+             'plain' : report['paths']['plain'],
+             'stripped' : report['paths']['stripped'],
+             'lxml' : report['paths']['lxml'],
+             'mismatches' : len(report['mismatches'])}]
+
+    if verbose:
+        print_report("HTML parsing of title_descr: BeautifulSoup vs html_tools", rows,
+                     ['nb_products', 'bs4_ms', 'html_tools_ms', 'speedup', 'plain', 'stripped', 'lxml', 'mismatches'])
+
+    return rows
+
+
+
+def get_worker_counts(max_workers = None):
+    '''
+    1, 2, 4, ... up to max_workers (all the cores by default), max_workers included.
+    '''
+    import runtime_tools as rtt
+
+    max_workers = max_workers or rtt.get_cpu_count()
+    counts = [2 ** i for i in range(max_workers.bit_length()) if 2 ** i < max_workers]
+
+    return counts + [max_workers]
+
+
+
+def benchmark_text_parallel(nb_products = 4000, worker_counts = None, chunk_size = None, verbose = True):
+    '''
+    Scaling of text_runtime_tools.preprocess_text_parallel from 1 to N processes on a synthetic
+    dataset, and whether every run gives exactly the single process output.
+    '''
+    import text_runtime_tools as trt
+
+    text_df = make_text_batch(nb_products)
+    columns = ['title_descr', 'lemma_tokens', 'language', 'text_token_len']
+
+    rows, reference = [], None
+    for nb_workers in worker_counts or get_worker_counts():
+        t0 = time.perf_counter()
+        df = trt.preprocess_text_parallel(text_df, nb_workers = nb_workers, chunk_size = chunk_size)
+        elapsed = time.perf_counter() - t0
+
+        if reference is None:
+            reference, reference_time = df, elapsed
+
+        rows.append({'nb_workers' : nb_workers,
+                     'time_s' : elapsed,
+                     'rows_per_s' : nb_products / elapsed,
+                     'speedup' : reference_time / elapsed,
+                     'efficiency' : reference_time / elapsed / nb_workers,
+                     'same_output' : str(df.index.equals(reference.index) and df[columns].equals(reference[columns]))})
+
+    if verbose:
+        print_report("preprocess_text_data scaling on %d products (worker start-up included)" %nb_products, rows,
+                     ['nb_workers', 'time_s', 'rows_per_s', 'speedup', 'efficiency', 'same_output'])
+
+    return rows
+
+
+
+def make_token_lists(nb_products, stop_words, vocabulary_size = 50000, zipf_exponent = 1.1, seed = 0):
+    '''
+    Lemma token lists of nb_products synthetic products: the number of tokens of each row is the one
+    of the make_text_batch texts, the tokens are drawn with Zipf frequencies from a vocabulary of
+    vocabulary_size words (the stop words first, as the most frequent ones). Rows share the string
+    objects of the vocabulary, as the lemma table returns them (the smallest memory for the lists).
+    '''
+    import re
+    import html_tools as htt
+
+    text_df = make_text_batch(nb_products)
+    texts = htt.parse_html(text_df['title'].fillna('') + ' \n ' + text_df['description'].fillna(''))
+    lengths = [len(re.findall(r'\w{3,}', text)) for text in texts]
+
+    rng = np.random.default_rng(seed)
+    words = sorted(set().union(*stop_words.values()))
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    known = set(words)
+    while len(words) < vocabulary_size:
+        word = ''.join(rng.choice(letters, size = rng.integers(3, 13)))
+        if word not in known:
+            known.add(word)
+            words.append(word)
+
+    frequencies = 1 / np.arange(1, len(words) + 1) ** zipf_exponent
+    draws = rng.choice(len(words), size = sum(lengths), p = frequencies / frequencies.sum()).tolist()
+    offsets = np.cumsum([0] + lengths).tolist()
+
+    return [[words[i] for i in draws[start : end]] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+
+def benchmark_token_ids(nb_products = 20000, nb_categories = 27, vocabulary_size = 50000, verbose = True):
+    '''
+    Token list stages on the list of lists form versus the int32 ids + offsets form of token_ids_tools,
+    each stage alone with its conversions from and back to lists, and the chain of preprocess_text_data
+    (dedupe, stop words, lengths) with the conversions paid once. Memory of both forms of the deduped
+    tokens (the form held between the stages), on a vocabulary of vocabulary_size words.
+    '''
+    import text_runtime_tools as trt
+    import token_ids_tools as tit
+
+    stop_words = trt.load_stop_words()
+    token_lists = make_token_lists(nb_products, stop_words, vocabulary_size = vocabulary_size)
+
+    ## same draws as make_text_batch: language of each product
+    rng = np.random.default_rng(123)
+    languages = ['fr' if rng.random() < 0.8 else 'en' for _ in range(nb_products)]
+    categories = list(np.random.default_rng(0).integers(nb_categories, size = nb_products))
+
+    def pool_lists(token_lists):
+        pools = {category : [] for category in range(nb_categories)}
+        for tokens, category in zip(token_lists, categories):
+            pools[category] += tokens
+        return [pools[category] for category in range(nb_categories)]
+
+    def chain_lists():
+        lists = [sorted(set(tokens), key = tokens.index) for tokens in token_lists]
+        lists = [[token for token in tokens if token not in stop_words.get(language, stop_words[None])]
+                 for tokens, language in zip(lists, languages)]
+        return lists, [len(tokens) for tokens in lists]
+
+    def chain_ids(tokens):
+        tokens = tit.remove_stop_words(tit.dedupe(tokens), languages, stop_words)
+        return tokens, tit.get_lengths(tokens)
+
+    def to_lists(result):
+        if isinstance(result, tuple):
+            return result[0].to_lists(), result[1].tolist()
+        return result.tolist() if isinstance(result, np.ndarray) else result.to_lists()
+
+    stages = [('dedupe',
+               lambda: [sorted(set(tokens), key = tokens.index) for tokens in token_lists],
+               lambda tokens: tit.dedupe(tokens)),
+              ('remove_stop_words',
+               lambda: [[token for token in tokens if token not in stop_words.get(language, stop_words[None])]
+                        for tokens, language in zip(token_lists, languages)],
+               lambda tokens: tit.remove_stop_words(tokens, languages, stop_words)),
+              ('get_token_length',
+               lambda: [len(tokens) for tokens in token_lists],
+               lambda tokens: tit.get_lengths(tokens)),
+              ('category_pool',
+               lambda: pool_lists(token_lists),
+               lambda tokens: tit.pool_by_category(tokens, categories, list(range(nb_categories)))[0]),
+              ('text_chain', chain_lists, chain_ids)]
+
+    rows = []
+    for name, with_lists, on_ids in stages:
+        t0 = time.perf_counter()
+        expected = with_lists()
+        t1 = time.perf_counter()
+        tokens = tit.from_lists(token_lists)
+        t2 = time.perf_counter()
+        result = on_ids(tokens)
+        t3 = time.perf_counter()
+        result = to_lists(result)
+        t4 = time.perf_counter()
+
+        rows.append({'stage' : name,
+                     'lists_ms' : (t1 - t0) * 1000,
+                     'ids_ms' : (t3 - t2) * 1000,
+                     'conversions_ms' : (t2 - t1 + t4 - t3) * 1000,
+                     'speedup' : (t1 - t0) / (t4 - t1),
+                     'same_output' : str(list(expected) == list(result))})
+
+    deduped_lists = [sorted(set(tokens), key = tokens.index) for tokens in token_lists]
+    tokens = tit.from_lists(deduped_lists)
+    memory = {'nb_tokens' : int(tokens.ids.shape[0]),
+              'vocabulary' : len(tokens.vocabulary),
+              'lists_MB' : tit.get_list_nbytes(deduped_lists) / 1e6,
+              'ids_MB' : tokens.get_nbytes() / 1e6}
+    memory['ratio'] = memory['lists_MB'] / memory['ids_MB']
+
+    if verbose:
+        print_report("Token list stages on %d products: lists vs token ids (speedup with the conversions)" %nb_products,
+                     rows, ['stage', 'lists_ms', 'ids_ms', 'conversions_ms', 'speedup', 'same_output'])
+        print_report("Memory of the deduped tokens", [memory], ['nb_tokens', 'vocabulary', 'lists_MB', 'ids_MB', 'ratio'])
+
+    return rows + [memory]
+
+
+
+BENCHMARKS = {'predict_overhead' : benchmark_predict_overhead,
+              'import_time' : benchmark_import_time,
+              'text_preprocessing' : benchmark_text_preprocessing,
+              'html_parsing' : benchmark_html_parsing,
+              'text_parallel' : benchmark_text_parallel,
+              'token_ids' : benchmark_token_ids}
+
+
+def main(args = None):
+
+    args = sys.argv[1:] if args is None else args
+    names = args if args else list(BENCHMARKS.keys())
+
+    results = {name : BENCHMARKS[name]() for name in names}
+
+    return results
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+
+def normalize_text(text):
+    '''
+    Normalized text used for hashing: missing -> '', whitespace collapsed, lower case
+    (the preprocessing lower-cases and tokenizes, so these variants give the same prediction).
+    '''
+    if text is None or text != text:    # None or NaN
+        return ''
+
+    return ' '.join(str(text).split()).lower()
+
+
+
+def get_image_bytes(image):
+    '''
+    Raw bytes of an image given as bytes, a file-like object or a file path (None if there is no image).
+    '''
+    if image is None:
+        return None
+
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+
+    if isinstance(image, str):
+        with open(image, 'rb') as file:
+            return file.read()
+
+    if hasattr(image, 'getvalue'):     # streamlit UploadedFile, BytesIO
+        return image.getvalue()
+
+    image_bytes = image.read()
+    if hasattr(image, 'seek'):
+        image.seek(0)
+
+    return image_bytes
+
+
+
+def get_product_key(title, description, image_bytes):
+    '''
+    Content hash of a product: normalized title and description plus the raw image bytes.
+    '''
+    digest = hashlib.sha256()
+    digest.update(normalize_text(title).encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(normalize_text(description).encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(image_bytes if image_bytes is not None else b'')
+
+    return digest.hexdigest()
+
+
+
+class PredictionCache:
+    '''
+    Thread-safe LRU cache with time-to-live, bounded to max_size entries.
+    Identical concurrent requests are coalesced: the first one computes the value and
+    the others wait for its result instead of running the pipeline again.
+    '''
+
+    def __init__(self, max_size = 1024, ttl = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()       # key -> (value, expiry time)
+        self._inflight = {}                 # key -> Future
+        self._lock = threading.Lock()
+        self.stats = {'hits' : 0, 'misses' : 0, 'coalesced' : 0, 'evictions' : 0, 'expirations' : 0}
+
+
+    def get_or_compute(self, key, compute, cacheable = None):
+        '''
+        Return the cached value for key, or compute() it once and cache it.
+        cacheable (optional) is a function of the computed value: values for which it returns False
+        are handed to the waiting callers but not stored (e.g. degraded predictions).
+        '''
+        return self.get_or_compute_many([key], lambda positions: [compute()], cacheable = cacheable)[0]
+
+
+    def get_or_compute_many(self, keys, compute_many, cacheable = None):
+        '''
+        Values of a list of keys: the cached ones are returned, the ones being computed by another
+        caller are waited for, and all the others are computed together by a single call
+        compute_many(positions), where positions are the indices in keys of the missing values
+        (first occurrence of each missing key). It returns their values in the same order.
+        '''
+        values = [None] * len(keys)
+        owned, waiting = {}, []             # key -> (position, future) computed here, (position, future) of others
+
+        with self._lock:
+            now = time.monotonic()
+
+            for position, key in enumerate(keys):
+                if key in owned:            # repeated key in the same call
+                    waiting.append((position, owned[key][1]))
+                    continue
+
+                entry = self._entries.get(key)
+
+                if entry is not None:
+                    value, expiry = entry
+                    if self.ttl is None or now < expiry:
+                        self._entries.move_to_end(key)
+                        self.stats['hits'] += 1
+                        values[position] = value
+                        continue
+
+                    del self._entries[key]
+                    self.stats['expirations'] += 1
+
+                future = self._inflight.get(key)
+
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    owned[key] = (position, future)
+                    self.stats['misses'] += 1
+                else:
+                    waiting.append((position, future))
+                    self.stats['coalesced'] += 1
+
+        if owned:
+            self._compute_owned(keys, owned, compute_many, cacheable, values)
+
+        for position, future in waiting:
+            values[position] = future.result()
+
+        return values
+
+
+    def _compute_owned(self, keys, owned, compute_many, cacheable, values):
+        positions = [position for position, _ in owned.values()]
+
+        try:
+            computed = compute_many(positions)
+        except Exception as error:
+            with self._lock:
+                for key in owned:
+                    del self._inflight[key]
+            for _, future in owned.values():
+                future.set_exception(error)
+            raise
+
+        with self._lock:
+            for position, value in zip(positions, computed):
+                key = keys[position]
+
+                if cacheable is None or cacheable(value):
+                    expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+                    self._entries[key] = (value, expiry)
+                    self._entries.move_to_end(key)
+
+                del self._inflight[key]
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+                self.stats['evictions'] += 1
+
+        for (_, future), position, value in zip(owned.values(), positions, computed):
+            values[position] = value
+            future.set_result(value)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+            stats['inflight'] = len(self._inflight)
+
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_rate'] = (stats['hits'] + stats['coalesced']) / lookups if lookups else 0.0
+        stats['max_size'] = self.max_size
+        stats['ttl'] = self.ttl
+
+        return stats
@@ -0,0 +1,246 @@
+'''
+Tuning of the confidence-gated cascade (project_tools.get_cascade_predictions).
+
+The text-only head and the fusion head are evaluated on the saved fusion data of the validation split
+(scaled text headless outputs followed by the scaled image headless outputs, see head_tools). For every
+threshold of the gate, the products whose text prediction scores below the threshold take the fusion
+prediction, the others keep the text one. The accuracy of the cascade is reported with its throughput,
+estimated from the measured per-product time of the text path, the image branch and the fusion head.
+The fastest threshold within max_accuracy_drop of the full fusion pipeline is saved for serving.
+Run from the streamlit folder, e.g.:
+    python cascade_tools.py 2309012059_fusion_data_X_val.npy y_val.npy --x-test 2309012059_fusion_data_X_test.npy --y-test y_test.npy --save
+'''
+
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+import project_tools as pt
+import benchmark_tools as bt
+import head_tools as ht
+
+
+
+def load_array(array):
+    return np.load(array) if isinstance(array, str) else array
+
+
+
+def get_head_pred_vectors(fusion_data, batch_size = 256):
+    '''
+    Text-only head and fusion head output vectors of fusion data (array or .npy file).
+    '''
+    fusion_data = load_array(fusion_data)
+
+    text_pred = pt.get_compiled_model('text_head').predict(ht.get_modality_data(fusion_data, 'text'), batch_size = batch_size)
+    fusion_pred = pt.get_compiled_model('fusion').predict(fusion_data, batch_size = batch_size)
+
+    return np.asarray(text_pred), np.asarray(fusion_pred)
+
+
+
+def measure_stage_times(products, batch_size = 32):
+    '''
+    Wall time per product (seconds) of the cascade stages on a list of products
+    {'title', 'description', 'image'}: 'text' (text branch + text-only head, run on every product),
+    'image' (image branch) and 'fusion' (fusion head), the last two only run on escalated products.
+    '''
+    titles = [p['title'] for p in products]
+    descriptions = [p['description'] for p in products]
+    images = [p['image'] for p in products]
+    nb_products = len(products)
+
+    def text_path():
+        text_hl_output = pt.get_text_hl_model_output_batch(pt.wrap_text_input(titles, descriptions), batch_size = batch_size)
+        pt.get_text_head_pred_vectors(text_hl_output, batch_size = batch_size)
+        return text_hl_output
+
+    ## always through the model: feature store hits would be timed instead of the image branch after warm-up
+    def image_branch():
+        return pt.compute_image_hl_model_output_batch(images, batch_size = batch_size)
+
+    ## warm-up (model loading and tracing) before timing
+    text_hl_output = text_path()
+    image_hl_output = image_branch()
+    fusion_data = pt.get_fusion_data(text_hl_output, image_hl_output)
+    fusion = lambda: pt.get_compiled_model('fusion').predict(fusion_data, batch_size = batch_size)
+    fusion()
+
+    times = {}
+    for name, function in [('text', text_path), ('image', image_branch), ('fusion', fusion)]:
+        t0 = time.perf_counter()
+        function()
+        times[name] = (time.perf_counter() - t0) / nb_products
+
+    return times
+
+
+
+def get_default_thresholds(step = 0.05):
+    '''
+    Grid of thresholds from 0 (text only) to inf (every product through the image branch).
+    '''
+    return list(np.round(np.arange(0, 1 + step / 2, step), 4)) + [np.inf]
+
+
+
+def evaluate_thresholds(text_pred, fusion_pred, y_true, stage_times, criterion = 'margin', thresholds = None):
+    '''
+    Accuracy and estimated throughput of the cascade for each threshold.
+    y_true are class indices or one-hot targets. Returns a list of rows (dicts).
+    '''
+    if thresholds is None:
+        thresholds = get_default_thresholds()
+
+    y_true = y_true.argmax(axis = 1) if y_true.ndim > 1 else y_true
+
+    text_correct = text_pred.argmax(axis = 1) == y_true
+    fusion_correct = fusion_pred.argmax(axis = 1) == y_true
+    fusion_accuracy = float(fusion_correct.mean())
+
+    scores = pt.get_cascade_scores(text_pred, criterion)
+
+    full_time = stage_times['text'] + stage_times['image'] + stage_times['fusion']
+
+    rows = []
+    for threshold in thresholds:
+        escalated = scores < threshold
+        escalated_rate = float(escalated.mean())
+        accuracy = float(np.where(escalated, fusion_correct, text_correct).mean())
+        time_per_item = stage_times['text'] + escalated_rate * (stage_times['image'] + stage_times['fusion'])
+
+        rows.append({'criterion' : criterion,
+                     'threshold' : float(threshold),
+                     'escalated_rate' : escalated_rate,
+                     'accuracy' : accuracy,
+                     'accuracy_drop' : fusion_accuracy - accuracy,
+                     'items_per_s' : 1 / time_per_item,
+                     'speedup' : full_time / time_per_item})
+
+    return rows
+
+
+
+def tune_threshold(rows, max_accuracy_drop = 0.005):
+    '''
+    Fastest row whose accuracy is within max_accuracy_drop of the full fusion pipeline.
+    '''
+    candidates = [row for row in rows if row['accuracy_drop'] <= max_accuracy_drop]
+
+    if not candidates:
+        candidates = [max(rows, key = lambda row: row['accuracy'])]
+
+    return max(candidates, key = lambda row: (row['items_per_s'], row['accuracy']))
+
+
+
+def save_cascade_config(config, path = './trained_models/', doit = False):
+    '''
+    Save the tuned gate where project_tools.get_cascade_config reads it.
+    '''
+    config_file = os.path.join(path, pt.CASCADE_CONFIG)
+
+    if doit:
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent = 2)
+        print("Cascade config saved in", config_file)
+    else:
+        print("Cascade config not saved (doit = False):", config)
+
+    return config_file
+
+
+
+def tune_cascade(X_val, y_val, X_test = None, y_test = None, criteria = ('margin', 'confidence'),
+                 max_accuracy_drop = 0.005, stage_times = None, nb_products = 64, batch_size = 32,
+                 save = False, verbose = True):
+    '''
+    Evaluate every criterion and threshold on the validation split, pick the fastest gate within
+    max_accuracy_drop of the fusion accuracy, and check it on the test split if given.
+    Stage times are measured on nb_products synthetic products if not given.
+    Returns {'stage_times', 'validation' : rows, 'config' : chosen gate, 'test' : row of the chosen gate}.
+    '''
+    for model_key in ['text_head', 'fusion']:
+        if not pt.is_model_available(model_key):
+            raise FileNotFoundError("No trained '%s' model (%s): train the text-only head with "
+                                    "head_tools.train_modality_head first" %(model_key, pt.TRAINED_MODELS[model_key]))
+
+    if stage_times is None:
+        import loadtest_tools as lt
+        lt.install_synthetic_models(verbose = verbose)
+        stage_times = measure_stage_times(lt.make_products(nb_products), batch_size = batch_size)
+
+    text_pred, fusion_pred = get_head_pred_vectors(X_val)
+    y_val = load_array(y_val)
+
+    rows = []
+    for criterion in criteria:
+        rows += evaluate_thresholds(text_pred, fusion_pred, y_val, stage_times, criterion = criterion)
+
+    best = tune_threshold(rows, max_accuracy_drop = max_accuracy_drop)
+
+    ## JSON has no infinity: a gate escalating everything is stored with a threshold above any score
+    threshold = best['threshold'] if np.isfinite(best['threshold']) else 2.0
+
+    config = {'criterion' : best['criterion'],
+              'threshold' : threshold,
+              'max_accuracy_drop' : max_accuracy_drop,
+              'validation' : dict(best, threshold = threshold),
+              'stage_times' : stage_times,
+              'tuned_on' : datetime.now().strftime("%Y-%m-%d %H:%M")}
+
+    report = {'stage_times' : stage_times, 'validation' : rows, 'config' : config, 'test' : None}
+
+    if X_test is not None:
+        text_pred, fusion_pred = get_head_pred_vectors(X_test)
+        report['test'] = evaluate_thresholds(text_pred, fusion_pred, load_array(y_test), stage_times,
+                                             criterion = best['criterion'], thresholds = [threshold])[0]
+        config['test'] = report['test']
+
+    if verbose:
+        columns = ['criterion', 'threshold', 'escalated_rate', 'accuracy', 'accuracy_drop', 'items_per_s', 'speedup']
+        print("Stage times per product (ms):", {name : round(value * 1000, 3) for name, value in stage_times.items()})
+        bt.print_report("Cascade trade-off on the validation split", rows, columns)
+        bt.print_report("Chosen gate (max accuracy drop %0.3f)" %max_accuracy_drop, [best], columns)
+        if report['test'] is not None:
+            bt.print_report("Chosen gate on the test split", [report['test']], columns)
+
+    save_cascade_config(config, doit = save)
+
+    return report
+
+
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(description = "Tune the threshold of the confidence-gated cascade")
+    parser.add_argument('x_val', help = "fusion data of the validation split (.npy)")
+    parser.add_argument('y_val', help = "one-hot targets of the validation split (.npy)")
+    parser.add_argument('--x-test', default = None)
+    parser.add_argument('--y-test', default = None)
+    parser.add_argument('--criterion', choices = ['margin', 'confidence'], action = 'append', default = None,
+                        help = "gate criterion (repeat for several, both by default)")
+    parser.add_argument('--max-accuracy-drop', type = float, default = 0.005)
+    parser.add_argument('--nb-products', type = int, default = 64, help = "synthetic products timing the stages")
+    parser.add_argument('--save', action = 'store_true', help = "save the chosen gate for serving")
+
+    return parser.parse_args(args)
+
+
+
+def main(args = None):
+
+    args = parse_args(args)
+
+    return tune_cascade(args.x_val, args.y_val, X_test = args.x_test, y_test = args.y_test,
+                        criteria = args.criterion or ('margin', 'confidence'),
+                        max_accuracy_drop = args.max_accuracy_drop, nb_products = args.nb_products,
+                        save = args.save)
+
+
+
+if __name__ == '__main__':
+    main()
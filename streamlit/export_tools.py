@@ -0,0 +1,300 @@
+'''
+Export of the serving models (headless text model, headless image pack, fusion head) to TFLite
+for CPU-only serving, with optional float16 or int8 post-training quantization.
+
+Typical use from the streamlit folder:
+    import export_tools as et
+    calibration = et.get_calibration_data(text_file, fusion_file, image_files)
+    exported = et.export_serving_models(calibration, quantizations = [None, 'float16', 'int8'], doit = True)
+    report = et.compare_runtimes(exported, calibration)
+'''
+
+import os
+import time
+import threading
+
+import numpy as np
+import pandas as pd
+
+import tensorflow as tf
+
+import project_tools as pt
+import registry_tools as rt
+import inference_tools as it
+import benchmark_tools as bt
+
+
+
+EXPORTED_MODELS = ['hl_txt_model', 'hl_img_model', 'fusion']
+
+QUANTIZATIONS = [None, 'float16', 'int8']
+
+
+
+def get_calibration_sample(file, nb_samples = 200, seed = 123):
+    '''
+    Random rows of a saved training feature matrix (.npy array or .npz sparse matrix).
+    '''
+    if file.endswith('.npz'):
+        from scipy import sparse
+        data = sparse.load_npz(file)
+    else:
+        data = np.load(file, mmap_mode = 'r')
+
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(data.shape[0], size = min(nb_samples, data.shape[0]), replace = False))
+
+    sample = data[rows]
+    if hasattr(sample, 'toarray'):
+        sample = sample.toarray()
+
+    return np.asarray(sample, dtype = np.float32)
+
+
+
+def get_calibration_data(text_file, fusion_file, image_files, nb_samples = 200, seed = 123):
+    '''
+    Calibration inputs of the three serving models, taken from the training features:
+        text_file   : transformed text features (e.g. '..._text_data_transformed_X_train.npz')
+        fusion_file : fusion head inputs (e.g. '2309012059_fusion_data_X_train.npy')
+        image_files : list of training image files
+    '''
+    rng = np.random.default_rng(seed)
+    image_sample = rng.choice(image_files, size = min(nb_samples, len(image_files)), replace = False)
+
+    calibration = {'hl_txt_model' : get_calibration_sample(text_file, nb_samples, seed),
+                   'fusion' : get_calibration_sample(fusion_file, nb_samples, seed),
+                   'hl_img_model' : pt.preprocess_sample_images(list(image_sample))}
+
+    return calibration
+
+
+
+def get_concrete_function(model, model_key):
+    '''
+    Concrete inference function of a model with a fixed input signature (free batch dim).
+    '''
+    signature = it.get_input_signature(model, pt.MODEL_INPUT_SHAPES.get(model_key))
+
+    forward = tf.function(lambda x: model(x, training = False), input_signature = signature)
+
+    return forward.get_concrete_function()
+
+
+
+def convert_to_tflite(model, model_key, quantization = None, calibration_data = None):
+    '''
+    Convert a Keras model to a TFLite flatbuffer (bytes).
+    quantization:
+        None      : float32
+        'float16' : float16 weights
+        'int8'    : int8 weights and activations, calibrated on calibration_data
+                    (float inputs / outputs are kept so the interface does not change)
+    '''
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([get_concrete_function(model, model_key)], model)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == 'int8':
+        if calibration_data is None:
+            raise ValueError("int8 quantization needs calibration data")
+
+        def representative_dataset():
+            for i in range(calibration_data.shape[0]):
+                yield [calibration_data[i : i+1].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+
+    elif quantization is not None:
+        raise ValueError("Unknown quantization '%s', choose from %s" %(quantization, QUANTIZATIONS))
+
+    return converter.convert()
+
+
+
+def get_tflite_filename(model_key, quantization):
+    '''
+    Exported file name, e.g. '2309012136_fusion_model_trained_int8.tflite'.
+    '''
+    name = pt.TRAINED_MODELS[model_key].replace('.keras', '')
+
+    return name + '_' + (quantization or 'float32') + '.tflite'
+
+
+
+def export_serving_models(calibration, quantizations = None, path = './trained_models/', doit = False, verbose = True):
+    '''
+    Convert every serving model with every quantization and save the .tflite files in path.
+    Returns {(model_key, quantization) : file}.
+    '''
+    if quantizations is None:
+        quantizations = QUANTIZATIONS
+
+    exported = {}
+    for model_key in EXPORTED_MODELS:
+        model = pt.get_trained_model(model_key)
+
+        for quantization in quantizations:
+            t0 = time.time()
+            content = convert_to_tflite(model, model_key, quantization, calibration.get(model_key))
+            file = os.path.join(path, get_tflite_filename(model_key, quantization))
+
+            if doit:
+                with open(file, 'wb') as f:
+                    f.write(content)
+                exported[(model_key, quantization)] = file
+
+            if verbose:
+                print("%s (%s): %0.1f MB converted in %0.1f seconds"
+                      %(model_key, quantization or 'float32', len(content) / 1e6, time.time() - t0))
+
+    if not doit and verbose:
+        print("TFLite models are not saved. Set doit = True to store them")
+
+    return exported
+
+
+
+class TFLitePredictor:
+    '''
+    TFLite interpreter with the same predict(inputs, batch_size) interface as CompiledPredictor.
+    The model file is memory-mapped. With use_default_delegates = False, XNNPACK does not repack
+    the weights, so float32 weights are read in place from the mapped file and the pages are shared
+    by every process that serves the same file.
+    One interpreter holds the input and output tensors of a single call: the calls of concurrent
+    threads (micro-batcher, degraded path, branch executor) are serialized by a lock.
+    '''
+
+    def __init__(self, model_file, num_threads = None, batch_size = 32, use_default_delegates = True):
+        self.model_file = model_file
+        self.batch_size = batch_size
+
+        if use_default_delegates:
+            resolver = tf.lite.experimental.OpResolverType.AUTO
+        else:
+            resolver = tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+
+        self.interpreter = tf.lite.Interpreter(model_path = model_file, num_threads = num_threads,
+                                               experimental_op_resolver_type = resolver)
+        self.interpreter.allocate_tensors()
+
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.output_shape = tuple(self.interpreter.get_output_details()[0]['shape'][1:])
+        self._batch_dim = None
+        self._lock = threading.Lock()
+
+
+    def _call(self, x):
+        x = np.ascontiguousarray(x, dtype = np.float32)
+
+        with self._lock:
+            ## resize the input tensor only when the batch size changes
+            if x.shape[0] != self._batch_dim:
+                self.interpreter.resize_tensor_input(self.input_index, x.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_dim = x.shape[0]
+
+            self.interpreter.set_tensor(self.input_index, x)
+            self.interpreter.invoke()
+
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+
+    def __call__(self, x):
+        return self._call(x)
+
+
+    def predict(self, x, batch_size = None):
+        batch_size = batch_size or self.batch_size
+
+        if x.shape[0] == 0:
+            return np.empty((0,) + self.output_shape, dtype = np.float32)
+
+        outputs = [self._call(x[start : start + batch_size]) for start in range(0, x.shape[0], batch_size)]
+
+        return np.concatenate(outputs, axis = 0)
+
+
+
+def run_pipeline(predictors, text_data, image_data):
+    '''
+    Fusion output vectors computed with the given predictors {model_key : predictor}.
+    '''
+    text_hl_output = predictors['hl_txt_model'].predict(text_data)
+    image_hl_output = predictors['hl_img_model'].predict(image_data)
+
+    fusion_data = pt.get_fusion_data(text_hl_output, image_hl_output)
+
+    return predictors['fusion'].predict(fusion_data.astype(np.float32))
+
+
+
+def check_parity(exported, text_data, image_data, quantization, verbose = True):
+    '''
+    Compare the decoded predictions of the TFLite pipeline (one quantization) with the Keras pipeline
+    on the same products. Returns top-1 code agreement, top-3 overlap and max |diff| of the probabilities.
+    '''
+    keras_predictors = {key : pt.get_compiled_model(key) for key in EXPORTED_MODELS}
+    tflite_predictors = {key : TFLitePredictor(exported[(key, quantization)]) for key in EXPORTED_MODELS}
+
+    reference = run_pipeline(keras_predictors, text_data, image_data)
+    converted = run_pipeline(tflite_predictors, text_data, image_data)
+
+    decoder = pt.get_label_decoder()
+    reference_codes = decoder.top_k(reference, k = 3)[0]
+    converted_codes = decoder.top_k(converted, k = 3)[0]
+
+    parity = {'quantization' : quantization or 'float32',
+              'top1_agreement' : float((reference_codes[:, 0] == converted_codes[:, 0]).mean()),
+              'top3_overlap' : float(np.mean([len(set(r) & set(c)) / 3 for r, c in zip(reference_codes, converted_codes)])),
+              'max_abs_diff' : float(np.abs(reference - converted).max())}
+
+    if verbose:
+        print("TFLite %(quantization)s vs Keras: top-1 agreement = %(top1_agreement)0.4f, "
+              "top-3 overlap = %(top3_overlap)0.4f, max |diff| = %(max_abs_diff)0.2e" % parity)
+
+    return parity
+
+
+
+def compare_runtimes(exported, calibration, batch_sizes = (1, 32), nb_calls = 20, verbose = True):
+    '''
+    Latency and memory of the Keras models versus every exported TFLite variant.
+    Memory is the model file size and the process RSS increase when the model is loaded
+    (0 for Keras models already warm in the registry).
+    '''
+    rows = []
+    for model_key in EXPORTED_MODELS:
+        variants = [('keras', None)] + [(quantization or 'float32', file)
+                                        for (key, quantization), file in exported.items() if key == model_key]
+
+        for variant, file in variants:
+            rss_0 = rt.get_process_rss()
+            if file is None:
+                predictor = pt.get_compiled_model(model_key)
+                size = os.path.getsize('./trained_models/' + pt.TRAINED_MODELS[model_key])
+            else:
+                predictor = TFLitePredictor(file)
+                size = os.path.getsize(file)
+            rss_1 = rt.get_process_rss()
+
+            for batch_size in batch_sizes:
+                x = calibration[model_key][:batch_size]
+                stats = bt.time_calls(lambda: predictor.predict(x, batch_size = batch_size), nb_calls = nb_calls)
+
+                rows.append({'model' : model_key,
+                             'variant' : variant,
+                             'batch_size' : x.shape[0],
+                             'latency_ms' : stats['p50'] * 1000,
+                             'file_MB' : size / 1e6,
+                             'rss_delta_MB' : (rss_1 - rss_0) / 1e6 if rss_0 is not None else float('nan')})
+
+    if verbose:
+        bt.print_report("Keras vs TFLite latency (median) and memory", rows,
+                        ['model', 'variant', 'batch_size', 'latency_ms', 'file_MB', 'rss_delta_MB'])
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,277 @@
+'''
+Persistent store of headless image model outputs (VGG16 features), memory-mapped for lookups.
+
+A product image already run through the headless image model (during training, or by an earlier
+scoring job or request) is identified by its catalog ids ('id:<imageid>_<productid>') and by the
+hash of its bytes ('sha256:<hex>'). Its features are then read from the store instead of running
+the image model again. New features are written back (appended) as they are computed.
+
+Layout of a store directory:
+    meta.json      feature width, dtype and signature of the model that produced the features
+    features.bin   float32 rows, appended, read through np.memmap
+    index.tsv      '<key>\t<row>' lines, appended after the rows they point to
+
+The files are only appended to (under an exclusive lock where fcntl is available), so several
+processes can share a store: each one picks up the rows written by the others on its next miss.
+The store stops growing at max_rows rows (later features are computed but not written back), and
+the files are fsynced every sync_rows rows or sync_interval seconds instead of on every put: rows
+written after the last sync may be lost by a power failure, the index entries pointing past the end
+of features.bin are then ignored.
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:     # Windows: single writer
+    fcntl = None
+
+
+
+def get_content_key(image_bytes):
+    return 'sha256:' + hashlib.sha256(image_bytes).hexdigest()
+
+
+
+def get_id_key(imageid, productid):
+    return 'id:%s_%s' %(imageid, productid)
+
+
+
+def get_store_directory(path, model_signature):
+    '''
+    Sub-directory of path holding the features of the model with this signature: the features of
+    a replaced model file are never served by the new one.
+    '''
+    return os.path.join(path, hashlib.sha256(model_signature.encode('utf-8')).hexdigest()[:16])
+
+
+
+class FeatureStore:
+    '''
+    Append-only, memory-mapped store of feature rows of width dim.
+        path            : store directory (created if needed)
+        dim             : feature width, None to take it from the existing store or the first put
+        model_signature : identifies the model producing the features, a store written by another
+                          model is not used (ValueError)
+        write_back      : append the features given to put (False: read-only lookups)
+        max_rows        : size bound, no more rows are written back beyond it (None: unbounded)
+        sync_rows, sync_interval : fsync the files after this many rows or seconds since the last sync
+    '''
+
+    def __init__(self, path, dim = None, model_signature = '', write_back = True, dtype = np.float32,
+                 max_rows = None, sync_rows = 256, sync_interval = 5.0):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.model_signature = model_signature
+        self.write_back = write_back
+        self.max_rows = max_rows
+        self.sync_rows = sync_rows
+        self.sync_interval = sync_interval
+
+        self.data_file = os.path.join(path, 'features.bin')
+        self.index_file = os.path.join(path, 'index.tsv')
+        self.meta_file = os.path.join(path, 'meta.json')
+
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_offset = 0
+        self._features = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.stats = {'hits' : 0, 'misses' : 0, 'writes' : 0, 'not_written' : 0, 'syncs' : 0}
+
+        os.makedirs(path, exist_ok = True)
+        self._check_meta()
+        self._refresh()
+
+
+    def _check_meta(self):
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, 'r') as f:
+                stored = json.load(f)
+            if self.dim is None:
+                self.dim = stored['dim']
+        elif self.dim is None:
+            return      # empty store, the width is set by the first put
+        else:
+            stored = None
+
+        meta = {'dim' : self.dim, 'dtype' : self.dtype.name, 'model_signature' : self.model_signature}
+
+        if stored is None:
+            with open(self.meta_file, 'w') as f:
+                json.dump(meta, f, indent = 2)
+        elif stored != meta:
+            raise ValueError("Feature store %s holds %s, not %s. Use another path or delete it."
+                             %(self.path, stored, meta))
+
+
+    def _refresh(self):
+        '''
+        Read the index lines appended since the last refresh (by this or another process)
+        and remap the feature file if it grew.
+        '''
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                f.seek(self._index_offset)
+                for line in f:
+                    if not line.endswith('\n'):
+                        break       # line being written by another process
+                    key, row = line.rstrip('\n').split('\t')
+                    self._index[key] = int(row)
+                    self._index_offset += len(line.encode('utf-8'))
+
+        if self.dim is None or not os.path.exists(self.data_file):
+            return
+
+        nb_rows = os.path.getsize(self.data_file) // (self.dim * self.dtype.itemsize)
+
+        if nb_rows > 0 and (self._features is None or self._features.shape[0] < nb_rows):
+            self._features = np.memmap(self.data_file, dtype = self.dtype, mode = 'r', shape = (nb_rows, self.dim))
+
+
+    def __len__(self):
+        return self._features.shape[0] if self._features is not None else 0
+
+
+    def _find_rows(self, key_lists):
+        ## rows past the end of features.bin: index written, rows lost before their sync
+        nb_rows = len(self)
+
+        return [next((self._index[key] for key in keys if self._index.get(key, nb_rows) < nb_rows), None)
+                for keys in key_lists]
+
+
+    def lookup(self, key_lists, count_misses = True):
+        '''
+        Features of the items described by key_lists (one list of keys per item, any key may match).
+        Returns an array (N, dim) with zeros for the unknown items and the boolean mask of the found ones.
+        count_misses = False for a first lookup whose misses are looked up again with other keys.
+        '''
+        with self._lock:
+            rows = self._find_rows(key_lists)
+
+            if any(row is None for row in rows):
+                self._refresh()
+                rows = self._find_rows(key_lists)
+
+            found = np.array([row is not None for row in rows], dtype = bool)
+            features = np.zeros((len(key_lists), self.dim or 0), dtype = self.dtype)
+            if found.any():
+                features[found] = self._features[[row for row in rows if row is not None]]
+
+            self.stats['hits'] += int(found.sum())
+            if count_misses:
+                self.stats['misses'] += int((~found).sum())
+
+        return features, found
+
+
+    def put(self, key_lists, features):
+        '''
+        Append the features (N, dim) of N items, each indexed under all of its keys.
+        '''
+        if not self.write_back or len(key_lists) == 0:
+            return
+
+        features = np.ascontiguousarray(features, dtype = self.dtype).reshape(len(key_lists), -1)
+
+        if self.max_rows is not None:
+            nb_free = max(0, self.max_rows - len(self))
+            if nb_free < len(key_lists):
+                with self._lock:
+                    self.stats['not_written'] += len(key_lists) - nb_free
+                key_lists, features = key_lists[:nb_free], features[:nb_free]
+                if nb_free == 0:
+                    return
+
+        if self.dim is None:
+            with self._lock:
+                self.dim = features.shape[1]
+                self._check_meta()
+        elif features.shape[1] != self.dim:
+            raise ValueError("Features of width %d in a store of width %d" %(features.shape[1], self.dim))
+
+        with self._lock, open(self.data_file, 'ab') as data, open(self.index_file, 'a') as index:
+            if fcntl is not None:
+                fcntl.flock(data.fileno(), fcntl.LOCK_EX)
+
+            try:
+                ## a crash while writing leaves a partial row, drop it to keep the rows aligned
+                row_size = self.dim * self.dtype.itemsize
+                size = data.seek(0, os.SEEK_END)
+                if size % row_size:
+                    os.ftruncate(data.fileno(), size - size % row_size)
+
+                first_row = size // row_size
+                data.write(features.tobytes())
+                data.flush()
+
+                ## the index is written after the rows it points to
+                index.write(''.join('%s\t%d\n' %(key, first_row + i) for i, keys in enumerate(key_lists) for key in keys))
+                index.flush()
+
+                self._unsynced += len(key_lists)
+                if self._unsynced >= self.sync_rows or time.monotonic() - self._last_sync >= self.sync_interval:
+                    self._sync_files(data, index)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(data.fileno(), fcntl.LOCK_UN)
+
+            self.stats['writes'] += len(key_lists)
+
+        with self._lock:
+            self._refresh()
+
+
+    def _sync_files(self, data, index):
+        os.fsync(data.fileno())
+        os.fsync(index.fileno())
+
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.stats['syncs'] += 1
+
+
+    def sync(self):
+        '''
+        fsync the rows written since the last sync (e.g. at the end of a scoring job).
+        '''
+        with self._lock:
+            if self._unsynced == 0 or not os.path.exists(self.data_file):
+                return
+
+            with open(self.data_file, 'ab') as data, open(self.index_file, 'a') as index:
+                self._sync_files(data, index)
+
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+
+        stats['rows'] = len(self)
+        stats['max_rows'] = self.max_rows
+        stats['keys'] = len(self._index)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+
+        return stats
+
+
+
+def import_features(store, features, imageids, productids):
+    '''
+    Index features computed offline (e.g. the headless image outputs of the training images,
+    image_hl_output_scaler.inverse_transform of the image block of the fusion data) by catalog ids.
+    '''
+    store.put([[get_id_key(imageid, productid)] for imageid, productid in zip(imageids, productids)], features)
+
+    return len(store)
@@ -0,0 +1,118 @@
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.keras.layers import Input, Layer, Concatenate
+from tensorflow.keras.models import Model
+
+import FusionModel_withVGG_tools as fm
+
+
+
+@tf.keras.utils.register_keras_serializable(package = 'rakuten')
+class MinMaxScaling(Layer):
+    '''
+    Constant affine layer reproducing a fitted sklearn MinMaxScaler:
+        outputs = inputs * scale + offset  (scaler.scale_, scaler.min_)
+    '''
+
+    def __init__(self, scale, offset, **kwargs):
+        super().__init__(trainable = False, **kwargs)
+        self.scale = np.asarray(scale, dtype = np.float32)
+        self.offset = np.asarray(offset, dtype = np.float32)
+
+
+    def call(self, inputs):
+        return inputs * tf.constant(self.scale) + tf.constant(self.offset)
+
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({'scale' : self.scale.tolist(),
+                       'offset' : self.offset.tolist()})
+        return config
+
+
+    @classmethod
+    def from_config(cls, config):
+        config.pop('trainable', None)
+        return cls(**config)
+
+
+
+def scaler_to_layer(scaler, name):
+    '''
+    Fold a fitted MinMaxScaler into a MinMaxScaling layer.
+    '''
+    return MinMaxScaling(scale = scaler.scale_, offset = scaler.min_, name = name)
+
+
+
+def build_fused_inference_model(text_hl_model, image_hl_model, fusion_model,
+                                text_hl_output_scaler, image_hl_output_scaler, image_shape = (224, 224, 3)):
+    '''
+    Rebuild the inference pipeline as one multi-input Keras graph:
+        text features  -> headless text model  -> text scaler  --\
+                                                                  concat -> fusion head -> class probabilities
+        image batch    -> headless image pack  -> image scaler --/
+    The headless output scalers are folded in as constant affine layers and the concatenation
+    is done in-graph, so a batch goes through a single model call without host round-trips.
+    '''
+    text_input = Input(shape = text_hl_model.input_shape[1:], name = 'text_input')
+    image_input = Input(shape = image_shape, name = 'image_input')
+
+    text_features = text_hl_model(text_input)
+    image_features = image_hl_model(image_input)
+
+    ## same order as get_sample_fusion_data: text first, then image
+    text_features_scaled = scaler_to_layer(text_hl_output_scaler, 'text_hl_output_scaler')(text_features)
+    image_features_scaled = scaler_to_layer(image_hl_output_scaler, 'image_hl_output_scaler')(image_features)
+
+    fusion_features = Concatenate(axis = 1, name = 'fusion_features')([text_features_scaled, image_features_scaled])
+
+    outputs = fusion_model(fusion_features)
+
+    fused_model = Model(inputs = [text_input, image_input], outputs = outputs, name = 'fused_inference_model')
+
+    return fused_model
+
+
+
+def check_fused_model_parity(fused_model, text_hl_model, image_hl_model, fusion_model,
+                             text_hl_output_scaler, image_hl_output_scaler, text_data, image_data, verbose = True):
+    '''
+    Compare the fused graph with the original step by step pipeline on the same inputs.
+    Returns the max absolute difference of the output probabilities and the top-1 agreement rate.
+    '''
+    text_hl_output = text_hl_model.predict(text_data, verbose = 0)
+    image_hl_output = image_hl_model.predict(image_data, verbose = 0)
+
+    fusion_data = fm.get_sample_fusion_data(text_hl_output, image_hl_output,
+                                            text_hl_output_scaler, image_hl_output_scaler)
+    reference = fusion_model.predict(fusion_data, verbose = 0)
+
+    fused = fused_model.predict([text_data, image_data], verbose = 0)
+
+    max_abs_diff = float(np.abs(fused - reference).max())
+    top1_agreement = float((fused.argmax(axis = 1) == reference.argmax(axis = 1)).mean())
+
+    if verbose:
+        print("Fused graph vs step by step pipeline: max |diff| = %0.2e, top-1 agreement = %0.4f"
+              %(max_abs_diff, top1_agreement))
+
+    return max_abs_diff, top1_agreement
+
+
+
+def export_fused_inference_model(text_hl_model, image_hl_model, fusion_model,
+                                 text_hl_output_scaler, image_hl_output_scaler,
+                                 path, fitting_time = None, doit = False):
+    '''
+    Build the fused inference graph and save it as '<fitting_time>_fused_inference_model.keras' in path.
+    '''
+    fused_model = build_fused_inference_model(text_hl_model, image_hl_model, fusion_model,
+                                              text_hl_output_scaler, image_hl_output_scaler)
+
+    fm.save_model(fused_model, name = 'fused_inference_model', path = path,
+                  fitting_time = fitting_time, doit = doit)
+
+    return fused_model
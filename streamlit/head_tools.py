@@ -0,0 +1,104 @@
+'''
+Single-modality classification heads trained on the scaled headless outputs saved for the fusion model.
+
+The fusion data matrices (e.g. '2309012059_fusion_data_X_train.npy') are the scaled text headless
+outputs followed by the scaled image headless outputs, so a head for one modality is trained on one
+block of columns with the same targets as the fusion head. The text-only head classifies products
+without image and serves the degraded predictions of the service when the full pipeline cannot meet
+a deadline. The image-only head classifies products without title and description
+(project_tools.get_modality_predictions).
+'''
+
+import numpy as np
+
+import FusionModel_withVGG_tools as fm
+
+
+
+## width of each headless output block in the fusion data: [text | image]
+HL_OUTPUT_WIDTHS = {'text' : 256, 'image' : 256}
+
+
+def get_modality_data(fusion_data, modality):
+    '''
+    Columns of the fusion data that belong to one modality ('text' or 'image').
+    '''
+    nb_text = HL_OUTPUT_WIDTHS['text']
+
+    if modality == 'text':
+        return fusion_data[:, :nb_text]
+    if modality == 'image':
+        return fusion_data[:, nb_text : nb_text + HL_OUTPUT_WIDTHS['image']]
+
+    raise ValueError("Unknown modality '%s', choose from %s" %(modality, list(HL_OUTPUT_WIDTHS)))
+
+
+
+def initialize_head(Nb_features, Nb_classes):
+    '''
+    Small classification head on top of one scaled headless output.
+    '''
+    from tensorflow.keras.layers import BatchNormalization, Dense, Dropout, Input
+    from tensorflow.keras.models import Sequential
+
+    head = Sequential()
+    head.add( Input(shape = (Nb_features,), name = "input") )
+    head.add( BatchNormalization() )
+    head.add( Dense(units = 256, activation = "relu", kernel_initializer = 'normal', name = "dense_1") )
+    head.add( Dropout(rate = 0.3) )
+    head.add( Dense(units = Nb_classes, activation = "softmax", kernel_initializer = 'normal', name = "dense_2") )
+
+    return head
+
+
+
+def train_head(X_train, yy_train, X_val, yy_val, epochs = 30, lr_0 = 1e-3, batch_size = 128, verbose = 1):
+    '''
+    Train a head on one-hot targets with early stopping on the validation loss.
+    Returns the trained head and its training history.
+    '''
+    head = initialize_head(X_train.shape[1], yy_train.shape[1])
+    head = fm.compile_fusion_model(head, lr_0)
+
+    history = head.fit(X_train, yy_train, validation_data = (X_val, yy_val), epochs = epochs, batch_size = batch_size,
+                       callbacks = [fm.get_early_stopping(), fm.get_reduceLRonPlateau()], verbose = verbose)
+
+    return head, history
+
+
+
+def train_modality_head(modality, fusion_data, targets, path = './trained_models/', fitting_time = None,
+                        epochs = 30, doit = False):
+    '''
+    Train and save the head of one modality.
+        fusion_data : {'X_train', 'X_val', 'X_test'} fusion head inputs (arrays or .npy files)
+        targets     : {'y_train', 'y_val', 'y_test'} one-hot targets (arrays or .npy files)
+    The model is saved as <fitting_time>_<modality>_only_head.keras. Returns the head and its test accuracy.
+    '''
+    data = {key : np.load(value) if isinstance(value, str) else value for key, value in fusion_data.items()}
+    yy = {key : np.load(value) if isinstance(value, str) else value for key, value in targets.items()}
+
+    X = {key : get_modality_data(value, modality) for key, value in data.items()}
+
+    head, _ = train_head(X['X_train'], yy['y_train'], X['X_val'], yy['y_val'], epochs = epochs)
+
+    test_accuracy = float((head.predict(X['X_test'], verbose = 0).argmax(axis = 1) == yy['y_test'].argmax(axis = 1)).mean())
+    print("%s-only head: test accuracy = %0.4f" %(modality, test_accuracy))
+
+    fm.save_model(head, modality + '_only_head', path, fitting_time = fitting_time, doit = doit)
+
+    return head, test_accuracy
+
+
+
+def train_modality_heads(fusion_data, targets, path = './trained_models/', fitting_time = None, epochs = 30, doit = False):
+    '''
+    Train and save the text-only and the image-only heads (project_tools.MODALITY_HEADS).
+    Returns {modality : test accuracy}.
+    '''
+    data = {key : np.load(value) if isinstance(value, str) else value for key, value in fusion_data.items()}
+    yy = {key : np.load(value) if isinstance(value, str) else value for key, value in targets.items()}
+
+    return {modality : train_modality_head(modality, data, yy, path = path, fitting_time = fitting_time,
+                                           epochs = epochs, doit = doit)[1]
+            for modality in HL_OUTPUT_WIDTHS}
@@ -0,0 +1,87 @@
+import numpy as np
+
+import tensorflow as tf
+
+
+
+def get_input_signature(model, input_shapes = None):
+    '''
+    Fixed input signature (batch dimension left free) of a Keras model.
+    input_shapes (list of shapes without batch dim, None to keep the model's) overrides undefined
+    dimensions, e.g. [(224, 224, 3)] for the headless VGG pack whose input is (None, None, None, 3).
+    '''
+    model_shapes = [tuple(tensor.shape[1:]) for tensor in model.inputs]
+
+    if input_shapes is None:
+        input_shapes = model_shapes
+    else:
+        input_shapes = [model_shape if shape is None else shape for shape, model_shape in zip(input_shapes, model_shapes)]
+
+    return [tf.TensorSpec(shape = (None,) + tuple(shape), dtype = tf.float32) for shape in input_shapes]
+
+
+
+class CompiledPredictor:
+    '''
+    Low-overhead inference wrapper around a Keras model.
+    The forward pass is traced once as a tf.function with a fixed input signature, and calls go
+    straight to the compiled graph. There is no data adapter, progress bar or distribution context
+    as in model.predict, which makes it suited to single samples and small batches.
+    '''
+
+    def __init__(self, model, input_shapes = None, batch_size = 256):
+        self.model = model
+        self.batch_size = batch_size
+        self.input_signature = get_input_signature(model, input_shapes)
+        self.nb_inputs = len(self.input_signature)
+
+        if self.nb_inputs == 1:
+            forward = lambda x: model(x, training = False)
+        else:
+            forward = lambda *x: model(list(x), training = False)
+
+        self._forward = tf.function(forward, input_signature = self.input_signature)
+
+
+    def _call(self, inputs):
+        tensors = [tf.convert_to_tensor(x, dtype = tf.float32) for x in inputs]
+
+        return self._forward(*tensors).numpy()
+
+
+    def __call__(self, *inputs):
+        '''
+        Run one batch (inputs as numpy arrays, one per model input) through the compiled graph.
+        '''
+        if len(inputs) == 1 and isinstance(inputs[0], (list, tuple)):
+            inputs = inputs[0]
+
+        return self._call(inputs)
+
+
+    def predict(self, inputs, batch_size = None):
+        '''
+        Same as model.predict: large inputs are split in chunks of batch_size rows.
+        '''
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+
+        batch_size = batch_size or self.batch_size
+        nb_rows = inputs[0].shape[0]
+
+        if nb_rows <= batch_size:
+            return self._call(inputs)
+
+        outputs = [self._call([x[start : start + batch_size] for x in inputs])
+                   for start in range(0, nb_rows, batch_size)]
+
+        return np.concatenate(outputs, axis = 0)
+
+
+    def warm_up(self, batch_size = 1):
+        '''
+        Trace the graph with a dummy batch so that the first real call does not pay for it.
+        '''
+        dummy = [np.zeros((batch_size,) + tuple(spec.shape[1:]), dtype = np.float32) for spec in self.input_signature]
+
+        return self._call(dummy)
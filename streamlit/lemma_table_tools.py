@@ -0,0 +1,166 @@
+'''
+Vocabulary-level lemma table: the WordNet lemma of every distinct token, computed once.
+
+get_lemmatized_tokens called WordNetLemmatizer.lemmatize for every token occurrence (millions over the
+corpus) while the number of distinct tokens is a small fraction of it. LemmaTable has the same
+lemmatize(token) method: a known token is a dict lookup, an unknown one is lemmatized by WordNet on
+first use and added to the table.
+
+At training time, fill one table while preprocessing the splits and save it next to lemmas_vectorizer
+(same joblib format as the other transformers):
+
+    import lemma_table_tools as ltt
+    lemma_table = ltt.LemmaTable()
+    df_X_train_preprocess = dpt.preprocess_text_data(df_X_train, lemma_table = lemma_table)
+    df_X_test_preprocess = dpt.preprocess_text_data(df_X_test, lemma_table = lemma_table)
+    dpt.save(datasets = [lemma_table], types = ['transformer'], names = ['lemma_table'], path = preprocessing_path, doit = True)
+
+The serving path loads it frozen (see project_tools.get_lemma_table): a token missing from a frozen
+table is lemmatized by WordNet without being stored, so user input cannot grow the shared table.
+'''
+
+import os
+import itertools
+
+
+
+class LemmaTable:
+    '''
+    Token -> lemma dict in front of the WordNet lemmatizer (created on the first unknown token).
+    A frozen table is read-only (safe to share between threads): unknown tokens are lemmatized
+    on every occurrence and not added. The lemmatizer is not pickled with the table.
+    '''
+
+    def __init__(self, lemmas = None, lemmatizer = None, frozen = False):
+        self.lemmas = dict(lemmas) if lemmas else {}
+        self.lemmatizer = lemmatizer
+        self.frozen = frozen
+        self.nb_loaded = len(self.lemmas)
+        self.nb_added = 0
+        self.nb_unknown = 0
+
+
+    def __len__(self):
+        return len(self.lemmas)
+
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['lemmatizer'] = None
+
+        return state
+
+
+    def get_lemmatizer(self):
+        if self.lemmatizer is None:
+            from nltk.stem import WordNetLemmatizer
+            self.lemmatizer = WordNetLemmatizer()
+
+        return self.lemmatizer
+
+
+    def freeze(self):
+        '''
+        Stop adding tokens (e.g. once the table is fitted on the training corpus).
+        '''
+        self.frozen = True
+
+        return self
+
+
+    def _add(self, token):
+        lemma = self.get_lemmatizer().lemmatize(token)
+
+        if self.frozen:
+            self.nb_unknown += 1
+        else:
+            self.lemmas[token] = lemma
+            self.nb_added += 1
+
+        return lemma
+
+
+    def lemmatize(self, token):
+        lemma = self.lemmas.get(token)
+
+        return lemma if lemma is not None else self._add(token)
+
+
+    def lemmatize_tokens(self, tokens):
+        '''
+        Lemmas of a list of tokens (WordNet lemmas are never empty strings).
+        '''
+        lemmas = self.lemmas
+
+        return [lemmas.get(token) or self._add(token) for token in tokens]
+
+
+    def update(self, tokens):
+        '''
+        Add the distinct tokens not in the table yet (e.g. the vocabulary of a corpus).
+        '''
+        if self.frozen:
+            raise ValueError("The lemma table is frozen")
+
+        for token in sorted(set(tokens).difference(self.lemmas)):
+            self._add(token)
+
+        return len(self)
+
+
+    def merge(self, lemmas):
+        '''
+        Add (token, lemma) pairs computed elsewhere, e.g. by the workers of a process pool.
+        '''
+        if self.frozen:
+            raise ValueError("The lemma table is frozen")
+
+        for token, lemma in lemmas:
+            if token not in self.lemmas:
+                self.lemmas[token] = lemma
+                self.nb_added += 1
+
+        return len(self)
+
+
+    def get_added_since(self, size):
+        '''
+        (token, lemma) pairs added after the table had size entries (dicts keep insertion order).
+        '''
+        return list(itertools.islice(self.lemmas.items(), size, None))
+
+
+    def get_stats(self):
+        return {'tokens' : len(self), 'loaded' : self.nb_loaded, 'added' : self.nb_added,
+                'unknown' : self.nb_unknown, 'frozen' : self.frozen}
+
+
+
+def build_lemma_table(token_lists, lemmatizer = None):
+    '''
+    Lemma table of every distinct token of token_lists (lists of tokens, e.g. tokenized title_descr).
+    '''
+    table = LemmaTable(lemmatizer = lemmatizer)
+    table.update(itertools.chain.from_iterable(token_lists))
+
+    return table
+
+
+
+def load_lemma_table(path, lemmatizer = None, frozen = False):
+    '''
+    Lemma table saved at path, or an empty table (filled lazily unless frozen) if there is no such file.
+    '''
+    if not os.path.exists(path):
+        return LemmaTable(lemmatizer = lemmatizer, frozen = frozen)
+
+    import joblib
+
+    table = joblib.load(path)
+    table.lemmatizer = lemmatizer
+    table.frozen = frozen
+    table.nb_loaded = len(table)
+    table.nb_added = 0
+    table.nb_unknown = 0
+
+    return table
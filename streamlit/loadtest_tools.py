@@ -0,0 +1,481 @@
+'''
+Offline load testing of the prediction path with synthetic Rakuten-like products.
+
+Products have French / English titles, HTML descriptions of realistic length (or none) and
+JPEG images of an object on a white background with margins of varied size. The serving models
+whose trained files are missing from trained_models are replaced by randomly initialized models
+with the production architectures, so the whole pipeline runs without the trained artifacts
+(the fitted transformers ship with the repo). Run from the streamlit folder, e.g.:
+    python loadtest_tools.py --mode single --concurrency 4 --nb-requests 200
+    python loadtest_tools.py --mode service --concurrency 16 --rate 20 --duration 30
+'''
+
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import project_tools as pt
+import registry_tools as rt
+import benchmark_tools as bt
+import head_tools as ht
+
+
+
+WORDS = {'fr' : ['lot', 'de', 'pour', 'avec', 'enfant', 'jeu', 'piscine', 'coussin', 'housse', 'livre', 'roman',
+                 'figurine', 'jouet', 'bois', 'couleur', 'noir', 'blanc', 'taille', 'haute', 'qualité', 'cadeau',
+                 'décoration', 'maison', 'jardin', 'console', 'carte', 'collection', 'édition', 'filtre', 'pompe',
+                 'épisode', 'très', 'facile', 'à', 'utiliser', 'matériau', 'résistant', 'dimensions', 'poids'],
+         'en' : ['set', 'of', 'for', 'with', 'kids', 'game', 'pool', 'cushion', 'cover', 'book', 'novel',
+                 'figure', 'toy', 'wood', 'color', 'black', 'white', 'size', 'high', 'quality', 'gift',
+                 'decoration', 'home', 'garden', 'console', 'card', 'collection', 'edition', 'filter', 'pump',
+                 'episode', 'very', 'easy', 'to', 'use', 'material', 'durable', 'dimensions', 'weight']}
+
+HTML_ENTITIES = ['&eacute;', '&egrave;', '&agrave;', '&nbsp;', '&amp;', '&ccedil;', '&ocirc;', '&#39;']
+
+
+
+def make_sentence(rng, language, nb_words):
+    words = rng.choice(WORDS[language], size = nb_words)
+    return ' '.join(words).capitalize() + '.'
+
+
+
+def make_title(rng, language):
+    return ' '.join(rng.choice(WORDS[language], size = rng.integers(4, 16))).capitalize()
+
+
+
+def make_description(rng, language, missing_rate = 0.35):
+    '''
+    HTML description of lognormal length (median ~ 500 characters, long tail up to a few thousands),
+    with paragraphs, line breaks, lists, bold text and HTML entities. None for missing descriptions.
+    '''
+    if rng.random() < missing_rate:
+        return None
+
+    target_length = int(np.clip(rng.lognormal(mean = 6.2, sigma = 0.9), 30, 8000))
+
+    parts, length = [], 0
+    while length < target_length:
+        kind = rng.integers(0, 4)
+        if kind == 0:
+            part = '<p>' + make_sentence(rng, language, rng.integers(6, 25)) + '</p>'
+        elif kind == 1:
+            part = '<ul>' + ''.join('<li>' + make_sentence(rng, language, rng.integers(2, 8)) + '</li>'
+                                    for _ in range(rng.integers(2, 6))) + '</ul>'
+        elif kind == 2:
+            part = '<b>' + make_sentence(rng, language, rng.integers(2, 6)) + '</b><br />'
+        else:
+            part = make_sentence(rng, language, rng.integers(5, 15)) + ' ' + rng.choice(HTML_ENTITIES) + ' <br>'
+
+        parts.append(part)
+        length += len(part)
+
+    return ''.join(parts)
+
+
+
+def make_image(rng, size = 500, quality = 90):
+    '''
+    JPEG (bytes) of a random coloured object on a white background, with margins of random width
+    on each side, like the Rakuten product images.
+    '''
+    import cv2
+
+    image = np.full((size, size, 3), 255, dtype = np.uint8)
+
+    left, top = rng.integers(0, size // 3, size = 2)
+    right, bottom = size - rng.integers(0, size // 3, size = 2)
+
+    color = tuple(int(c) for c in rng.integers(0, 200, size = 3))
+    if rng.random() < 0.5:
+        cv2.rectangle(image, (int(left), int(top)), (int(right), int(bottom)), color, thickness = -1)
+    else:
+        center = (int(left + right) // 2, int(top + bottom) // 2)
+        axes = (int(right - left) // 2, int(bottom - top) // 2)
+        cv2.ellipse(image, center, axes, 0, 0, 360, color, thickness = -1)
+
+    ## texture so that JPEG sizes are realistic
+    noise = rng.integers(-20, 20, size = image.shape)
+    image = np.where(image < 255, np.clip(image + noise, 0, 254), image).astype(np.uint8)
+
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+
+def make_products(nb_products, seed = 123, fr_rate = 0.8):
+    '''
+    List of synthetic products {'title', 'description', 'image' (JPEG bytes)}.
+    '''
+    rng = np.random.default_rng(seed)
+
+    products = []
+    for _ in range(nb_products):
+        language = 'fr' if rng.random() < fr_rate else 'en'
+        products.append({'title' : make_title(rng, language),
+                         'description' : make_description(rng, language),
+                         'image' : make_image(rng, size = int(rng.choice([250, 500, 500, 800])))})
+
+    return products
+
+
+
+####################################################################################################################
+
+
+
+def build_text_hl_model(nb_features):
+    '''
+    Headless text model: FusionModel_withVGG_tools.initialize_NN without its classification layer.
+    '''
+    from tensorflow.keras.layers import Dense, Dropout, Input
+    from tensorflow.keras.models import Model
+
+    inputs = Input(shape = (nb_features,), name = "input")
+    x = Dense(units = 256, activation = "relu", kernel_initializer = 'normal', name = "dense_1")(inputs)
+    outputs = Dropout(rate = 0.7, seed = 123)(x)
+
+    return Model(inputs = inputs, outputs = outputs)
+
+
+
+def build_image_hl_model():
+    '''
+    Headless image pack: VGG16 convolutions (random weights) followed by
+    FusionModel_withVGG_tools.initialize_NN_image without its classification layer.
+    '''
+    from tensorflow.keras.layers import Dense, Dropout, Flatten, GlobalAveragePooling2D
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.applications.vgg16 import VGG16
+
+    head_model = Sequential()
+    head_model.add( GlobalAveragePooling2D(input_shape = (7, 7, 512)) )
+    head_model.add( Flatten() )
+    head_model.add( Dropout(rate = 0.2) )
+    head_model.add( Dense(units = 512, activation = 'relu') )
+    head_model.add( Dropout(rate = 0.2) )
+    head_model.add( Dense(units = 256, activation = 'relu') )
+    head_model.add( Dropout(rate = 0.2) )
+
+    pack = Sequential()
+    pack.add( VGG16(weights = None, include_top = False) )
+    pack.add( head_model )
+
+    return pack
+
+
+
+def build_fusion_model(nb_features, nb_classes):
+    '''
+    Fusion head with the architecture of FusionModel_withVGG_tools.initialize_fusion_model_NN.
+    '''
+    from tensorflow.keras.layers import BatchNormalization, Dense, Dropout, Input
+    from tensorflow.keras.models import Sequential
+
+    fusion_model = Sequential()
+    fusion_model.add( Input(shape = (nb_features,), name = "input") )
+    fusion_model.add( BatchNormalization() )
+    fusion_model.add( Dense(units = 1024, activation = "relu", kernel_initializer = 'normal', name = "dense_1") )
+    fusion_model.add( BatchNormalization() )
+    fusion_model.add( Dropout(rate = 0.25) )
+    fusion_model.add( Dense(units = 1024, activation = "relu", kernel_initializer = 'normal', name = "dense_2") )
+    fusion_model.add( BatchNormalization() )
+    fusion_model.add( Dropout(rate = 0.5) )
+    fusion_model.add( Dense(units = nb_classes, activation = "softmax", kernel_initializer = 'normal', name = "dense_3") )
+
+    return fusion_model
+
+
+
+def get_text_feature_number():
+    '''
+    Width of the transformed text features: token length + one-hot language + TF-IDF vocabulary.
+    '''
+    language_encoder = pt.get_transformer('language_encoder')
+    lemmas_vectorizer = pt.get_transformer('lemmas_vectorizer')
+
+    return 1 + sum(len(c) for c in language_encoder.categories_) + len(lemmas_vectorizer.vocabulary_)
+
+
+
+def install_synthetic_models(seed = 123, force = False, verbose = True):
+    '''
+    Register randomly initialized serving models for every trained model file that is missing
+    (all of them if force = True). Returns the keys of the synthetic models.
+    '''
+    import tensorflow as tf
+    tf.keras.utils.set_random_seed(seed)
+
+    builders = {'hl_txt_model' : lambda: build_text_hl_model(get_text_feature_number()),
+                'hl_img_model' : build_image_hl_model,
+                'fusion' : lambda: build_fusion_model(2 * 256, len(pt.get_transformer('text_target_encoder').classes_)),
+                'text_head' : lambda: ht.initialize_head(ht.HL_OUTPUT_WIDTHS['text'],
+                                                         len(pt.get_transformer('text_target_encoder').classes_)),
+                'image_head' : lambda: ht.initialize_head(ht.HL_OUTPUT_WIDTHS['image'],
+                                                          len(pt.get_transformer('text_target_encoder').classes_))}
+
+    synthetic = []
+    for model_key in pt.SERVING_MODELS + list(pt.MODALITY_HEADS.values()):
+        if force or not os.path.exists('./trained_models/' + pt.TRAINED_MODELS[model_key]):
+            pt.register_trained_model(model_key, builders[model_key]())
+            synthetic.append(model_key)
+
+    if verbose and synthetic:
+        print("Randomly initialized models used for: %s" %', '.join(synthetic))
+
+    return synthetic
+
+
+
+####################################################################################################################
+
+
+
+class RSSSampler:
+    '''
+    Background thread sampling the process RSS, to report its peak during a run.
+    '''
+
+    def __init__(self, interval = 0.05):
+        self.interval = interval
+        self.peak = rt.get_process_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = rt.get_process_rss()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+
+def get_peak_rss():
+    '''
+    Peak RSS (bytes) of the process since it started (None where resource is not available).
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+
+def run_load(call, requests, concurrency = 4, rate = None, duration = None):
+    '''
+    Send requests (list of call arguments, cycled if needed) through call(request) on `concurrency` threads.
+        rate = None : closed loop, every thread sends its next request as soon as the previous one returns
+        rate = r    : open loop, r requests per second (Poisson arrivals); the latency is measured from
+                      the scheduled arrival, so it includes the time spent waiting for a free thread
+    The run stops after duration seconds if given, otherwise after len(requests) requests.
+    '''
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def send(request, scheduled):
+        try:
+            call(request)
+        except Exception as error:
+            with lock:
+                errors.append(repr(error))
+            return
+
+        with lock:
+            latencies.append(time.perf_counter() - scheduled)
+
+    deadline = (time.perf_counter() + duration) if duration is not None else None
+    nb_max = None if duration is not None else len(requests)
+    rng = np.random.default_rng(0)
+    counter = iter(range(10**12))
+
+    def next_request():
+        i = next(counter)
+        if (nb_max is not None and i >= nb_max) or (deadline is not None and time.perf_counter() >= deadline):
+            return None
+        return requests[i % len(requests)]
+
+    with RSSSampler() as sampler:
+        t0 = time.perf_counter()
+
+        if rate is None:
+            def worker():
+                while True:
+                    with lock:
+                        request = next_request()
+                    if request is None:
+                        return
+                    send(request, time.perf_counter())
+
+            threads = [threading.Thread(target = worker) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        else:
+            with ThreadPoolExecutor(max_workers = concurrency) as executor:
+                scheduled = t0
+                while True:
+                    request = next_request()
+                    if request is None:
+                        break
+                    scheduled += rng.exponential(1 / rate)
+                    time.sleep(max(0, scheduled - time.perf_counter()))
+                    executor.submit(send, request, scheduled)
+
+        elapsed = time.perf_counter() - t0
+
+    return summarize_run(latencies, errors, elapsed, sampler.peak)
+
+
+
+def summarize_run(latencies, errors, elapsed, peak_rss = None):
+
+    latencies = np.asarray(latencies)
+    peak_rss = peak_rss or get_peak_rss()
+
+    summary = {'requests' : len(latencies) + len(errors),
+               'errors' : len(errors),
+               'elapsed' : elapsed,
+               'throughput' : len(latencies) / elapsed if elapsed > 0 else 0.0,
+               'peak_rss_MB' : peak_rss / 1e6 if peak_rss is not None else float('nan')}
+
+    for name, q in [('p50', 50), ('p95', 95), ('p99', 99)]:
+        summary[name + '_ms'] = float(np.percentile(latencies, q)) * 1000 if latencies.size else float('nan')
+
+    summary['mean_ms'] = float(latencies.mean()) * 1000 if latencies.size else float('nan')
+    summary['max_ms'] = float(latencies.max()) * 1000 if latencies.size else float('nan')
+
+    if errors:
+        summary['first_error'] = errors[0]
+
+    return summary
+
+
+
+def get_entry_point(mode, batch_size = 32, **server_kwargs):
+    '''
+    (call, close) for a serving entry point:
+        'single'  : project_tools.get_predictions, one product per request
+        'cached'  : project_tools.get_cached_predictions
+        'batch'   : project_tools.get_batch_predictions, batch_size products per request
+        'service' : HTTP service (micro-batching) started in this process, one product per request
+    '''
+    if mode == 'single':
+        return (lambda p: pt.get_predictions(p['title'], p['description'], p['image'])), None
+
+    if mode == 'cached':
+        return (lambda p: pt.get_cached_predictions(p['title'], p['description'], p['image'])), None
+
+    if mode == 'batch':
+        return (lambda ps: pt.get_batch_predictions([p['title'] for p in ps], [p['description'] for p in ps],
+                                                    [p['image'] for p in ps], batch_size = batch_size)), None
+
+    if mode == 'service':
+        import service_tools as svc
+
+        server_kwargs.setdefault('cache_size', 0)
+        server, url = svc.start_server_in_thread(port = 0, **server_kwargs)
+        client = svc.PredictionClient(url)
+
+        return (lambda p: client.predict(p['title'], p['description'] or '', p['image'])), server.shutdown
+
+    raise ValueError("Unknown mode '%s'" %mode)
+
+
+
+def run_load_test(mode = 'single', nb_products = 200, concurrency = 4, rate = None, duration = None,
+                  nb_requests = None, batch_size = 32, seed = 123, verbose = True):
+    '''
+    Build synthetic products, install synthetic models where needed, warm up, then drive the entry point.
+    Returns the run summary (latency percentiles, throughput, peak RSS, ...).
+    '''
+    products = make_products(nb_products, seed = seed)
+
+    ## the synthetic images must neither be served from nor written to the feature store
+    pt.configure_feature_store(enabled = False)
+
+    synthetic = install_synthetic_models(seed = seed, verbose = verbose)
+    pt.warm_up_transformers()
+    pt.warm_up_models()
+
+    call, close = get_entry_point(mode, batch_size = batch_size)
+
+    if mode == 'batch':
+        requests = [products[i : i + batch_size] for i in range(0, len(products), batch_size)]
+    else:
+        requests = products
+
+    if nb_requests is not None and duration is None:
+        requests = [requests[i % len(requests)] for i in range(nb_requests)]
+
+    ## warm-up request (graph tracing, lazy imports)
+    call(requests[0])
+
+    try:
+        summary = run_load(call, requests, concurrency = concurrency, rate = rate, duration = duration)
+    finally:
+        if close is not None:
+            close()
+
+    summary.update({'mode' : mode, 'concurrency' : concurrency, 'rate' : rate or 'closed',
+                    'synthetic_models' : ','.join(synthetic) or '-'})
+    if mode == 'batch':
+        summary['items_per_s'] = summary['throughput'] * batch_size
+
+    if verbose:
+        bt.print_report("Load test", [summary],
+                        ['mode', 'concurrency', 'rate', 'requests', 'errors', 'throughput',
+                         'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_MB'])
+
+    return summary
+
+
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(description = "Offline load test of the prediction path")
+    parser.add_argument('--mode', default = 'single', choices = ['single', 'cached', 'batch', 'service'])
+    parser.add_argument('--concurrency', type = int, default = 4)
+    parser.add_argument('--rate', type = float, default = None, help = "requests per second (open loop)")
+    parser.add_argument('--duration', type = float, default = None, help = "seconds")
+    parser.add_argument('--nb-requests', type = int, default = None)
+    parser.add_argument('--nb-products', type = int, default = 200)
+    parser.add_argument('--batch-size', type = int, default = 32)
+    parser.add_argument('--seed', type = int, default = 123)
+
+    return parser.parse_args(args)
+
+
+
+def main(args = None):
+
+    args = parse_args(args)
+
+    return run_load_test(mode = args.mode, nb_products = args.nb_products, concurrency = args.concurrency,
+                         rate = args.rate, duration = args.duration, nb_requests = args.nb_requests,
+                         batch_size = args.batch_size, seed = args.seed)
+
+
+
+if __name__ == '__main__':
+    main()
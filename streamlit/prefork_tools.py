@@ -0,0 +1,377 @@
+'''
+Pre-fork multi-process prediction server sharing the serving resources between workers.
+
+The parent process loads the fitted transformers (TF-IDF vocabulary, encoders, scalers), the label
+decoder and the text preprocessing resources (wordnet, langid model) once, freezes them out of the
+garbage collector and forks the workers, which share these pages copy-on-write.
+The TensorFlow runtime is not fork-safe, so model weights are not loaded before the fork: every
+worker maps the exported TFLite files (see export_tools) read-only, and all workers share the same
+page-cache pages of the weights. Without exported TFLite files, each worker loads its own Keras models.
+
+The parent runs a load balancer that forwards every request to the worker with the fewest requests
+in flight, and reports per-worker RSS, USS (memory unique to the worker) and PSS on /stats.
+Run from the streamlit folder:
+    python prefork_tools.py --workers 4 --port 8000
+
+Endpoints: same as service_tools (POST /predict, GET /health, GET /stats).
+'''
+
+import os
+import gc
+import json
+import time
+import signal
+import argparse
+import threading
+import urllib.error
+import urllib.request
+import multiprocessing as mp
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import project_tools as pt
+import registry_tools as rt
+import runtime_tools as rtt
+
+
+
+
+def preload_shared_resources(verbose = True):
+    '''
+    Load, in the parent, every serving resource that can be shared copy-on-write with forked workers
+    (pure python / numpy objects, no TensorFlow runtime).
+    '''
+    t0 = time.perf_counter()
+
+    pt.warm_up_transformers()
+    pt.get_label_decoder()
+
+    ## loads nltk wordnet and the langid model
+    pt.get_text_features_batch(pt.wrap_text_input('Lot de 2 coussins', '<p>Housse de coussin en coton</p>'))
+
+    ## objects created so far are never collected: the collector does not touch (and copy) their pages
+    gc.freeze()
+
+    if verbose:
+        print("Shared resources loaded in %0.2f seconds, parent RSS = %s MB"
+              %(time.perf_counter() - t0, format_mb(rt.get_process_rss())))
+
+
+
+def get_tflite_files(quantization = None):
+    '''
+    Exported TFLite file of each serving model, or None if one of them is missing.
+    Same names as export_tools.get_tflite_filename, which is not imported here: it would load
+    TensorFlow in the parent before the fork.
+    '''
+    names = {key : pt.TRAINED_MODELS[key].replace('.keras', '') + '_' + (quantization or 'float32') + '.tflite'
+             for key in pt.SERVING_MODELS}
+    files = {key : './trained_models/' + name for key, name in names.items()}
+
+    return files if all(os.path.exists(file) for file in files.values()) else None
+
+
+
+def install_worker_models(tflite_files, num_threads):
+    '''
+    In a worker: serve the models from the memory-mapped TFLite files (shared between workers),
+    or load the Keras models if no TFLite file is given (one copy per worker).
+    '''
+    if tflite_files is None:
+        pt.warm_up_models()
+        return 'keras'
+
+    import export_tools as et
+
+    for model_key, file in tflite_files.items():
+        pt.register_compiled_model(model_key, et.TFLitePredictor(file, num_threads = num_threads,
+                                                                 use_default_delegates = False))
+
+    return 'tflite'
+
+
+
+def run_worker(index, connection, tflite_files, nb_workers, server_kwargs):
+    '''
+    Worker process: configure its thread pools, install the models, start a service_tools server
+    on a free local port and send the port back to the parent.
+    '''
+    import service_tools as svc
+
+    ## the parent handles Ctrl-C and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    profile = rtt.get_thread_profile(nb_workers)
+    rtt.configure_threads(**profile)
+
+    backend = install_worker_models(tflite_files, num_threads = profile['intra_op'])
+
+    server = svc.create_server('127.0.0.1', 0, **server_kwargs)
+
+    def stop(*args):
+        threading.Thread(target = server.shutdown, daemon = True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+
+    connection.send({'port' : server.server_address[1], 'backend' : backend})
+    connection.close()
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.batcher.stop()
+
+
+
+class WorkerPool:
+    '''
+    Forked prediction workers behind a least-outstanding-requests balancer.
+    '''
+
+    def __init__(self, nb_workers, tflite_files = None, server_kwargs = None, start_timeout = 600):
+        self.nb_workers = nb_workers
+        self.workers = []
+        self._lock = threading.Lock()
+
+        context = mp.get_context('fork')
+
+        for index in range(nb_workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target = run_worker, name = 'prediction-worker-%d' %index,
+                                      args = (index, child_connection, tflite_files, nb_workers, server_kwargs or {}))
+            process.start()
+            child_connection.close()
+
+            self.workers.append({'index' : index, 'process' : process, 'connection' : parent_connection,
+                                 'inflight' : 0, 'requests' : 0, 'errors' : 0})
+
+        for worker in self.workers:
+            if not worker['connection'].poll(start_timeout):
+                self.stop()
+                raise RuntimeError("worker %d did not start within %d seconds" %(worker['index'], start_timeout))
+
+            info = worker['connection'].recv()
+            worker['url'] = 'http://127.0.0.1:%d' %info['port']
+            worker['backend'] = info['backend']
+
+
+    def _acquire(self):
+        with self._lock:
+            alive = [worker for worker in self.workers if worker['process'].is_alive()]
+            if not alive:
+                raise RuntimeError("no prediction worker alive")
+
+            worker = min(alive, key = lambda w: (w['inflight'], w['requests']))
+            worker['inflight'] += 1
+            worker['requests'] += 1
+
+        return worker
+
+
+    def _release(self, worker, error = False):
+        with self._lock:
+            worker['inflight'] -= 1
+            if error:
+                worker['errors'] += 1
+
+
+    def forward(self, path, body = None, timeout = 60):
+        '''
+        Send a request to the least busy worker. Returns (status, response body bytes).
+        '''
+        worker = self._acquire()
+        request = urllib.request.Request(worker['url'] + path, data = body,
+                                         headers = {'Content-Type' : 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout = timeout) as response:
+                status, content = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, content = error.code, error.read()
+        except Exception as error:
+            status, content = 502, json.dumps({'error' : 'worker %d: %s' %(worker['index'], error)}).encode('utf-8')
+
+        self._release(worker, error = status >= 500)
+
+        return status, content
+
+
+    def get_worker_stats(self, worker, timeout = 5):
+        try:
+            with urllib.request.urlopen(worker['url'] + '/stats', timeout = timeout) as response:
+                return json.loads(response.read())
+        except Exception:
+            return None
+
+
+    def get_memory_report(self):
+        '''
+        RSS, USS and PSS of the parent and of every worker. If the sharing holds, each worker's USS
+        stays small compared to its RSS, and the sum of the PSS is far below the sum of the RSS.
+        '''
+        rows = []
+        for worker in [None] + self.workers:
+            pid = os.getpid() if worker is None else worker['process'].pid
+            alive = worker is None or worker['process'].is_alive()
+            memory = rt.get_process_memory(pid) if alive else None
+
+            rows.append({'process' : 'parent' if worker is None else 'worker_%d' %worker['index'],
+                         'pid' : pid,
+                         'alive' : alive,
+                         'rss_MB' : memory['rss'] / 1e6 if memory else None,
+                         'uss_MB' : memory['uss'] / 1e6 if memory else None,
+                         'pss_MB' : memory['pss'] / 1e6 if (memory and memory['pss'] is not None) else None})
+
+        totals = {key : sum(row[key] for row in rows if row[key] is not None) for key in ['rss_MB', 'uss_MB', 'pss_MB']}
+        totals['shared_MB'] = totals['rss_MB'] - totals['uss_MB']
+
+        return {'processes' : rows, 'totals' : totals}
+
+
+    def get_stats(self):
+        with self._lock:
+            workers = [{key : worker[key] for key in ['index', 'url', 'backend', 'inflight', 'requests', 'errors']}
+                       for worker in self.workers]
+
+        for worker, state in zip(workers, self.workers):
+            worker['pid'] = state['process'].pid
+            worker['alive'] = state['process'].is_alive()
+            worker['service'] = self.get_worker_stats(state) if worker['alive'] else None
+
+        return {'workers' : workers, 'memory' : self.get_memory_report()}
+
+
+    def stop(self, timeout = 10):
+        for worker in self.workers:
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+        for worker in self.workers:
+            worker['process'].join(timeout)
+
+
+
+def make_balancer_handler(pool, request_timeout = 60):
+
+    class BalancerHandler(BaseHTTPRequestHandler):
+
+        def _send(self, status, content):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+
+        def _send_json(self, status, body):
+            self._send(status, json.dumps(body).encode('utf-8'))
+
+
+        def do_GET(self):
+            if self.path == '/health':
+                alive = sum(worker['process'].is_alive() for worker in pool.workers)
+                self._send_json(200 if alive else 503, {'status' : 'ok' if alive else 'down',
+                                                        'workers' : pool.nb_workers, 'alive' : alive})
+            elif self.path == '/stats':
+                self._send_json(200, pool.get_stats())
+            else:
+                self._send_json(404, {'error' : 'unknown endpoint'})
+
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error' : 'unknown endpoint'})
+                return
+
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                status, content = pool.forward(self.path, self.rfile.read(length), timeout = request_timeout)
+            except RuntimeError as error:
+                self._send_json(503, {'error' : str(error)})
+                return
+
+            self._send(status, content)
+
+
+        def log_message(self, format, *args):
+            return
+
+    return BalancerHandler
+
+
+
+def create_prefork_server(host = '127.0.0.1', port = 8000, nb_workers = 2, quantization = None,
+                          request_timeout = 60, verbose = True, **server_kwargs):
+    '''
+    Preload the shared resources, fork nb_workers workers and build the balancer server
+    (not started). server_kwargs go to service_tools.create_server in every worker.
+    Stop the workers with server.pool.stop().
+    '''
+    preload_shared_resources(verbose = verbose)
+
+    tflite_files = get_tflite_files(quantization)
+    if tflite_files is None and verbose:
+        print("No exported TFLite models (export_tools.export_serving_models): "
+              "every worker loads its own copy of the Keras models")
+
+    pool = WorkerPool(nb_workers, tflite_files = tflite_files, server_kwargs = server_kwargs)
+
+    server = ThreadingHTTPServer((host, port), make_balancer_handler(pool, request_timeout))
+    server.daemon_threads = True
+    server.pool = pool
+
+    return server
+
+
+
+def format_mb(size):
+    return '%0.1f' %(size / 1e6) if size is not None else 'n/a'
+
+
+
+def print_memory_report(report):
+    print("%-10s %8s %10s %10s %10s" %('process', 'pid', 'RSS MB', 'USS MB', 'PSS MB'))
+    for row in report['processes']:
+        values = ['%0.1f' %row[key] if row[key] is not None else 'n/a' for key in ['rss_MB', 'uss_MB', 'pss_MB']]
+        print("%-10s %8d %10s %10s %10s" %(row['process'], row['pid'], *values))
+    print("Total RSS = %(rss_MB)0.1f MB, total USS = %(uss_MB)0.1f MB, total PSS = %(pss_MB)0.1f MB" %report['totals'])
+
+
+
+def parse_args(args = None):
+
+    parser = argparse.ArgumentParser(description = 'Pre-fork multi-process fusion model prediction server.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--workers', type = int, default = max(1, rtt.get_cpu_count() // 2))
+    parser.add_argument('--quantization', default = None, choices = ['float16', 'int8'],
+                        help = 'exported TFLite variant to serve (default float32)')
+    parser.add_argument('--max-batch-size', type = int, default = 32)
+    parser.add_argument('--max-wait-ms', type = float, default = 10.0)
+    parser.add_argument('--cache-size', type = int, default = 4096, help = 'max cached predictions per worker, 0 to disable')
+
+    return parser.parse_args(args)
+
+
+
+def main(args = None):
+
+    args = parse_args(args)
+
+    server = create_prefork_server(args.host, args.port, nb_workers = args.workers, quantization = args.quantization,
+                                   max_batch_size = args.max_batch_size, max_wait = args.max_wait_ms / 1000,
+                                   cache_size = args.cache_size)
+
+    print("Serving predictions with %d workers on http://%s:%d" %((args.workers,) + server.server_address[:2]))
+    print_memory_report(server.pool.get_memory_report())
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.stop()
+
+
+
+if __name__ == '__main__':
+    main()
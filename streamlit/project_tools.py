@@ -1,17 +1,20 @@
-import streamlit as st
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set() 
-
-import cv2
 import joblib
 
 import FusionModel_withVGG_tools as fm
-from tensorflow.keras.models import load_model
-from tensorflow.keras.applications.vgg16 import preprocess_input
+import registry_tools as rt
+import cache_tools as ct
+import timing_tools as tt
+import feature_store_tools as fst
+
+## TensorFlow and cv2 are imported on first use (model loading, image decoding), so that importing
+## this module (streamlit reruns, fresh serving workers) does not pay for them
 
 
 
@@ -115,78 +118,576 @@ def demo_instructions():
 
 
 
-def get_predictions(sample_title, sample_description, sample_image):
-    sample_pred_code, sample_pred_class = 'unknown', 'unknown' 
+## the text and image branches are independent until the fusion step: run them concurrently
+## (TF predict, opencv decoding and resizing release the GIL)
+_branch_executor = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = 'image_branch')
 
-    sample_image_hl_output = get_image_hl_model_output(sample_image)
 
-    sample_text_hl_output = get_text_hl_model_output(sample_title, sample_description)
+def run_timed(function, *args, **kwargs):
+    '''
+    Call function and return (output, wall time in seconds).
+    '''
+    t0 = time.perf_counter()
+    output = function(*args, **kwargs)
 
-    ## past argument in the right order to concatenate text + img
-    sample_fusion_data = get_fusion_data(sample_text_hl_output, sample_image_hl_output)
+    return output, time.perf_counter() - t0
 
-    fusion_model = get_trained_model('fusion')
 
-    ## run headless model
-    sample_pred_vector = fusion_model.predict(sample_fusion_data)
+
+def get_predictions(sample_title, sample_description, sample_image, return_timings = False):
+    '''
+    Top 3 codes, classes and confidences for a single product.
+    The image branch runs on a worker thread while the text branch runs in the calling thread,
+    so the latency is about max(text, image) + fusion.
+    If return_timings = True, also return a dict with per-branch wall times (seconds).
+    For a stage-level breakdown, call it inside timing_tools.collect_timings().
+    A product without image (or without text) is classified by the single-modality head.
+    '''
+    modality = get_product_modality(sample_title, sample_description, sample_image)
+    if modality != 'text+image':
+        return get_single_modality_predictions(modality, sample_title, sample_description, sample_image,
+                                               return_timings = return_timings)
+
+    t0 = time.perf_counter()
+
+    image_future = _branch_executor.submit(tt.run_in_context(run_timed), get_image_hl_model_output, sample_image)
+
+    with tt.stage('text_branch', items = 1):
+        sample_text_hl_output, text_time = run_timed(get_text_hl_model_output, sample_title, sample_description)
+
+    sample_image_hl_output, image_time = image_future.result()
+
+    t1 = time.perf_counter()
+
+    with tt.stage('fusion', items = 1):
+        ## past argument in the right order to concatenate text + img
+        sample_fusion_data = get_fusion_data(sample_text_hl_output, sample_image_hl_output)
+
+        fusion_model = get_compiled_model('fusion')
+
+        ## run headless model
+        sample_pred_vector = fusion_model.predict(sample_fusion_data)
 
     ## translate model prediction into a meaningfull output
+    with tt.stage('decode_predictions', items = 1):
+        sample_pred_code, sample_pred_class, pred_confidences = get_decoded_predictions_with_confidence(sample_pred_vector, num = 3)
+
+    t2 = time.perf_counter()
+
+    if return_timings:
+        timings = {'text_branch' : text_time,
+                   'image_branch' : image_time,
+                   'branches' : t1 - t0,
+                   'fusion' : t2 - t1,
+                   'total' : t2 - t0}
+        return sample_pred_code, sample_pred_class, pred_confidences, timings
 
-    # sample_pred_code, sample_pred_class = get_decoded_predictions(sample_pred_vector)
-    sample_pred_code, sample_pred_class, pred_confidences = get_decoded_predictions_with_confidence(sample_pred_vector, num = 3)
     return sample_pred_code, sample_pred_class, pred_confidences
 
  
 
+
+def get_single_modality_predictions(modality, sample_title, sample_description, sample_image, return_timings = False):
+    '''
+    get_predictions of a product with a single modality ('text' or 'image'): the branch of the
+    missing modality never runs (no VGG16 for products without image).
+    '''
+    if modality == 'none':
+        raise ValueError("The product has neither text nor image")
+
+    t0 = time.perf_counter()
+
+    if modality == 'text':
+        with tt.stage('text_branch', items = 1):
+            sample_hl_output = get_text_hl_model_output(sample_title, sample_description)
+    else:
+        with tt.stage('image_branch', items = 1):
+            sample_hl_output = get_image_hl_model_output(sample_image)
+
+    t1 = time.perf_counter()
+
+    sample_pred_vector = get_head_pred_vectors(modality, sample_hl_output, batch_size = 1)
+
+    with tt.stage('decode_predictions', items = 1):
+        sample_pred_code, sample_pred_class, pred_confidences = get_decoded_predictions_with_confidence(sample_pred_vector, num = 3)
+
+    t2 = time.perf_counter()
+
+    if return_timings:
+        ## the single-modality head replaces the fusion head: timed under its own name
+        timings = {'text_branch' : t1 - t0 if modality == 'text' else 0.0,
+                   'image_branch' : t1 - t0 if modality == 'image' else 0.0,
+                   'branches' : t1 - t0,
+                   'fusion' : 0.0,
+                   MODALITY_HEADS[modality] : t2 - t1,
+                   'total' : t2 - t0}
+        return sample_pred_code, sample_pred_class, pred_confidences, timings
+
+    return sample_pred_code, sample_pred_class, pred_confidences
+
+
+
+def has_text(title, description):
+    return any(isinstance(text, str) and text.strip() != '' for text in [title, description])
+
+
+
+def has_image(image):
+    '''
+    False for a missing image: None, NaN (empty dataframe cell), empty bytes or a path that does not exist.
+    '''
+    if image is None or (isinstance(image, float) and np.isnan(image)):
+        return False
+
+    if isinstance(image, str):
+        return os.path.exists(image)
+
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return len(image) > 0
+
+    return True
+
+
+
+def get_product_modality(title, description, image):
+    '''
+    Modalities available for a product: 'text+image', 'text', 'image' or 'none'.
+    '''
+    text, image = has_text(title, description), has_image(image)
+
+    if text and image:
+        return 'text+image'
+
+    return 'text' if text else 'image' if image else 'none'
+
+
+
+## cache of predictions keyed by product content (sellers re-upload identical products)
+_prediction_cache = ct.PredictionCache(max_size = 4096, ttl = 24 * 3600)
+
+
+def configure_prediction_cache(max_size = 4096, ttl = 24 * 3600):
+    '''
+    Replace the prediction cache with a new one of the given size bound and time-to-live (seconds).
+    '''
+    global _prediction_cache
+    _prediction_cache = ct.PredictionCache(max_size = max_size, ttl = ttl)
+
+    return _prediction_cache
+
+
+
+def get_cached_predictions(sample_title, sample_description, sample_image, return_timings = False):
+    '''
+    Same output as get_predictions, served from the content-hash cache when the same product
+    (normalized title / description and identical image bytes) has already been classified.
+    Identical concurrent requests share one computation.
+    With return_timings = True, the timings of the original computation are returned with
+    'served' = time spent in this call.
+    '''
+    t0 = time.perf_counter()
+
+    image_bytes = ct.get_image_bytes(sample_image)
+    key = ct.get_product_key(sample_title, sample_description, image_bytes)
+
+    predictions = _prediction_cache.get_or_compute(key, lambda: get_predictions(sample_title, sample_description, 
+                                                                                image_bytes, return_timings = True))
+
+    if return_timings:
+        timings = dict(predictions[3], served = time.perf_counter() - t0)
+        return predictions[:3] + (timings,)
+
+    return predictions[:3]
+
+
+
+def get_prediction_cache_stats():
+    '''
+    Hit / miss / coalesced counters and size of the prediction cache.
+    '''
+    return _prediction_cache.get_stats()
+
+
+
+def get_label_decoder():
+    '''
+    Label decoder (model output index -> prdtypecode, prodtype), built once per process.
+    It is rebuilt if the target encoder file changes.
+    '''
+    target_encoder_file = './trained_models/' + TRANSFORMERS['text_target_encoder']
+
+    return _transformer_registry.get('label_decoder',
+                                     lambda: fm.get_label_decoder(get_transformer('text_target_encoder'),
+                                                                  '../references/product_class.csv'),
+                                     path = target_encoder_file)
+
+
+
+def get_products_frame(titles = None, descriptions = None, images = None, data = None):
+    '''
+    Products of the batch APIs as a dataframe with columns 'title', 'description' and 'image'.
+    Missing lists give empty texts (image-only products) or no images (text-only products).
+    '''
+    if data is None:
+        nb_products = len(titles) if titles is not None else len(images)
+
+        return pd.DataFrame({'title' : list(titles) if titles is not None else [''] * nb_products,
+                             'description' : list(descriptions) if descriptions is not None else [''] * nb_products,
+                             'image' : list(images) if images is not None else [None] * nb_products})
+
+    return data.rename({'designation' : 'title'}, axis = 1)
+
+
+
+def get_batch_predictions(titles = None, descriptions = None, images = None, data = None, 
+                          num = 3, batch_size = 256, use_fused_model = False, verbose = False):
+    '''
+    Classify many products at once with the fusion pipeline.
+    Products are given either as lists of titles, descriptions and images, or as a dataframe 'data'
+    with columns 'title' (or 'designation'), 'description' and 'image'.
+    Images can be raw bytes, file-like objects or file paths.
+    Every stage runs on full batches of batch_size products (memory stays bounded by batch_size).
+    With use_fused_model = True the models run as the single exported fused graph (see export_fused_model).
+
+    Returns a dataframe with columns pred_code_i, pred_class_i and confidence_i for i = 1..num,
+    indexed like 'data' (or 0..N-1 when lists are given).
+    '''
+    data = get_products_frame(titles, descriptions, images, data)
+
+    t0 = time.time()
+
+    batch_results = []
+    for start in range(0, data.shape[0], batch_size):
+        batch = data.iloc[start : start + batch_size]
+
+        with tt.stage('batch_pred_vectors', items = batch.shape[0]):
+            pred_vectors = get_batch_pred_vectors(batch['title'].tolist(), batch['description'].tolist(),
+                                                  batch['image'].tolist(), batch_size = batch_size,
+                                                  use_fused_model = use_fused_model, image_ids = get_image_ids(batch))
+
+        with tt.stage('decode_predictions', items = batch.shape[0]):
+            batch_results.append( get_decoded_batch_predictions(pred_vectors, batch.index, num = num) )
+
+        if verbose:
+            print("%d products classified at time %0.2f seconds" %(start + batch.shape[0], time.time() - t0))
+
+    if len(batch_results) == 0:
+        return get_decoded_batch_predictions(np.empty((0, len(get_label_decoder().codes))), data.index, num = num)
+
+    return pd.concat(batch_results)
+
+
+
+def get_text_only_predictions(titles, descriptions = None, num = 3, batch_size = 256, index = None):
+    '''
+    Predictions from the text only: headless text model, scaled like the fusion inputs,
+    followed by the text-only head (no image branch). Same output table as get_batch_predictions.
+    '''
+    if descriptions is None:
+        descriptions = [''] * len(titles)
+
+    with tt.stage('text_branch', items = len(titles)):
+        text_hl_output = get_text_hl_model_output_batch(wrap_text_input(titles, descriptions), batch_size = batch_size)
+
+    pred_vectors = get_text_head_pred_vectors(text_hl_output, batch_size = batch_size)
+
+    return get_decoded_batch_predictions(pred_vectors, index = index, num = num)
+
+
+
+def get_image_only_predictions(images, num = 3, batch_size = 256, index = None, image_ids = None):
+    '''
+    Predictions from the image only: headless image model, scaled like the fusion inputs,
+    followed by the image-only head (no text branch). Same output table as get_batch_predictions.
+    '''
+    image_hl_output = get_image_hl_model_output_batch(images, batch_size = batch_size, image_ids = image_ids)
+
+    pred_vectors = get_head_pred_vectors('image', image_hl_output, batch_size = batch_size)
+
+    return get_decoded_batch_predictions(pred_vectors, index = index, num = num)
+
+
+
+def get_head_pred_vectors(modality, hl_output, batch_size = 256):
+    '''
+    Output vectors (N, Nb_classes) of the single-modality head of 'text' or 'image'
+    from the headless model output of that modality.
+    '''
+    model_key = MODALITY_HEADS[modality]
+
+    with tt.stage(model_key, items = hl_output.shape[0]):
+        hl_output_scaled = get_transformer(modality + '_hl_output_scaler').transform(hl_output)
+        pred_vectors = get_compiled_model(model_key).predict(hl_output_scaled, batch_size = batch_size)
+
+    return pred_vectors
+
+
+
+def get_text_head_pred_vectors(text_hl_output, batch_size = 256):
+    '''
+    Text-only head output vectors (N, Nb_classes) from the headless text model output.
+    '''
+    return get_head_pred_vectors('text', text_hl_output, batch_size = batch_size)
+
+
+
+def get_modality_predictions(titles = None, descriptions = None, images = None, data = None, num = 3,
+                             batch_size = 256, use_fused_model = False, use_cascade = False, verbose = False):
+    '''
+    Classify many products, each with the path of the modalities it has: the fusion pipeline
+    (or the cascade if use_cascade = True) for text + image, the text-only head for products without
+    image and the image-only head for products without title and description. The image model is
+    never loaded nor run for products without image. Products with neither get empty predictions
+    (missing values, the codes are a nullable Int64 column).
+
+    Same inputs and output as get_batch_predictions, plus a column 'modalities'
+    (and 'cascade_stage' if use_cascade = True, missing for the products without both modalities).
+    '''
+    data = get_products_frame(titles, descriptions, images, data)
+
+    modalities = pd.Series([get_product_modality(title, description, image)
+                            for title, description, image in zip(data['title'], data['description'], data['image'])],
+                           index = data.index)
+
+    results = []
+    for modality in ['text+image', 'text', 'image']:
+        group = data[modalities == modality]
+        if group.shape[0] == 0:
+            continue
+
+        if verbose:
+            print("%d products with modalities %s" %(group.shape[0], modality))
+
+        if modality == 'text+image' and use_cascade:
+            results.append(get_cascade_predictions(data = group, num = num, batch_size = batch_size, verbose = verbose))
+        elif modality == 'text+image':
+            results.append(get_batch_predictions(data = group, num = num, batch_size = batch_size,
+                                                 use_fused_model = use_fused_model, verbose = verbose))
+        elif modality == 'text':
+            results.append(get_text_only_predictions(group['title'].fillna('').tolist(), group['description'].fillna('').tolist(),
+                                                     num = num, batch_size = batch_size, index = group.index))
+        else:
+            results.append(get_image_only_predictions(group['image'].tolist(), num = num, batch_size = batch_size,
+                                                      index = group.index, image_ids = get_image_ids(group)))
+
+    if len(results) == 0:
+        predictions = get_decoded_batch_predictions(np.empty((0, len(get_label_decoder().codes))), num = num)
+    else:
+        predictions = pd.concat(results)
+
+    predictions = predictions.reindex(data.index)
+    predictions['modalities'] = modalities
+
+    ## same columns and dtypes whatever the modalities of the batch (e.g. chunks of a scoring job)
+    if use_cascade and 'cascade_stage' not in predictions.columns:
+        predictions['cascade_stage'] = pd.Series(None, index = data.index, dtype = object)
+
+    for column in predictions.columns:
+        if column.startswith('pred_code_'):
+            predictions[column] = predictions[column].astype('Int64')
+
+    return predictions
+
+
+
+def get_cascade_scores(pred_vectors, criterion = 'margin'):
+    '''
+    Decisiveness of each prediction vector: top-1 probability ('confidence')
+    or difference between the top-1 and top-2 probabilities ('margin').
+    '''
+    if criterion == 'confidence':
+        return pred_vectors.max(axis = 1)
+
+    if criterion == 'margin':
+        top_2 = np.partition(pred_vectors, -2, axis = 1)[:, -2:]
+        return top_2[:, 1] - top_2[:, 0]
+
+    raise ValueError("Unknown cascade criterion '%s', choose 'confidence' or 'margin'" %criterion)
+
+
+
+def get_cascade_config():
+    '''
+    Gate of the cascade ({'criterion', 'threshold'}) tuned on the validation split by cascade_tools,
+    or DEFAULT_CASCADE_CONFIG if it has not been tuned.
+    '''
+    config_file = './trained_models/' + CASCADE_CONFIG
+
+    def load_config():
+        if not os.path.exists(config_file):
+            return dict(DEFAULT_CASCADE_CONFIG)
+        with open(config_file, 'r') as f:
+            return json.load(f)
+
+    return _transformer_registry.get('cascade_config', load_config, path = config_file)
+
+
+
+def get_cascade_predictions(titles = None, descriptions = None, images = None, data = None, num = 3, batch_size = 256,
+                            criterion = None, threshold = None, verbose = False):
+    '''
+    Classify many products with the confidence-gated cascade: the text branch and the text-only head
+    run on every product, the image branch (VGG16) and the fusion head only on the products whose
+    text prediction is not decisive (cascade score below threshold, see get_cascade_scores).
+    The gate defaults to the tuned one (get_cascade_config).
+
+    Same inputs and output as get_batch_predictions, plus a column 'cascade_stage' = 'text' or 'fusion'.
+    '''
+    config = get_cascade_config()
+    criterion = criterion if criterion is not None else config['criterion']
+    threshold = threshold if threshold is not None else config['threshold']
+
+    data = get_products_frame(titles, descriptions, images, data)
+
+    t0 = time.time()
+
+    batch_results = []
+    for start in range(0, data.shape[0], batch_size):
+        batch = data.iloc[start : start + batch_size]
+
+        with tt.stage('text_branch', items = batch.shape[0]):
+            text_batch = wrap_text_input(batch['title'].tolist(), batch['description'].tolist())
+            text_hl_output = get_text_hl_model_output_batch(text_batch, batch_size = batch_size)
+
+        pred_vectors = np.array(get_text_head_pred_vectors(text_hl_output, batch_size = batch_size))
+        escalated = get_cascade_scores(pred_vectors, criterion) < threshold
+
+        if escalated.any():
+            images_escalated = [image for image, flag in zip(batch['image'], escalated) if flag]
+            image_ids = get_image_ids(batch[escalated])
+            image_hl_output = get_image_hl_model_output_batch(images_escalated, batch_size = batch_size, image_ids = image_ids)
+
+            ## the text branch output is reused, only the image branch and the fusion head run again
+            with tt.stage('fusion', items = len(images_escalated)):
+                fusion_data = get_fusion_data(text_hl_output[escalated], image_hl_output)
+                pred_vectors[escalated] = get_compiled_model('fusion').predict(fusion_data, batch_size = batch_size)
+
+        with tt.stage('decode_predictions', items = batch.shape[0]):
+            predictions = get_decoded_batch_predictions(pred_vectors, batch.index, num = num)
+            predictions['cascade_stage'] = np.where(escalated, 'fusion', 'text')
+            batch_results.append(predictions)
+
+        if verbose:
+            print("%d products classified (%d through the image branch) at time %0.2f seconds"
+                  %(start + batch.shape[0], escalated.sum(), time.time() - t0))
+
+    if len(batch_results) == 0:
+        predictions = get_decoded_batch_predictions(np.empty((0, len(get_label_decoder().codes))), data.index, num = num)
+        predictions['cascade_stage'] = pd.Series(dtype = object)
+        return predictions
+
+    return pd.concat(batch_results)
+
+
+
+def get_batch_pred_vectors(titles, descriptions, images, batch_size = 256, use_fused_model = False, image_ids = None):
+    '''
+    Fusion model output vectors (N, Nb_classes) for a batch of products.
+    image_ids are (imageid, productid) catalog ids of the images, used by the feature store.
+    '''
+    if use_fused_model:
+        return get_fused_pred_vectors(titles, descriptions, images, batch_size = batch_size)
+
+    ## image branch on a worker thread, text branch in the calling thread
+    image_future = _branch_executor.submit(tt.run_in_context(get_image_hl_model_output_batch), images,
+                                           batch_size = batch_size, image_ids = image_ids)
+
+    with tt.stage('text_branch', items = len(titles)):
+        text_batch = wrap_text_input(titles, descriptions)
+        text_hl_output = get_text_hl_model_output_batch(text_batch, batch_size = batch_size)
+
+    image_hl_output = image_future.result()
+
+    ## fusion head
+    with tt.stage('fusion', items = len(titles)):
+        fusion_data = get_fusion_data(text_hl_output, image_hl_output)
+        pred_vectors = get_compiled_model('fusion').predict(fusion_data, batch_size = batch_size)
+
+    return pred_vectors
+
+
+
+def get_fused_pred_vectors(titles, descriptions, images, batch_size = 256):
+    '''
+    Fusion model output vectors computed with the fused inference graph: 
+    headless models, output scalers, concatenation and fusion head in one model call.
+    '''
+    image_future = _branch_executor.submit(tt.run_in_context(preprocess_sample_images), images)
+
+    text_features = get_text_features_batch(wrap_text_input(titles, descriptions))
+    image_batch = image_future.result()
+
+    pred_vectors = get_compiled_model('fused').predict([text_features, image_batch], batch_size = batch_size)
+
+    return pred_vectors
+
+
+
+def export_fused_model(doit = False):
+    '''
+    Build the fused inference graph from the serving models and scalers, check it against
+    the step by step pipeline on random inputs, and save it in ./trained_models/.
+    '''
+    import fused_graph_tools as fgt
+
+    models = [get_trained_model('hl_txt_model'), get_trained_model('hl_img_model'), get_trained_model('fusion')]
+    scalers = [get_transformer('text_hl_output_scaler'), get_transformer('image_hl_output_scaler')]
+
+    fused_model = fgt.export_fused_inference_model(*models, *scalers, path = './trained_models/', 
+                                                   fitting_time = TRAINED_MODELS['fusion'][:10], doit = doit)
+
+    text_data = np.random.rand(8, models[0].input_shape[1]).astype(np.float32)
+    image_data = np.random.rand(8, 224, 224, 3).astype(np.float32)
+    fgt.check_fused_model_parity(fused_model, *models, *scalers, text_data, image_data)
+
+    return fused_model
+
+
+
+def get_decoded_batch_predictions(pred_vectors, index = None, num = 3):
+    '''
+    Top-num codes / classes / confidences table of a batch of model output vectors.
+    '''
+    pred_codes, pred_classes, confidences = get_label_decoder().top_k(pred_vectors, k = num)
+
+    table = {}
+    for i in range(pred_codes.shape[1]):
+        table['pred_code_' + str(i+1)] = pred_codes[:, i]
+        table['pred_class_' + str(i+1)] = pred_classes[:, i]
+        table['confidence_' + str(i+1)] = confidences[:, i]
+
+    return pd.DataFrame(table, index = index)
+
+
+
 def get_decoded_predictions(sample_pred_vector):
 
-    path = './trained_models/'
-    target_encoder = joblib.load(path + "2308281220_text_target_encoder")
+    decoder = get_label_decoder()
 
-    ## reverse one hot encoding
-    sample_pred_label = sample_pred_vector.argmax(axis = 1)
+    ## reverse one hot and label encoding, get predicted code and class name
+    pred_codes, pred_classes = decoder.decode(sample_pred_vector)
 
-    ## revert label encoder, get predcited code
-    sample_pred_code = target_encoder.inverse_transform(sample_pred_label)[0]
-    
-    ## get predicted class name
-    path = '../references/'
-    product_class = pd.read_csv(path + 'product_class.csv', sep = ';')
-    product_class.drop('target', axis = 1, inplace = True)
-    
-    sample_pred_class = product_class[product_class['prdtypecode']==sample_pred_code]['prodtype'].values
+    sample_pred_code = pred_codes[0]
+    sample_pred_class = pred_classes[:1]
     
     return sample_pred_code, sample_pred_class
 
 
 def get_decoded_predictions_with_confidence(sample_pred_vector, num = 3):
 
-    path = './trained_models/'
-    target_encoder = joblib.load(path + "2308281220_text_target_encoder")
+    decoder = get_label_decoder()
 
-    ## reverse one hot encoding
-    pred_labels = sample_pred_vector.argsort(axis = 1)[:,-3:][:,::-1].T
+    ## top-num codes, class names and confidences of the first sample
+    pred_codes, pred_classes, confidences = decoder.top_k(sample_pred_vector, k = num)
 
-    confidences = [sample_pred_vector[0,label][0] for label in pred_labels]
+    return list(pred_codes[0]), list(pred_classes[0]), list(confidences[0])
 
-    ## revert label encoder, get predcited code
-    pred_codes = [target_encoder.inverse_transform(label)[0] for label in pred_labels]
-    
-    ## get predicted class name
-    path = '../references/'
-    product_class = pd.read_csv(path + 'product_class.csv', sep = ';')
-    product_class.drop('target', axis = 1, inplace = True)
-    
-    pred_classes = [ product_class[product_class['prdtypecode']==code]['prodtype'].values[0] for code in pred_codes]
-    
-    return pred_codes, pred_classes, confidences
 
 
 def get_fusion_data(sample_text_hl_output, sample_image_hl_output):
 
-    path = './trained_models/'
-    text_hl_output_scaler = joblib.load(path + '2309012059_text_hl_data_output_scaler')
-    image_hl_output_scaler = joblib.load(path + '2309012059_image_hl_data_output_scaler')
+    text_hl_output_scaler = get_transformer('text_hl_output_scaler')
+    image_hl_output_scaler = get_transformer('image_hl_output_scaler')
 
     sample_fusion_data = fm.get_sample_fusion_data(sample_text_hl_output, sample_image_hl_output, 
                                                text_hl_output_scaler, image_hl_output_scaler)
@@ -200,31 +701,95 @@ def get_text_hl_model_output(sample_title, sample_description):
     ## wrap text data into a dataframe
     sample_text = wrap_text_input(sample_title, sample_description)
 
-    ## preprocess text data: cleaning, feature engineering, etc
-    sample_text_preprocessed = fm.preprocess_text_data(sample_text, verbose = False)
+    sample_text_hl_output = get_text_hl_model_output_batch(sample_text)
+
+    return sample_text_hl_output
+
 
-    ## transform text data: vectorization, etc
-    path = './trained_models/'
-    token_len_scaler = joblib.load(path + '2308281220_token_len_scaler')
-    language_encoder = joblib.load(path + '2308281220_language_encoder')
-    lemmas_vectorizer = joblib.load(path + '2308281220_lemmas_vectorizer')
 
-    sample_text_transformed = fm.transform_sample_text(sample_text_preprocessed, token_len_scaler,
-                                                   language_encoder, lemmas_vectorizer, verbose = 1)
+def get_text_hl_model_output_batch(text_df, batch_size = 256):
+    '''
+    Headless text model output for every row (title, description) of text_df.
+    '''
+    text_transformed = get_text_features_batch(text_df)
 
     ## get text headless model
-    model = get_trained_model('hl_txt_model')
+    model = get_compiled_model('hl_txt_model')
 
     ## run headless model
-    sample_text_hl_output = model.predict(sample_text_transformed)
+    with tt.stage('hl_txt_model', items = text_df.shape[0]):
+        text_hl_output = model.predict(text_transformed, batch_size = batch_size)
+
+    return text_hl_output
+
+
+
+def get_text_features_batch(text_df):
+    '''
+    Preprocess and transform the text of every row (title, description) of text_df
+    into the input features of the headless text model.
+    '''
+    ## preprocess text data: cleaning, feature engineering, etc
+    text_preprocessed = get_text_runtime().process(text_df)
+
+    ## transform text data: vectorization, etc
+    token_len_scaler = get_transformer('token_len_scaler')
+    language_encoder = get_transformer('language_encoder')
+    lemmas_vectorizer = get_transformer('lemmas_vectorizer')
+
+    with tt.stage('transform_text', items = text_df.shape[0]):
+        text_transformed = fm.transform_sample_text(text_preprocessed, token_len_scaler,
+                                                    language_encoder, lemmas_vectorizer, verbose = 0)
+
+    return text_transformed
+
+
+
+def get_lemma_table():
+    '''
+    Lemma table saved with the fitted transformers (lemma_table_tools), reloaded if the file changes
+    on disk. It is frozen: the tokens of the requests that are not in it are lemmatized by WordNet
+    without being added, so the shared table does not grow with user input (an empty table if it
+    has not been saved).
+    '''
+    import lemma_table_tools as ltt
+
+    lemma_table_file = './trained_models/' + LEMMA_TABLE
+
+    return _transformer_registry.get('lemma_table', lambda: ltt.load_lemma_table(lemma_table_file, frozen = True),
+                                     path = lemma_table_file)
+
+
+
+def get_text_runtime():
+    '''
+    Text preprocessing runtime (text_runtime_tools.TextPreprocessor) shared by every request:
+    tokenizer, lemma table, language identifiers and stop words are loaded once per process.
+    '''
+    import text_runtime_tools as trt
+
+    lemma_table = get_lemma_table()
+
+    runtime = _transformer_registry.get('text_runtime', lambda: trt.TextPreprocessor(lemma_table = lemma_table))
+
+    ## the lemma table file was replaced: new runtime on the new table
+    if runtime.lemmatizer is not lemma_table:
+        _transformer_registry.evict('text_runtime')
+        runtime = _transformer_registry.get('text_runtime', lambda: trt.TextPreprocessor(lemma_table = lemma_table))
+
+    return runtime
 
-    return sample_text_hl_output
 
 
 def wrap_text_input(title, description):
+    '''
+    Wrap a single product (strings) or a batch of products (lists) into a text dataframe.
+    '''
+    if isinstance(title, str):
+        title, description = [title], [description]
 
-    text_dict = {'title' : [title],
-                'description' : [description]}
+    text_dict = {'title' : list(title),
+                'description' : list(description)}
 
     text_df = pd.DataFrame(text_dict, columns = text_dict.keys())
 
@@ -233,59 +798,422 @@ def wrap_text_input(title, description):
 
 
 def get_image_hl_model_output(sample_image):
+
+    ## known images are served from the feature store
+    store = get_feature_store()
+    if store is not None:
+        image_bytes = ct.get_image_bytes(sample_image)
+        key_lists = [[fst.get_content_key(image_bytes)]]
+
+        with tt.stage('feature_store', items = 1):
+            features, found = store.lookup(key_lists)
+        if found[0]:
+            return features
+
+        sample_image = image_bytes
     
     ## Preprocess and transform data
-    sample_image_preprocessed = preprocess_sample_image(sample_image)
+    with tt.stage('image_preprocessing', items = 1):
+        sample_image_preprocessed = preprocess_sample_image(sample_image)
 
     ## Load model
-    model = get_trained_model('hl_img_model')
+    model = get_compiled_model('hl_img_model')
     # model.summary(print_fn=lambda x: st.text(x))
 
     ## apply hl_image_model
-    sample_image_hl_output = model.predict(sample_image_preprocessed)
+    with tt.stage('hl_img_model', items = 1):
+        sample_image_hl_output = model.predict(sample_image_preprocessed)
+
+    if store is not None:
+        store.put(key_lists, sample_image_hl_output)
 
     return sample_image_hl_output
 
 
 
+def get_image_hl_model_output_batch(images, batch_size = 256, image_ids = None):
+    '''
+    Headless image model output for a list of images (bytes, file-like objects or paths).
+    Images already in the feature store, by catalog id (image_ids: list of (imageid, productid))
+    or by content, are not run through the model. The outputs of the others are written back.
+    '''
+    store = get_feature_store()
+    if store is None:
+        return compute_image_hl_model_output_batch(images, batch_size = batch_size)
+
+    nb_images = len(images)
+    if nb_images == 0:
+        return compute_image_hl_model_output_batch(images, batch_size = batch_size)
+
+    id_keys = [[fst.get_id_key(*ids)] if ids is not None else [] for ids in (image_ids or [None] * nb_images)]
+
+    with tt.stage('feature_store', items = nb_images):
+        ## catalog ids first: a hit does not even read the image file
+        features, found = store.lookup(id_keys, count_misses = False)
+
+        missing = np.flatnonzero(~found)
+        images_bytes = [ct.get_image_bytes(images[i]) for i in missing]
+        key_lists = [id_keys[i] + [fst.get_content_key(image_bytes)] for i, image_bytes in zip(missing, images_bytes)]
+
+        missing_features, missing_found = store.lookup([keys[-1:] for keys in key_lists])
+
+    ## run the model on the images still unknown, and write their outputs back
+    to_compute = np.flatnonzero(~missing_found)
+    if len(to_compute) > 0:
+        computed = compute_image_hl_model_output_batch([images_bytes[j] for j in to_compute], batch_size = batch_size)
+        store.put([key_lists[j] for j in to_compute], computed)
+
+    image_hl_output = np.empty((nb_images, store.dim or computed.shape[1]), dtype = np.float32)
+    if found.any():
+        image_hl_output[found] = features[found]
+    if missing_found.any():
+        image_hl_output[missing[missing_found]] = missing_features[missing_found]
+    if len(to_compute) > 0:
+        image_hl_output[missing[to_compute]] = computed
+
+    return image_hl_output
+
+
+
+def get_image_ids(data):
+    '''
+    (imageid, productid) catalog ids of the products of a dataframe, None if it does not have them.
+    '''
+    if 'imageid' not in data.columns or 'productid' not in data.columns:
+        return None
+
+    return list(zip(data['imageid'], data['productid']))
+
+
+
+def configure_feature_store(path = None, enabled = True, write_back = True, max_rows = None):
+    '''
+    Use the feature store in path (default FEATURE_STORE_PATH) for the image branch, or disable it
+    (the default). With write_back = False the store is only read. The store stops growing at
+    max_rows rows (default FEATURE_STORE_MAX_ROWS).
+    '''
+    store = get_feature_store() if _model_registry.is_loaded('image_feature_store') else None
+    if store is not None:
+        store.sync()
+
+    _model_registry.evict('image_feature_store')
+    _feature_store_config.update(path = path or FEATURE_STORE_PATH, enabled = enabled, write_back = write_back,
+                                 max_rows = max_rows or FEATURE_STORE_MAX_ROWS)
+
+
+
+def get_feature_store_signature():
+    '''
+    Signature of the image model file (name, modification time and size, as the registries sign
+    files): retraining or replacing the file under the same name gives a new signature.
+    '''
+    model_file = './trained_models/' + TRAINED_MODELS['hl_img_model']
+
+    if not os.path.exists(model_file):
+        return TRAINED_MODELS['hl_img_model']
+
+    return '%s:%d:%d' %((TRAINED_MODELS['hl_img_model'],) + rt.get_file_signature(model_file))
+
+
+
+def get_feature_store():
+    '''
+    Store of the headless image model outputs (feature_store_tools.FeatureStore), None if disabled
+    (see configure_feature_store). It is bound to the image model file: the features of each version
+    of the file (get_feature_store_signature) are kept in their own sub-directory of the store path.
+    '''
+    if not _feature_store_config['enabled']:
+        return None
+
+    model_file = './trained_models/' + TRAINED_MODELS['hl_img_model']
+
+    def load_store():
+        signature = get_feature_store_signature()
+        return fst.FeatureStore(fst.get_store_directory(_feature_store_config['path'], signature),
+                                model_signature = signature,
+                                write_back = _feature_store_config['write_back'],
+                                max_rows = _feature_store_config['max_rows'])
+
+    return _model_registry.get('image_feature_store', load_store, path = model_file)
+
+
+
+def get_feature_store_stats():
+    store = get_feature_store()
+
+    return store.get_stats() if store is not None else {}
+
+
+
+def compute_image_hl_model_output_batch(images, batch_size = 256):
+    '''
+    Headless image model output for a list of images, always computed by the model.
+    '''
+    with tt.stage('image_preprocessing', items = len(images)):
+        image_batch = preprocess_sample_images(images)
+
+    with tt.stage('hl_img_model', items = len(images)):
+        image_hl_output = get_compiled_model('hl_img_model').predict(image_batch, batch_size = batch_size)
+
+    return image_hl_output
+
+
+
+## trained models and fitted transformers are loaded once per process and shared 
+## (read-only) by every session / rerun. They are reloaded if their file changes on disk.
+_model_registry = rt.ResourceRegistry('trained_models')
+_transformer_registry = rt.ResourceRegistry('transformers')
+
+TRAINED_MODELS = { 
+    'RF_txt' : '2308181133_text_rf_trained.joblib',
+    'hl_img_model' : '2309012056_image_headless_model_pack.keras',
+    'hl_txt_model' : '2309012056_headless_text_model.keras',
+    'fusion' : '2309012136_fusion_model_trained.keras',
+    'fused' : '2309012136_fused_inference_model.keras',
+    'text_head' : '2309012136_text_only_head.keras',
+    'image_head' : '2309012136_image_only_head.keras'}
+
+## models needed by get_predictions
+SERVING_MODELS = ['hl_img_model', 'hl_txt_model', 'fusion']
+
+## models of the degraded (text-only) predictions, see head_tools
+DEGRADED_MODELS = ['text_head']
+
+## single-modality heads of the products without image or without text, see head_tools
+MODALITY_HEADS = {'text' : 'text_head', 'image' : 'image_head'}
+
+## headless image model outputs of the images already seen, see feature_store_tools.
+## Off by default: enabled by the scoring jobs and the service with --feature-store
+FEATURE_STORE_PATH = './feature_store/'
+FEATURE_STORE_MAX_ROWS = 500000
+_feature_store_config = {'path' : FEATURE_STORE_PATH, 'enabled' : False, 'write_back' : True,
+                         'max_rows' : FEATURE_STORE_MAX_ROWS}
+
+## gate of the confidence-gated cascade, tuned by cascade_tools
+CASCADE_CONFIG = 'cascade_config.json'
+DEFAULT_CASCADE_CONFIG = {'criterion' : 'margin', 'threshold' : 0.5}
+
+TRANSFORMERS = {
+    'token_len_scaler' : '2308281220_token_len_scaler',
+    'language_encoder' : '2308281220_language_encoder',
+    'lemmas_vectorizer' : '2308281220_lemmas_vectorizer',
+    'text_target_encoder' : '2308281220_text_target_encoder',
+    'text_hl_output_scaler' : '2309012059_text_hl_data_output_scaler',
+    'image_hl_output_scaler' : '2309012059_image_hl_data_output_scaler'}
+
+## lemma of every token of the training vocabulary, saved next to lemmas_vectorizer (lemma_table_tools)
+LEMMA_TABLE = '2308281220_lemma_table'
+
+
 def get_trained_model(model_key):
+    '''
+    Return the trained model for model_key from the process-wide registry.
+    The model file is only read on the first request.
+    '''
+    model_file = './trained_models/' + TRAINED_MODELS[model_key]
+
+    return _model_registry.get(model_key, lambda: load_trained_model(model_key), path = model_file)
+
+
+
+## input shapes (without batch dim) of the compiled inference functions, None = same as the model
+MODEL_INPUT_SHAPES = {
+    'hl_img_model' : [(224, 224, 3)],
+    'fused' : [None, (224, 224, 3)]}
+
+
+def get_compiled_model(model_key):
+    '''
+    Compiled inference wrapper (traced tf.function with a fixed input signature) of a trained model.
+    Use it instead of model.predict for single samples and small batches: it has the same
+    predict(inputs, batch_size) interface without the per-call setup of Keras predict.
+    '''
+    import inference_tools as it
+
+    model_file = './trained_models/' + TRAINED_MODELS[model_key]
+
+    return _model_registry.get('compiled_' + model_key,
+                               lambda: it.CompiledPredictor(get_trained_model(model_key), MODEL_INPUT_SHAPES.get(model_key)),
+                               path = model_file)
+
+
+
+def register_trained_model(model_key, model):
+    '''
+    Serve an already built model under model_key instead of the file in trained_models
+    (e.g. randomly initialized models for offline load tests).
+    '''
+    ## the stored image features are the outputs of the trained image model only
+    if model_key == 'hl_img_model':
+        configure_feature_store(enabled = False)
+
+    _model_registry.evict('compiled_' + model_key)
+
+    ## pinned: not replaced by the file in trained_models, even if it exists or changes
+    return _model_registry.register(model_key, model)
+
+
+
+def is_model_available(model_key):
+    '''
+    True if the model is already loaded (or registered) or its file exists in trained_models.
+    '''
+    return _model_registry.is_loaded(model_key) or os.path.exists('./trained_models/' + TRAINED_MODELS[model_key])
+
+
+
+def register_compiled_model(model_key, predictor):
+    '''
+    Serve model_key with another predictor exposing predict(inputs, batch_size), e.g. a TFLite
+    interpreter (export_tools.TFLitePredictor), in place of the compiled Keras model.
+    '''
+    if model_key == 'hl_img_model':
+        configure_feature_store(enabled = False)
+
+    return _model_registry.register('compiled_' + model_key, predictor)
+
+
+
+def load_trained_model(model_key):
+    from tensorflow.keras.models import load_model
 
-    ## define dictionary with keys
-    trained_models = { 
-        'RF_txt' : '2308181133_text_rf_trained.joblib',
-        'hl_img_model' : '2309012056_image_headless_model_pack.keras',
-        'hl_txt_model' : '2309012056_headless_text_model.keras',
-        'fusion' : '2309012136_fusion_model_trained.keras'}
-    
     path = './trained_models/'
-    model_file = path + trained_models[model_key]
+    model_file = path + TRAINED_MODELS[model_key]
 
     ## get model with joblib
     if model_key in ['RF_txt']:
         model = joblib.load(model_file)
 
-    elif model_key in ['hl_img_model','hl_txt_model','fusion']:
+    elif model_key in ['hl_img_model','hl_txt_model','fusion','text_head','image_head']:
+        model = load_model(model_file)
+
+    elif model_key in ['fused']:
+        import fused_graph_tools   # registers the MinMaxScaling layer
         model = load_model(model_file)
      
     return model
 
 
 
-def preprocess_sample_image(sample_image):
+def get_transformer(transformer_key):
+    '''
+    Return the fitted transformer (scaler, encoder, vectorizer) for transformer_key.
+    It is unpickled once and shared read-only across requests.
+    '''
+    transformer_file = './trained_models/' + TRANSFORMERS[transformer_key]
+
+    return _transformer_registry.get(transformer_key, lambda: joblib.load(transformer_file), path = transformer_file)
+
 
-    # Convert the file to an opencv image
-    file_bytes = np.asarray(bytearray(sample_image.read()), dtype=np.uint8)
-    opencv_image = cv2.imdecode(file_bytes, 1)
 
-    sample_image_cropped = fm.crop_image(opencv_image, threshold = 230)
-    sample_image_resized = cv2.resize(sample_image_cropped, (224, 224))
+def warm_up_transformers():
+    '''
+    Eagerly load every fitted transformer used by the serving path, and the text preprocessing runtime.
+    '''
+    for transformer_key in TRANSFORMERS:
+        get_transformer(transformer_key)
+
+    get_text_runtime()
+
+    return _transformer_registry.report()
+
+
+
+def warm_up_models(model_keys = None, verbose = False):
+    '''
+    Eagerly load the serving models into the registry (e.g. at app startup),
+    so that the first prediction does not pay the deserialization cost.
+    Returns the registry report.
+    '''
+    if model_keys is None:
+        model_keys = SERVING_MODELS
+
+    for model_key in model_keys:
+        get_trained_model(model_key)
+
+    report = get_model_registry_report()
+
+    if verbose:
+        for key, stats in report['resources'].items():
+            print("Model '%s' loaded in %0.2f seconds" %(key, stats['load_time']))
+
+    return report
+
+
+
+def get_model_registry_report():
+    '''
+    Load time and memory figures of the warm model pool.
+    '''
+    return _model_registry.report()
+
+
+
+def get_transformer_registry_report():
+    return _transformer_registry.report()
+
+
+
+def refresh_registries():
+    '''
+    Drop every cached model or transformer whose file changed on disk.
+    '''
+    return _model_registry.refresh() + _transformer_registry.refresh()
+
+
+
+def preprocess_sample_image(sample_image):
 
     ## Preprocess af for VGG feature extractor: The images are converted from RGB to BGR, 
     ## then each color channel is zero-centered with respect to the ImageNet dataset, without scaling.
 
-    sample_image_batch = np.expand_dims(sample_image_resized, axis=0)
-    sample_image_scaled = preprocess_input(sample_image_batch) / 255
+    sample_image_scaled = preprocess_sample_images([sample_image])
 
     return sample_image_scaled
 
 
+
+def decode_image(image):
+    '''
+    Read an image given as raw bytes, a file-like object (e.g. streamlit upload) or a file path
+    into an opencv (BGR) array.
+    '''
+    import cv2
+
+    if isinstance(image, str):
+        return cv2.imread(image)
+
+    if hasattr(image, 'read'):
+        image = image.read()
+
+    file_bytes = np.frombuffer(image, dtype = np.uint8)
+
+    return cv2.imdecode(file_bytes, 1)
+
+
+
+def crop_resize_image(opencv_image, threshold = 230, new_pixel_nb = 224):
+    import cv2
+
+    image_cropped = fm.crop_image(opencv_image, threshold = threshold)
+    image_resized = cv2.resize(image_cropped, (new_pixel_nb, new_pixel_nb))
+
+    return image_resized
+
+
+
+def preprocess_sample_images(images):
+    '''
+    Decode, crop, resize and scale a list of images into a single (N, 224, 224, 3) batch
+    ready for the headless image model.
+    '''
+    from tensorflow.keras.applications.vgg16 import preprocess_input
+
+    image_batch = np.empty((len(images), 224, 224, 3), dtype = np.float32)
+
+    for i, image in enumerate(images):
+        image_batch[i] = crop_resize_image(decode_image(image))
+
+    image_batch = preprocess_input(image_batch) / 255
+
+    return image_batch
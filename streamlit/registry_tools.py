@@ -0,0 +1,211 @@
+import os
+import time
+import threading
+
+
+
+def get_process_rss():
+    '''
+    Resident set size of the current process in bytes.
+    Returns None if psutil is not available.
+    '''
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+
+def get_process_memory(pid = None):
+    '''
+    Memory of a process in bytes: rss, uss (unique set size: pages no other process shares)
+    and pss (proportional set size, Linux only). Returns None if psutil is not available.
+    '''
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    info = psutil.Process(pid or os.getpid()).memory_full_info()
+
+    return {'rss' : info.rss, 'uss' : info.uss, 'pss' : getattr(info, 'pss', None)}
+
+
+
+def estimate_resource_size(resource):
+    '''
+    Rough in-memory size (bytes) of a loaded resource.
+    Keras models are measured from their weights, other objects are not estimated (None).
+    '''
+    if hasattr(resource, 'count_params'):
+        return int(resource.count_params()) * 4   # float32 weights
+
+    return None
+
+
+
+## signature of the resources put with ResourceRegistry.register, never stale
+PINNED = object()
+
+
+
+def get_file_signature(path):
+    '''
+    (modification time, size) of a file, used to detect that an artifact changed on disk.
+    '''
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+
+class ResourceRegistry:
+    '''
+    Process-wide registry of heavy read-only resources (trained models, fitted transformers).
+    Each resource is loaded once per process with the loader given on the first request,
+    and the same object is then shared by every caller and every thread.
+    Shared resources must be treated as read-only.
+
+    If a resource is registered with the path of its file and check_files = True,
+    the file signature is compared on every request and the resource is reloaded
+    when the file has been replaced on disk. Resources put with register() replace
+    their file until they are evicted.
+    '''
+
+    def __init__(self, name, check_files = True):
+        self.name = name
+        self.check_files = check_files
+        self._resources = {}
+        self._signatures = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+
+    def _get_key_lock(self, key):
+        ## one lock per resource: two different models can load in parallel,
+        ## while concurrent requests for the same model wait for a single load.
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+
+    def get(self, key, loader, path = None):
+        '''
+        Return the resource registered under key, loading it with loader() if needed.
+        path (optional) is the file the resource is loaded from, used for invalidation.
+        '''
+        if key in self._resources and not self._is_stale(key, path):
+            return self._resources[key]
+
+        with self._get_key_lock(key):
+            if key in self._resources and not self._is_stale(key, path):   # loaded by another thread
+                return self._resources[key]
+
+            reloads = self._stats[key]['reloads'] + 1 if key in self._stats else 0
+            signature = get_file_signature(path) if (path is not None and os.path.exists(path)) else None
+
+            rss_0 = get_process_rss()
+            t0 = time.perf_counter()
+
+            resource = loader()
+
+            t1 = time.perf_counter()
+            rss_1 = get_process_rss()
+
+            self._stats[key] = {'load_time' : t1 - t0,
+                                'rss_delta' : (rss_1 - rss_0) if rss_0 is not None else None,
+                                'size' : estimate_resource_size(resource),
+                                'loaded_at' : time.time(),
+                                'reloads' : reloads,
+                                'path' : path}
+            self._signatures[key] = signature
+            self._resources[key] = resource
+
+        return resource
+
+
+    def register(self, key, resource):
+        '''
+        Serve resource under key (e.g. a model built in memory) in place of the one loaded from
+        its file: it is never stale, whatever happens to the file, until it is evicted.
+        '''
+        with self._get_key_lock(key):
+            self._stats[key] = {'load_time' : 0.0,
+                                'rss_delta' : None,
+                                'size' : estimate_resource_size(resource),
+                                'loaded_at' : time.time(),
+                                'reloads' : self._stats[key]['reloads'] + 1 if key in self._stats else 0,
+                                'path' : None}
+            self._signatures[key] = PINNED
+            self._resources[key] = resource
+
+        return resource
+
+
+    def _is_stale(self, key, path):
+        '''
+        True if the file behind the resource changed since it was loaded.
+        '''
+        if not self.check_files or path is None or self._signatures.get(key) is PINNED:
+            return False
+
+        try:
+            return get_file_signature(path) != self._signatures.get(key)
+        except OSError:
+            return False    # file temporarily missing (being replaced): keep serving the loaded object
+
+
+    def is_loaded(self, key):
+        return key in self._resources
+
+
+    def keys(self):
+        return list(self._resources.keys())
+
+
+    def evict(self, key):
+        '''
+        Drop a resource from the registry. It will be reloaded on the next request.
+        '''
+        with self._get_key_lock(key):
+            self._resources.pop(key, None)
+            self._signatures.pop(key, None)
+            self._stats.pop(key, None)
+
+
+    def clear(self):
+        for key in self.keys():
+            self.evict(key)
+
+
+    def refresh(self):
+        '''
+        Evict every resource whose file changed on disk. Returns the evicted keys.
+        '''
+        stale = [key for key in self.keys() if self._is_stale(key, self._stats[key]['path'])]
+        for key in stale:
+            self.evict(key)
+
+        return stale
+
+
+    def report(self):
+        '''
+        Load time and memory figures of every loaded resource, plus totals and the current process RSS.
+        '''
+        stats = {key : dict(value) for key, value in self._stats.items()}
+
+        sizes = [s['size'] for s in stats.values() if s['size'] is not None]
+        rss_deltas = [s['rss_delta'] for s in stats.values() if s['rss_delta'] is not None]
+
+        report = {'registry' : self.name,
+                  'resources' : stats,
+                  'total_load_time' : sum(s['load_time'] for s in stats.values()),
+                  'total_size' : sum(sizes) if sizes else None,
+                  'total_rss_delta' : sum(rss_deltas) if rss_deltas else None,
+                  'process_rss' : get_process_rss()}
+
+        return report
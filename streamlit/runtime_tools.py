@@ -0,0 +1,213 @@
+'''
+Serving runtime profile: thread pools of TensorFlow, OpenCV and BLAS, and warm-up inference.
+
+Call apply_serving_profile() once at startup, before the first model is loaded
+(TensorFlow thread pools can only be set before the TF runtime is initialized):
+
+    import runtime_tools as rtt
+    report = rtt.apply_serving_profile(nb_workers = 2)
+
+Thread counts can also be set with the environment variables RAKUTEN_INTRA_OP_THREADS,
+RAKUTEN_INTER_OP_THREADS, RAKUTEN_OPENCV_THREADS and RAKUTEN_BLAS_THREADS.
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+
+import project_tools as pt
+import benchmark_tools as bt
+
+
+
+def get_cpu_count():
+    '''
+    Cores available to this process (affinity aware where supported).
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+
+def get_thread_profile(nb_workers = 1):
+    '''
+    Default thread counts when nb_workers sessions / processes share the machine:
+    each gets an equal share of the cores for its intra-op pool and a single inter-op thread
+    (the serving graphs are small chains of ops, there is little to run in parallel between ops).
+    Environment variables override the defaults.
+    '''
+    share = max(1, get_cpu_count() // max(1, nb_workers))
+
+    profile = {'intra_op' : share, 'inter_op' : 1, 'opencv' : 1, 'blas' : share}
+
+    for key, variable in [('intra_op', 'RAKUTEN_INTRA_OP_THREADS'), ('inter_op', 'RAKUTEN_INTER_OP_THREADS'),
+                          ('opencv', 'RAKUTEN_OPENCV_THREADS'), ('blas', 'RAKUTEN_BLAS_THREADS')]:
+        if os.environ.get(variable):
+            profile[key] = int(os.environ[variable])
+
+    return profile
+
+
+
+def configure_threads(intra_op = None, inter_op = None, opencv = None, blas = None):
+    '''
+    Pin the thread pools (None leaves a pool unchanged) and return what was applied.
+    TensorFlow and OpenCV are not imported for this: if they are not loaded yet, the environment
+    variables they read at initialization are set instead. TensorFlow pools cannot change once
+    its runtime is initialized, in which case the current values are reported with tf_applied = False.
+    '''
+    applied = {}
+
+    if blas is not None:
+        for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+            os.environ[variable] = str(blas)
+
+        ## BLAS libraries already loaded (numpy) read the variables at import, threadpoolctl resizes them
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits = blas)
+            applied['blas'] = blas
+        except ImportError:
+            applied['blas'] = 'environment only (install threadpoolctl)'
+
+    if opencv is not None:
+        os.environ['OPENCV_FOR_THREADS_NUM'] = str(opencv)
+
+        if 'cv2' in sys.modules:
+            cv2 = sys.modules['cv2']
+            cv2.setNumThreads(opencv)
+            applied['opencv'] = cv2.getNumThreads()
+        else:
+            applied['opencv'] = opencv
+
+    if intra_op is not None or inter_op is not None:
+        if intra_op is not None:
+            os.environ['TF_NUM_INTRAOP_THREADS'] = str(intra_op)
+        if inter_op is not None:
+            os.environ['TF_NUM_INTEROP_THREADS'] = str(inter_op)
+
+        if 'tensorflow' in sys.modules:
+            tf = sys.modules['tensorflow']
+            try:
+                if intra_op is not None:
+                    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+                if inter_op is not None:
+                    tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+                applied['tf_applied'] = True
+            except RuntimeError:
+                applied['tf_applied'] = False
+
+            applied['intra_op'] = tf.config.threading.get_intra_op_parallelism_threads()
+            applied['inter_op'] = tf.config.threading.get_inter_op_parallelism_threads()
+        else:
+            applied.update({'tf_applied' : True, 'intra_op' : intra_op, 'inter_op' : inter_op})
+
+    return applied
+
+
+
+def get_dummy_inputs(model_key, batch_size = 1):
+    '''
+    Zero inputs of the production shapes of a serving model, e.g. (1, 5030) for the text model,
+    (1, 224, 224, 3) for the image pack and (1, 512) for the fusion head.
+    '''
+    compiled = pt.get_compiled_model(model_key)
+
+    return [np.zeros((batch_size,) + tuple(spec.shape[1:]), dtype = np.float32) for spec in compiled.input_signature]
+
+
+
+def warm_up_model(model_key, batch_sizes = (1,), nb_calls = 10):
+    '''
+    Load a model, run dummy inputs through its compiled graph, and time the first (cold) call
+    against the following (warm) calls, for each batch size.
+    '''
+    t0 = time.perf_counter()
+    compiled = pt.get_compiled_model(model_key)
+    load_time = time.perf_counter() - t0
+
+    rows = []
+    for batch_size in batch_sizes:
+        inputs = get_dummy_inputs(model_key, batch_size)
+
+        t0 = time.perf_counter()
+        compiled(inputs)
+        cold = time.perf_counter() - t0
+
+        warm = bt.time_calls(lambda: compiled(inputs), nb_calls = nb_calls, nb_warm_up = 0)['p50']
+
+        rows.append({'model' : model_key,
+                     'input_shapes' : ' '.join(str(tuple(x.shape)) for x in inputs),
+                     'load_s' : load_time,
+                     'cold_ms' : cold * 1000,
+                     'warm_ms' : warm * 1000,
+                     'cold_warm_ratio' : cold / warm if warm > 0 else float('nan')})
+        load_time = 0.0
+
+    return rows
+
+
+
+def warm_up_preprocessing(nb_calls = 5):
+    '''
+    Run a dummy product through the text and image preprocessing, which loads their lazy
+    dependencies (nltk, langid, bs4, cv2) and resources. Same cold / warm timing as warm_up_model.
+    '''
+    import cv2
+
+    image_bytes = cv2.imencode('.jpg', np.full((500, 500, 3), 255, dtype = np.uint8))[1].tobytes()
+    text_batch = pt.wrap_text_input('Lot de 2 coussins', '<p>Housse de coussin en coton</p>')
+
+    stages = {'text_preprocessing' : lambda: pt.get_text_features_batch(text_batch),
+              'image_preprocessing' : lambda: pt.preprocess_sample_images([image_bytes])}
+
+    rows = []
+    for name, function in stages.items():
+        t0 = time.perf_counter()
+        function()
+        cold = time.perf_counter() - t0
+
+        warm = bt.time_calls(function, nb_calls = nb_calls, nb_warm_up = 0)['p50']
+
+        rows.append({'model' : name, 'input_shapes' : '-', 'load_s' : 0.0,
+                     'cold_ms' : cold * 1000, 'warm_ms' : warm * 1000,
+                     'cold_warm_ratio' : cold / warm if warm > 0 else float('nan')})
+
+    return rows
+
+
+
+def apply_serving_profile(nb_workers = 1, model_keys = None, batch_sizes = (1,), warm_up = True, verbose = True):
+    '''
+    Pin the thread pools for nb_workers workers sharing the machine, load the fitted transformers
+    and pre-trace every serving model (and the fused model if it has been exported) with dummy inputs.
+    Returns {'threads' : applied thread counts, 'warm_up' : cold vs warm latency rows}.
+    '''
+    profile = get_thread_profile(nb_workers)
+    applied = configure_threads(**profile)
+
+    report = {'threads' : applied, 'warm_up' : []}
+
+    if warm_up:
+        if model_keys is None:
+            model_keys = list(pt.SERVING_MODELS)
+            if os.path.exists('./trained_models/' + pt.TRAINED_MODELS['fused']):
+                model_keys.append('fused')
+
+        pt.warm_up_transformers()
+        report['warm_up'] += warm_up_preprocessing()
+
+        for model_key in model_keys:
+            report['warm_up'] += warm_up_model(model_key, batch_sizes = batch_sizes)
+
+    if verbose:
+        print("Thread pools:", applied)
+        if report['warm_up']:
+            bt.print_report("Warm-up: cold (first call) vs warm (median) latency", report['warm_up'],
+                            ['model', 'input_shapes', 'load_s', 'cold_ms', 'warm_ms', 'cold_warm_ratio'])
+
+    return report
@@ -0,0 +1,221 @@
+'''
+Streaming bulk scoring of a product feed (X_test_update.csv-style file + image directory).
+
+The CSV is read in chunks of chunk_size rows. For every chunk the images
+image_<imageid>_product_<productid>.jpg are resolved in image_dir, the chunk goes through the batch
+prediction pipeline, and its predictions are appended to the output CSV. Rows without image file
+are classified by the text-only head (a text-only feed never loads VGG16), and with --feature-store,
+images whose features are in the feature store (same imageid / productid or same bytes) are not run
+through VGG16. Memory is bounded by the chunk size. Progress is checkpointed after every chunk in <output>.progress.json, so a crashed job
+restarts from the last completed chunk. Run from the streamlit folder, e.g.:
+    python scoring_tools.py ../data/X_test_update.csv ../data/images/image_test/ predictions.csv
+'''
+
+import os
+import json
+import time
+import argparse
+
+import pandas as pd
+
+import project_tools as pt
+
+
+
+def get_image_file(image_dir, imageid, productid):
+    return os.path.join(image_dir, "image_" + str(imageid) + "_product_" + str(productid) + ".jpg")
+
+
+
+def get_progress_file(output_file):
+    return output_file + '.progress.json'
+
+
+
+def load_progress(output_file):
+    '''
+    Checkpoint of a previous run on output_file ({} if the job starts from scratch).
+    '''
+    progress_file = get_progress_file(output_file)
+
+    if not os.path.exists(progress_file):
+        return {}
+
+    with open(progress_file, 'r') as f:
+        return json.load(f)
+
+
+
+def save_progress(output_file, progress):
+    '''
+    Write the checkpoint atomically (temporary file + rename), so a crash never leaves it half written.
+    '''
+    progress_file = get_progress_file(output_file)
+    tmp_file = progress_file + '.tmp'
+
+    with open(tmp_file, 'w') as f:
+        json.dump(progress, f, indent = 2)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_file, progress_file)
+
+
+
+def check_progress(progress, input_file, chunk_size):
+    '''
+    A job can only be resumed with the same input file and chunk size.
+    '''
+    if progress and (progress['input_file'] != os.path.abspath(input_file) or progress['chunk_size'] != chunk_size):
+        raise ValueError("%s was produced from %s with chunk_size = %d. Use the same arguments to resume, "
+                         "or restart = True to start from scratch."
+                         %(progress['output_file'], progress['input_file'], progress['chunk_size']))
+
+
+
+def get_output_columns(num = 3, use_cascade = False):
+    '''
+    Columns of the output CSV, the same for every chunk (they are written under the header of the first one).
+    '''
+    columns = ['productid', 'imageid']
+    for i in range(1, num + 1):
+        columns += ['pred_code_' + str(i), 'pred_class_' + str(i), 'confidence_' + str(i)]
+
+    return columns + (['cascade_stage'] if use_cascade else []) + ['modalities', 'image_found']
+
+
+
+def score_chunk(chunk, image_dir, num = 3, batch_size = 256, use_fused_model = False, use_cascade = False):
+    '''
+    Predictions of one chunk of the feed. Rows whose image file is missing (image_found = False)
+    are classified from their text only, rows without text from their image only, and rows with
+    neither get empty predictions.
+    With use_cascade = True the image branch only runs when the text prediction is not decisive.
+    The columns are get_output_columns(num, use_cascade), with integer codes.
+    '''
+    image_files = [get_image_file(image_dir, imageid, productid)
+                   for imageid, productid in zip(chunk['imageid'], chunk['productid'])]
+    image_found = pd.Series([os.path.exists(file) for file in image_files], index = chunk.index)
+
+    data = pd.DataFrame({'title' : chunk['designation'],
+                         'description' : chunk['description'],
+                         'image' : [file if found else None for file, found in zip(image_files, image_found)],
+                         'imageid' : chunk['imageid'],
+                         'productid' : chunk['productid']},
+                        index = chunk.index)
+
+    predictions = pt.get_modality_predictions(data = data, num = num, batch_size = batch_size,
+                                              use_fused_model = use_fused_model, use_cascade = use_cascade)
+
+    predictions['productid'] = chunk['productid']
+    predictions['imageid'] = chunk['imageid']
+    predictions['image_found'] = image_found
+
+    predictions = predictions.reindex(columns = get_output_columns(num, use_cascade))
+
+    ## missing codes (products with neither text nor image, num above the number of classes)
+    ## must not turn the others into floats
+    for i in range(1, num + 1):
+        predictions['pred_code_' + str(i)] = predictions['pred_code_' + str(i)].astype('Int64')
+
+    return predictions
+
+
+
+def score_file(input_file, image_dir, output_file, chunk_size = 1024, num = 3, batch_size = 256,
+               use_fused_model = False, use_cascade = False, restart = False, verbose = True):
+    '''
+    Score input_file chunk by chunk and append the predictions to output_file (indexed like the input).
+    Resumes from the last completed chunk unless restart = True. Returns the final checkpoint.
+    '''
+    progress = {} if restart else load_progress(output_file)
+    check_progress(progress, input_file, chunk_size)
+
+    if not progress:
+        progress = {'input_file' : os.path.abspath(input_file),
+                    'output_file' : os.path.abspath(output_file),
+                    'chunk_size' : chunk_size,
+                    'completed_chunks' : 0,
+                    'rows_written' : 0,
+                    'output_size' : 0,
+                    'finished' : False}
+
+    ## drop what a crashed run wrote after its last checkpoint
+    mode = 'r+b' if os.path.exists(output_file) else 'wb'
+    with open(output_file, mode) as f:
+        f.truncate(progress['output_size'])
+
+    if progress['finished']:
+        if verbose:
+            print("%s is complete (%d rows)" %(output_file, progress['rows_written']))
+        return progress
+
+    t0 = time.time()
+    reader = pd.read_csv(input_file, header = 0, index_col = 0, chunksize = chunk_size)
+
+    for i, chunk in enumerate(reader):
+        if i < progress['completed_chunks']:
+            continue
+
+        predictions = score_chunk(chunk, image_dir, num = num, batch_size = batch_size,
+                                  use_fused_model = use_fused_model, use_cascade = use_cascade)
+
+        with open(output_file, 'a', newline = '') as f:
+            predictions.to_csv(f, header = (progress['output_size'] == 0), index = True)
+            f.flush()
+            os.fsync(f.fileno())
+
+        progress['completed_chunks'] = i + 1
+        progress['rows_written'] += predictions.shape[0]
+        progress['output_size'] = os.path.getsize(output_file)
+        save_progress(output_file, progress)
+
+        if verbose:
+            print("Chunk %d: %d rows scored (%d without image), %d rows in total at %0.1f seconds"
+                  %(i, predictions.shape[0], (~predictions['image_found']).sum(), progress['rows_written'], time.time() - t0))
+
+    progress['finished'] = True
+    save_progress(output_file, progress)
+
+    store = pt.get_feature_store()
+    if store is not None:
+        store.sync()
+        if verbose:
+            print("Image feature store:", store.get_stats())
+
+    return progress
+
+
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(description = "Streaming bulk scoring of a product CSV and its image directory")
+    parser.add_argument('input_file', help = "X_test_update.csv-style file (designation, description, productid, imageid)")
+    parser.add_argument('image_dir', help = "directory with the image_<imageid>_product_<productid>.jpg files")
+    parser.add_argument('output_file')
+    parser.add_argument('--chunk-size', type = int, default = 1024)
+    parser.add_argument('--batch-size', type = int, default = 256)
+    parser.add_argument('--num', type = int, default = 3, help = "number of predicted classes per product")
+    parser.add_argument('--fused', action = 'store_true', help = "use the exported fused inference model")
+    parser.add_argument('--cascade', action = 'store_true', help = "skip the image branch when the text prediction is decisive")
+    parser.add_argument('--restart', action = 'store_true', help = "ignore the checkpoint and start from scratch")
+    parser.add_argument('--feature-store', action = 'store_true', help = "read and write the image features in the feature store")
+
+    return parser.parse_args(args)
+
+
+
+def main(args = None):
+
+    args = parse_args(args)
+
+    if args.feature_store:
+        pt.configure_feature_store(enabled = True)
+
+    return score_file(args.input_file, args.image_dir, args.output_file, chunk_size = args.chunk_size,
+                      num = args.num, batch_size = args.batch_size, use_fused_model = args.fused, use_cascade = args.cascade,
+                      restart = args.restart)
+
+
+
+if __name__ == '__main__':
+    main()
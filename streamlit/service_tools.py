@@ -0,0 +1,547 @@
+'''
+Standalone HTTP prediction service around the project_tools fusion pipeline.
+
+Concurrent requests are queued and grouped into micro-batches (up to max_batch_size products,
+waiting at most max_wait seconds after the first one) before going through the headless
+text / image models and the fusion head with a single predict call per model.
+The queue is bounded and every request has a deadline (see admission_tools): requests that cannot
+be served in time get a text-only prediction flagged "degraded": true, or a 503 when shed.
+
+Run from the streamlit folder:
+    python service_tools.py --port 8000 --max-batch-size 32 --max-wait-ms 10 --deadline-ms 2000
+
+Endpoints:
+    POST /predict   {"title": ..., "description": ..., "image": <base64 jpeg, optional>, "deadline_ms": ...}
+                    or {"products": [ {...}, {...} ], "deadline_ms": ...}
+    GET  /health
+    GET  /stats
+    GET  /metrics   queue depth, shed and degraded counts (Prometheus text format)
+'''
+
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pandas as pd
+
+import project_tools as pt
+import cache_tools as ct
+import runtime_tools as rtt
+import admission_tools as at
+
+
+
+
+def predict_products(products, num = 3):
+    '''
+    Run the fusion pipeline on a list of product dicts (title, description, image bytes).
+    Products without image (or without text) go through the single-modality head.
+    Returns one prediction dict per product.
+    '''
+    data = pd.DataFrame({'title' : [p['title'] for p in products],
+                         'description' : [p.get('description', '') for p in products],
+                         'image' : [p.get('image') for p in products]})
+
+    predictions = pt.get_modality_predictions(data = data, num = num, batch_size = max(len(products), 1))
+
+    return table_to_records(predictions, num)
+
+
+
+def predict_cascade_products(products, num = 3):
+    '''
+    Confidence-gated cascade on a list of product dicts: the image branch only runs for the products
+    whose text prediction is not decisive (see project_tools.get_cascade_predictions).
+    '''
+    data = pd.DataFrame({'title' : [p['title'] for p in products],
+                         'description' : [p.get('description', '') for p in products],
+                         'image' : [p.get('image') for p in products]})
+
+    predictions = pt.get_modality_predictions(data = data, num = num, batch_size = max(len(products), 1),
+                                              use_cascade = True)
+
+    return table_to_records(predictions, num)
+
+
+
+def predict_text_only_products(products, num = 3):
+    '''
+    Degraded predictions (text-only head, no image branch) of a list of product dicts.
+    '''
+    predictions = pt.get_text_only_predictions([p['title'] for p in products],
+                                               [p.get('description', '') for p in products],
+                                               num = num, batch_size = max(len(products), 1))
+
+    return table_to_records(predictions, num)
+
+
+
+def table_to_records(predictions, num):
+    '''
+    Convert the codes/classes/confidences table into JSON serializable dicts.
+    Products without prediction (neither text nor image) get empty lists.
+    '''
+    records = []
+    for _, row in predictions.iterrows():
+        k_range = [i for i in range(1, num + 1) if 'pred_code_' + str(i) in row.index and not pd.isna(row['pred_code_' + str(i)])]
+        records.append({'pred_codes' : [int(row['pred_code_' + str(i)]) for i in k_range],
+                        'pred_classes' : [str(row['pred_class_' + str(i)]) for i in k_range],
+                        'confidences' : [float(row['confidence_' + str(i)]) for i in k_range]})
+        for column in ['cascade_stage', 'modalities']:
+            if column in row.index and isinstance(row[column], str):
+                records[-1][column] = row[column]
+
+    return records
+
+
+
+class MicroBatcher:
+    '''
+    Queue single items submitted from many threads and process them in micro-batches.
+    predict_batch_fn takes a list of items and returns a list of results in the same order.
+    The queue holds at most max_queue_size items (0 = unbounded), submit raises queue.Full beyond.
+    Items whose future was cancelled while queued are skipped. When predict_batch_fn fails, the items
+    of the batch are run again one by one: only the items that fail alone get the exception.
+    '''
+
+    def __init__(self, predict_batch_fn, max_batch_size = 32, max_wait = 0.01, max_queue_size = 0):
+        self.predict_batch_fn = predict_batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue(maxsize = max_queue_size)
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests' : 0, 'batches' : 0, 'items' : 0, 'errors' : 0, 'retried_batches' : 0,
+                      'cancelled' : 0, 'busy_time' : 0.0, 'batch_time' : 0.0}
+
+        self._worker = threading.Thread(target = self._run, name = 'micro-batcher', daemon = True)
+        self._worker.start()
+
+
+    def submit(self, item):
+        '''
+        Enqueue an item, returns a Future with its result.
+        '''
+        future = Future()
+        self._queue.put_nowait((item, future))
+
+        with self._stats_lock:
+            self.stats['requests'] += 1
+
+        return future
+
+
+    def predict(self, item, timeout = None):
+        return self.submit(item).result(timeout = timeout)
+
+
+    def _collect_batch(self):
+        ## block until the first item arrives, then wait at most max_wait for more
+        try:
+            first = self._queue.get(timeout = 0.1)
+        except queue.Empty:
+            return []
+
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout = remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect_batch()
+
+            ## drop items cancelled by their caller (deadline passed) while they were queued
+            nb_collected = len(batch)
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+
+            with self._stats_lock:
+                self.stats['cancelled'] += nb_collected - len(batch)
+
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            t0 = time.perf_counter()
+            try:
+                results = self.predict_batch_fn(items)
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            except Exception as error:
+                self._run_one_by_one(items, futures, error)
+
+            batch_time = time.perf_counter() - t0
+
+            with self._stats_lock:
+                self.stats['batches'] += 1
+                self.stats['items'] += len(items)
+                self.stats['busy_time'] += batch_time
+                ## moving average of the batch service time, used to estimate queueing delays
+                self.stats['batch_time'] = batch_time if self.stats['batches'] == 1 else \
+                                           0.8 * self.stats['batch_time'] + 0.2 * batch_time
+
+
+    def _run_one_by_one(self, items, futures, error):
+        '''
+        The batch failed (e.g. a corrupt image): run its items again one by one, so that only
+        the futures of the faulty items get an exception.
+        '''
+        if len(items) == 1:
+            futures[0].set_exception(error)
+            with self._stats_lock:
+                self.stats['errors'] += 1
+            return
+
+        with self._stats_lock:
+            self.stats['retried_batches'] += 1
+
+        for item, future in zip(items, futures):
+            try:
+                future.set_result(self.predict_batch_fn([item])[0])
+            except Exception as item_error:
+                future.set_exception(item_error)
+                with self._stats_lock:
+                    self.stats['errors'] += 1
+
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+
+    def get_batch_time(self):
+        with self._stats_lock:
+            return self.stats['batch_time']
+
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+
+        stats['queue_depth'] = self._queue.qsize()
+        stats['mean_batch_size'] = stats['items'] / stats['batches'] if stats['batches'] else 0.0
+        stats['max_batch_size'] = self.max_batch_size
+        stats['max_wait'] = self.max_wait
+
+        return stats
+
+
+    def stop(self):
+        self._stop.set()
+        self._worker.join()
+
+
+
+def decode_product(payload):
+    '''
+    Product dict from a JSON payload: the image is sent base64 encoded and is optional.
+    Raises ValueError for a product with neither text nor image (nothing to classify).
+    '''
+    product = {'title' : payload.get('title', ''),
+               'description' : payload.get('description', ''),
+               'image' : base64.b64decode(payload['image']) if payload.get('image') else None}
+
+    if pt.get_product_modality(product['title'], product['description'], product['image']) == 'none':
+        raise ValueError("the product has neither text nor image")
+
+    return product
+
+
+
+def predict_with_cache(admission, cache, product, deadline):
+    '''
+    Prediction of one product through the content-hash cache, computed through admission control
+    on a miss. Degraded predictions are not cached.
+    '''
+    return predict_many_with_cache(admission, cache, [product], deadline)[0]
+
+
+
+def predict_many_with_cache(admission, cache, products, deadline):
+    '''
+    Predictions of a list of products through the content-hash cache: all the keys are looked up
+    first, and the misses go through admission control as one group (they share micro-batches
+    instead of queueing one product at a time). Degraded predictions are not cached.
+    '''
+    if cache is None:
+        return admission.predict_many(products, deadline = deadline)
+
+    keys = [ct.get_product_key(product['title'], product['description'], product['image']) for product in products]
+
+    return cache.get_or_compute_many(keys,
+                                     lambda positions: admission.predict_many([products[i] for i in positions], deadline = deadline),
+                                     cacheable = lambda prediction: not prediction.get('degraded'))
+
+
+
+def get_metrics(admission, cache = None):
+    '''
+    Service metrics in the Prometheus text exposition format.
+    '''
+    stats = admission.get_stats()
+    batcher_stats = admission.batcher.get_stats()
+
+    lines = ['# TYPE rakuten_queue_depth gauge', 'rakuten_queue_depth %d' %stats['queue_depth'],
+             '# TYPE rakuten_estimated_wait_seconds gauge', 'rakuten_estimated_wait_seconds %f' %stats['estimated_wait'],
+             '# TYPE rakuten_requests_total counter', 'rakuten_requests_total %d' %stats['requests'],
+             '# TYPE rakuten_admitted_total counter', 'rakuten_admitted_total %d' %stats['admitted'],
+             '# TYPE rakuten_deadline_missed_total counter', 'rakuten_deadline_missed_total %d' %stats['deadline_missed'],
+             '# TYPE rakuten_batches_total counter', 'rakuten_batches_total %d' %batcher_stats['batches'],
+             '# TYPE rakuten_shed_total counter', '# TYPE rakuten_degraded_total counter']
+
+    lines += ['rakuten_shed_total{reason="%s"} %d' %(reason, count) for reason, count in stats['shed'].items()]
+    lines += ['rakuten_degraded_total{reason="%s"} %d' %(reason, count) for reason, count in stats['degraded'].items()]
+
+    if cache is not None:
+        cache_stats = cache.get_stats()
+        lines += ['# TYPE rakuten_cache_hits_total counter', 'rakuten_cache_hits_total %d' %cache_stats['hits']]
+
+    return '\n'.join(lines) + '\n'
+
+
+
+def make_handler(admission, cache = None):
+
+    batcher = admission.batcher
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, body, headers = None):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status' : 'ok'})
+            elif self.path == '/stats':
+                stats = batcher.get_stats()
+                stats['admission'] = admission.get_stats()
+                if cache is not None:
+                    stats['cache'] = cache.get_stats()
+                self._send_json(200, stats)
+            elif self.path == '/metrics':
+                content = get_metrics(admission, cache).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self._send_json(404, {'error' : 'unknown endpoint'})
+
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json(404, {'error' : 'unknown endpoint'})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length))
+
+                if 'products' in payload:
+                    products = [decode_product(p) for p in payload['products']]
+                else:
+                    products = [decode_product(payload)]
+
+                timeout = float(payload['deadline_ms']) / 1000 if 'deadline_ms' in payload else None
+            except (ValueError, KeyError, TypeError) as error:
+                self._send_json(400, {'error' : 'invalid request: %s' % error})
+                return
+
+            deadline = admission.get_deadline(timeout)
+
+            try:
+                ## every product not in the cache joins the shared micro-batch queue
+                predictions = predict_many_with_cache(admission, cache, products, deadline)
+            except at.RequestShed as error:
+                self._send_json(503, {'error' : str(error), 'reason' : error.reason}, headers = {'Retry-After' : '1'})
+                return
+            except Exception as error:
+                self._send_json(500, {'error' : str(error)})
+                return
+
+            if 'products' in payload:
+                self._send_json(200, {'predictions' : predictions})
+            else:
+                self._send_json(200, predictions[0])
+
+
+        def log_message(self, format, *args):
+            return      # keep the console quiet under load
+
+    return PredictionHandler
+
+
+
+def create_server(host = '127.0.0.1', port = 8000, max_batch_size = 32, max_wait = 0.01,
+                  predict_batch_fn = None, cache_size = 4096, cache_ttl = 24 * 3600,
+                  max_queue_size = 256, deadline = 10.0, degraded_fn = None, degrade = True):
+    '''
+    Build the HTTP server, its micro-batcher and its admission control. Use port = 0 to pick a free port.
+    Predictions are cached by product content (cache_size = 0 disables the cache).
+    At most max_queue_size products wait for the pipeline and requests have deadline seconds by default.
+    Late requests get text-only predictions if degrade = True and the text-only head is available,
+    otherwise they are shed (HTTP 503).
+    '''
+    if predict_batch_fn is None:
+        predict_batch_fn = predict_products
+
+    if degraded_fn is None and degrade:
+        if pt.is_model_available('text_head'):
+            degraded_fn = predict_text_only_products
+        else:
+            print("No text-only head (head_tools.train_modality_head): late requests are shed instead of degraded")
+
+    batcher = MicroBatcher(predict_batch_fn, max_batch_size = max_batch_size, max_wait = max_wait,
+                           max_queue_size = max_queue_size)
+    admission = at.AdmissionController(batcher, degraded_fn = degraded_fn if degrade else None,
+                                       max_queue_size = max_queue_size, default_deadline = deadline)
+    cache = ct.PredictionCache(max_size = cache_size, ttl = cache_ttl) if cache_size > 0 else None
+
+    server = ThreadingHTTPServer((host, port), make_handler(admission, cache))
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.admission = admission
+    server.cache = cache
+
+    return server
+
+
+
+def start_server_in_thread(**kwargs):
+    '''
+    Start the service in a background thread (local testing). Returns (server, base_url).
+    Stop it with server.shutdown().
+    '''
+    server = create_server(**kwargs)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+
+    host, port = server.server_address[:2]
+
+    return server, 'http://%s:%d' % (host, port)
+
+
+
+class PredictionClient:
+    '''
+    Minimal stdlib client of the prediction service.
+    '''
+
+    def __init__(self, base_url, timeout = 60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+
+    def _request(self, path, payload = None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data = data,
+                                         headers = {'Content-Type' : 'application/json'})
+
+        with urllib.request.urlopen(request, timeout = self.timeout) as response:
+            return json.loads(response.read())
+
+
+    def predict(self, title, description, image_bytes = None):
+        payload = {'title' : title,
+                   'description' : description}
+        if image_bytes is not None:
+            payload['image'] = base64.b64encode(image_bytes).decode('ascii')
+
+        return self._request('/predict', payload)
+
+
+    def predict_many(self, products):
+        payload = {'products' : [{'title' : p['title'],
+                                  'description' : p.get('description', ''),
+                                  'image' : base64.b64encode(p['image']).decode('ascii') if p.get('image') else None}
+                                 for p in products]}
+
+        return self._request('/predict', payload)['predictions']
+
+
+    def health(self):
+        return self._request('/health')
+
+
+    def stats(self):
+        return self._request('/stats')
+
+
+
+def parse_args(args = None):
+
+    parser = argparse.ArgumentParser(description = 'Fusion model HTTP prediction service.')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--max-batch-size', type = int, default = 32)
+    parser.add_argument('--max-wait-ms', type = float, default = 10.0)
+    parser.add_argument('--cache-size', type = int, default = 4096, help = 'max cached predictions, 0 to disable')
+    parser.add_argument('--cache-ttl', type = float, default = 24 * 3600, help = 'cached predictions time-to-live (s)')
+    parser.add_argument('--no-warm-up', action = 'store_true', help = 'load models on the first request')
+    parser.add_argument('--nb-workers', type = int, default = 1, help = 'processes sharing the cores (sizes the thread pools)')
+    parser.add_argument('--max-queue-size', type = int, default = 256, help = 'max products waiting for the pipeline')
+    parser.add_argument('--deadline-ms', type = float, default = 10000.0, help = 'default request deadline')
+    parser.add_argument('--no-degrade', action = 'store_true', help = 'shed late requests instead of text-only predictions')
+    parser.add_argument('--cascade', action = 'store_true', help = 'skip the image branch when the text prediction is decisive')
+    parser.add_argument('--feature-store', action = 'store_true', help = 'serve known images from the image feature store')
+
+    return parser.parse_args(args)
+
+
+
+def main(args = None):
+
+    args = parse_args(args)
+
+    if args.feature_store:
+        pt.configure_feature_store(enabled = True)
+
+    rtt.apply_serving_profile(nb_workers = args.nb_workers, warm_up = not args.no_warm_up)
+
+    server = create_server(args.host, args.port, max_batch_size = args.max_batch_size,
+                           max_wait = args.max_wait_ms / 1000,
+                           cache_size = args.cache_size, cache_ttl = args.cache_ttl,
+                           max_queue_size = args.max_queue_size, deadline = args.deadline_ms / 1000,
+                           degrade = not args.no_degrade,
+                           predict_batch_fn = predict_cascade_products if args.cascade else None)
+
+    print("Serving predictions on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.stop()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,22 @@
+import os
 import streamlit as st
 import pandas as pd
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
-import seaborn as sns
-sns.set()
 
 import project_tools as pt
+import runtime_tools as rtt
 
 
+## Serving runtime profile, applied once per process: thread pools sized for RAKUTEN_SESSIONS
+## concurrent sessions, and optional eager warm-up of the serving models (set RAKUTEN_WARM_UP=1).
+## The registry in project_tools keeps them loaded for the whole process.
+@st.cache_resource
+def apply_serving_profile():
+    return rtt.apply_serving_profile(nb_workers = int(os.environ.get('RAKUTEN_SESSIONS', '2')),
+                                     warm_up = os.environ.get('RAKUTEN_WARM_UP', '0') == '1')
+
+apply_serving_profile()
+
 
 st.title("Multimodal Product Data Classification")
 
@@ -105,7 +113,8 @@ if page == 'Try it!':
         # st.write(pt.get_image_hl_model_output(sample_image).shape)
         # st.write(pt.get_text_hl_model_output(sample_title, sample_description).shape)
         with st.spinner('Wait for it...'):        
-            sample_pred_codes, sample_pred_classes, pred_confidences = pt.get_predictions(sample_title, sample_description, sample_image)
+            sample_pred_codes, sample_pred_classes, pred_confidences, timings = pt.get_cached_predictions(sample_title, sample_description, 
+                                                                                                         sample_image, return_timings = True)
         
         # @st.cache_data()
         st.markdown("#### Top 3 predictions:")
@@ -115,6 +124,11 @@ if page == 'Try it!':
             st.success(f'**{np.round(float(pred_confidences[i])*100, 2)} %** confidence of \
                     being category "**{sample_pred_classes[i]} ({sample_pred_codes[i]})**"', icon="✅")
 
+        ## products without image (or text) go through a single-modality head instead of the fusion head
+        head = next((key for key in ['text_head', 'image_head'] if key in timings), 'fusion')
+        st.caption("Prediction time: %0.2f s (computed in %0.2f s: text branch %0.2f s, image branch %0.2f s, %s %0.2f s)" 
+                   %(timings['served'], timings['total'], timings['text_branch'], timings['image_branch'], head.replace('_', ' '), timings[head]))
+
         # st.write("Predicted class code:", sample_pred_codes)
         # st.write("Predicted class name:", sample_pred_classes)
         # st.write("Predicted class name:", pred_confidences) 
@@ -122,7 +136,8 @@ if page == 'Try it!':
 
         # @st.cache_data()
         with st.expander("Product Summary", expanded = True): 
-            st.image(sample_image, width = 400)
+            if sample_image is not None:
+                st.image(sample_image, width = 400)
             st.markdown(f"**Title:** {sample_title}")
             st.markdown(f"**Description:** {sample_description}")
  
@@ -0,0 +1,9 @@
+'''
+The streamlit tools are imported as top-level modules (run from the streamlit folder):
+make them importable from the tests, whatever the working directory of pytest.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
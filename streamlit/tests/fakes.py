@@ -0,0 +1,49 @@
+'''
+Stand-ins for the trained models in the tests: prediction tables with the columns of
+project_tools.get_decoded_batch_predictions.
+'''
+
+import numpy as np
+import pandas as pd
+
+import FusionModel_withVGG_tools as fm
+
+
+
+def make_prediction_table(nb_rows, index = None, num = 3, first_code = 10):
+    table = {}
+    for i in range(1, num + 1):
+        table['pred_code_' + str(i)] = [first_code + i] * nb_rows
+        table['pred_class_' + str(i)] = ['class_%d' %(first_code + i)] * nb_rows
+        table['confidence_' + str(i)] = [1.0 / (i + 1)] * nb_rows
+
+    return pd.DataFrame(table, index = index)
+
+
+
+def patch_modality_heads(monkeypatch, pt):
+    '''
+    Replace the text-only, image-only, fusion and cascade predictions of project_tools
+    (codes 11.. for text, 21.. for image, 31.. for text + image), and its label decoder.
+    '''
+    target_encoder = type('TargetEncoder', (), {'classes_' : np.array([10, 40, 50])})()
+    product_class = pd.DataFrame({'prdtypecode' : [10, 40, 50], 'prodtype' : ['livre', 'jeu', 'console']})
+    monkeypatch.setattr(pt, 'get_label_decoder', lambda: fm.LabelDecoder(target_encoder, product_class))
+
+    monkeypatch.setattr(pt, 'get_text_only_predictions',
+                        lambda titles, descriptions = None, num = 3, batch_size = 256, index = None:
+                        make_prediction_table(len(titles), index, num, first_code = 10))
+    monkeypatch.setattr(pt, 'get_image_only_predictions',
+                        lambda images, num = 3, batch_size = 256, index = None, image_ids = None:
+                        make_prediction_table(len(images), index, num, first_code = 20))
+
+    def fusion(data = None, num = 3, batch_size = 256, verbose = False, **kwargs):
+        return make_prediction_table(data.shape[0], data.index, num, first_code = 30)
+
+    def cascade(data = None, num = 3, batch_size = 256, verbose = False, **kwargs):
+        predictions = make_prediction_table(data.shape[0], data.index, num, first_code = 30)
+        predictions['cascade_stage'] = 'fusion'
+        return predictions
+
+    monkeypatch.setattr(pt, 'get_batch_predictions', fusion)
+    monkeypatch.setattr(pt, 'get_cascade_predictions', cascade)
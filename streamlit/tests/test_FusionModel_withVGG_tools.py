@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+import FusionModel_withVGG_tools as fm
+
+
+
+class TargetEncoder:
+    ## fitted LabelEncoder: output index i is classes_[i]
+    classes_ = np.array([10, 40, 50, 60])
+
+
+
+PRODUCT_CLASS = pd.DataFrame({'prdtypecode' : [10, 40, 50], 'prodtype' : ['livre', 'jeu', 'console']})
+
+PRED_VECTORS = np.array([[0.12, 0.6, 0.2, 0.08],
+                         [0.05, 0.15, 0.3, 0.5],
+                         [0.7, 0.1, 0.15, 0.05]])
+
+
+
+def test_decode_gives_the_top_1_code_and_class():
+    decoder = fm.LabelDecoder(TargetEncoder(), PRODUCT_CLASS)
+
+    codes, classes = decoder.decode(PRED_VECTORS)
+
+    assert codes.tolist() == [40, 60, 10]
+    ## code 60 is missing from the product_class table
+    assert classes.tolist() == ['jeu', 'unknown', 'livre']
+
+
+
+def test_decode_accepts_a_single_vector():
+    codes, classes = fm.LabelDecoder(TargetEncoder(), PRODUCT_CLASS).decode(PRED_VECTORS[0])
+
+    assert codes.tolist() == [40] and classes.tolist() == ['jeu']
+
+
+
+def test_top_k_sorted_by_decreasing_confidence():
+    codes, classes, confidences = fm.LabelDecoder(TargetEncoder(), PRODUCT_CLASS).top_k(PRED_VECTORS, k = 3)
+
+    assert codes.tolist() == [[40, 50, 10], [60, 50, 40], [10, 50, 40]]
+    assert classes.tolist() == [['jeu', 'console', 'livre'], ['unknown', 'console', 'jeu'], ['livre', 'console', 'jeu']]
+    assert np.allclose(confidences, [[0.6, 0.2, 0.12], [0.5, 0.3, 0.15], [0.7, 0.15, 0.1]])
+
+    ## same order as a full sort of each row
+    assert (codes == TargetEncoder.classes_[np.argsort(-PRED_VECTORS, axis = 1)[:, :3]]).all()
+
+
+
+def test_top_k_larger_than_the_number_of_classes():
+    codes, _, confidences = fm.LabelDecoder(TargetEncoder(), PRODUCT_CLASS).top_k(PRED_VECTORS[:1], k = 10)
+
+    assert codes.shape == (1, 4) and codes.tolist() == [[40, 50, 10, 60]]
+    assert np.all(np.diff(confidences, axis = 1) <= 0)
+
+
+
+def test_decoder_from_the_product_class_file(tmp_path):
+    path = tmp_path / 'product_class.csv'
+    PRODUCT_CLASS.to_csv(path, sep = ';', index = False)
+    decoder = fm.get_label_decoder(TargetEncoder(), path)
+
+    code, pred_class = fm.decode_predictions(PRED_VECTORS[1:], TargetEncoder(), decoder = decoder)
+
+    assert code == 60 and pred_class.tolist() == ['unknown']
@@ -0,0 +1,109 @@
+import queue
+from concurrent.futures import Future
+
+import pytest
+
+import admission_tools as at
+
+
+
+class FakeBatcher:
+    '''
+    MicroBatcher interface with a settable queue depth and batch time. submit() answers at once
+    unless hang = True (future never completed) or raises queue.Full when full = True.
+    '''
+
+    def __init__(self, depth = 0, batch_time = 0.01, hang = False, full = False):
+        self.depth = depth
+        self.batch_time = batch_time
+        self.hang = hang
+        self.full = full
+        self.max_batch_size = 8
+        self.max_wait = 0.005
+        self.futures = []
+
+
+    def queue_depth(self):
+        return self.depth
+
+
+    def get_batch_time(self):
+        return self.batch_time
+
+
+    def submit(self, product):
+        if self.full:
+            raise queue.Full()
+
+        future = Future()
+        if not self.hang:
+            future.set_result({'pred_codes' : [10], 'modalities' : ['text', 'image']})
+        self.futures.append(future)
+
+        return future
+
+
+
+def degraded_fn(products):
+    return [{'pred_codes' : [40], 'modalities' : ['text', 'image']} for _ in products]
+
+
+
+def test_admitted_requests_are_served_by_the_batcher():
+    controller = at.AdmissionController(FakeBatcher(), degraded_fn = degraded_fn)
+
+    results = controller.predict_many([{'title' : 'a'}, {'title' : 'b'}])
+
+    assert [result['pred_codes'] for result in results] == [[10], [10]]
+    assert all(result['degraded'] is False for result in results)
+    assert controller.get_stats()['served'] == 2
+
+
+
+@pytest.mark.parametrize('batcher, reason', [(FakeBatcher(depth = 4), 'queue_full'),
+                                             (FakeBatcher(full = True), 'queue_full'),
+                                             (FakeBatcher(batch_time = 60.0), 'deadline')])
+def test_refused_requests_are_degraded_to_text_only(batcher, reason):
+    controller = at.AdmissionController(batcher, degraded_fn = degraded_fn, max_queue_size = 4)
+
+    result = controller.predict({'title' : 'a'}, deadline = controller.get_deadline(1.0))
+
+    assert result['degraded'] is True and result['degraded_reason'] == reason
+    assert result['modalities'] == ['text'] and result['pred_codes'] == [40]
+    assert controller.get_stats()['degraded'] == {reason : 1}
+
+
+
+def test_missed_deadline_cancels_the_queued_item():
+    batcher = FakeBatcher(hang = True)
+    controller = at.AdmissionController(batcher, degraded_fn = degraded_fn)
+
+    result = controller.predict({'title' : 'a'}, deadline = controller.get_deadline(0.05))
+
+    assert result['degraded_reason'] == 'deadline_missed'
+    assert batcher.futures[0].cancelled()
+    assert controller.get_stats()['deadline_missed'] == 1
+
+
+
+def test_requests_are_shed_without_degraded_path():
+    controller = at.AdmissionController(FakeBatcher(depth = 4), max_queue_size = 4)
+
+    with pytest.raises(at.RequestShed) as error:
+        controller.predict_many([{'title' : 'a'}, {'title' : 'b'}])
+
+    assert error.value.reason == 'queue_full'
+    stats = controller.get_stats()
+    assert stats['shed'] == {'queue_full' : 2} and stats['shed_total'] == 2
+
+
+
+def test_requests_are_shed_when_degraded_path_is_busy():
+    controller = at.AdmissionController(FakeBatcher(depth = 4), degraded_fn = degraded_fn, max_queue_size = 4,
+                                        max_degraded_inflight = 1)
+    controller._degraded_slots.acquire()
+
+    with pytest.raises(at.RequestShed) as error:
+        controller.predict({'title' : 'a'})
+
+    assert error.value.reason == 'degraded_path_busy'
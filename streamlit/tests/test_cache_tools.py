@@ -0,0 +1,109 @@
+import time
+import threading
+
+import pytest
+
+import cache_tools as ct
+
+
+
+def test_product_key_normalizes_text():
+    key = ct.get_product_key('  Piscine   GONFLABLE ', None, b'jpeg')
+
+    assert key == ct.get_product_key('piscine gonflable', '', b'jpeg')
+    assert key != ct.get_product_key('piscine gonflable', '', b'other')
+    assert key != ct.get_product_key('piscine gonflable', '', None)
+
+
+
+def test_lru_eviction():
+    cache = ct.PredictionCache(max_size = 2, ttl = None)
+    for key in ['a', 'b']:
+        cache.get_or_compute(key, lambda: key.upper())
+
+    cache.get_or_compute('a', lambda: 'recomputed')     # 'a' becomes the most recent
+    cache.get_or_compute('c', lambda: 'C')              # evicts 'b'
+
+    assert cache.get_or_compute('a', lambda: 'recomputed') == 'A'
+    assert cache.get_or_compute('b', lambda: 'recomputed') == 'recomputed'
+    assert cache.get_stats()['evictions'] == 2
+
+
+
+def test_ttl_expiration():
+    cache = ct.PredictionCache(max_size = 10, ttl = 0.05)
+    cache.get_or_compute('a', lambda: 1)
+
+    assert cache.get_or_compute('a', lambda: 2) == 1
+    time.sleep(0.1)
+    assert cache.get_or_compute('a', lambda: 3) == 3
+    assert cache.get_stats()['expirations'] == 1
+
+
+
+def test_uncacheable_values_are_not_stored():
+    cache = ct.PredictionCache()
+    cache.get_or_compute('a', lambda: {'degraded' : True}, cacheable = lambda value: not value['degraded'])
+
+    assert cache.get_stats()['size'] == 0
+
+
+
+def test_inflight_requests_are_coalesced():
+    cache = ct.PredictionCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    results = []
+    owner = threading.Thread(target = lambda: results.append(cache.get_or_compute('a', compute)))
+    owner.start()
+    started.wait(5)
+
+    waiters = [threading.Thread(target = lambda: results.append(cache.get_or_compute('a', compute))) for _ in range(4)]
+    for thread in waiters:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [owner] + waiters:
+        thread.join(5)
+
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+    assert cache.get_stats()['coalesced'] == 4
+
+
+
+def test_get_or_compute_many_computes_misses_together():
+    cache = ct.PredictionCache()
+    cache.get_or_compute('b', lambda: 'B')
+    calls = []
+
+    def compute_many(positions):
+        calls.append(positions)
+        return [keys[i].upper() for i in positions]
+
+    keys = ['a', 'b', 'c', 'a']
+    values = cache.get_or_compute_many(keys, compute_many)
+
+    assert values == ['A', 'B', 'C', 'A']
+    assert calls == [[0, 2]]
+
+
+
+def test_failed_computation_is_not_cached():
+    cache = ct.PredictionCache()
+
+    def fail(positions):
+        raise RuntimeError('pipeline down')
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute_many(['a', 'b'], fail)
+
+    assert cache.get_or_compute_many(['a', 'b'], lambda positions: ['x'] * len(positions)) == ['x', 'x']
+    assert cache.get_stats()['inflight'] == 0
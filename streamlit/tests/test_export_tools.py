@@ -0,0 +1,70 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+et = pytest.importorskip('export_tools', exc_type = ImportError)
+
+
+
+class FakeInterpreter:
+    '''
+    Interpreter whose invoke fails if another call is using the tensors at the same time.
+    '''
+
+    def __init__(self):
+        self.busy = False
+        self.x = None
+
+    def resize_tensor_input(self, index, shape):
+        pass
+
+    def allocate_tensors(self):
+        pass
+
+    def set_tensor(self, index, x):
+        assert not self.busy
+        self.busy = True
+        self.x = x
+
+    def invoke(self):
+        time.sleep(0.001)
+
+    def get_tensor(self, index):
+        output = self.x.sum(axis = 1, keepdims = True)
+        self.busy = False
+        return output
+
+
+
+def make_predictor():
+    predictor = object.__new__(et.TFLitePredictor)
+    predictor.interpreter = FakeInterpreter()
+    predictor.batch_size = 4
+    predictor.input_index = predictor.output_index = 0
+    predictor.output_shape = (1,)
+    predictor._batch_dim = None
+    predictor._lock = threading.Lock()
+
+    return predictor
+
+
+
+def test_tflite_predictor_serializes_concurrent_calls():
+    predictor = make_predictor()
+    inputs = [np.full((3, 2), i, dtype = np.float32) for i in range(32)]
+
+    with ThreadPoolExecutor(8) as pool:
+        outputs = list(pool.map(predictor.predict, inputs))
+
+    for i, output in enumerate(outputs):
+        assert np.array_equal(output, np.full((3, 1), 2 * i))
+
+
+
+def test_tflite_predictor_empty_input():
+    output = make_predictor().predict(np.empty((0, 2), dtype = np.float32))
+
+    assert output.shape == (0, 1)
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pytest
+
+import feature_store_tools as fst
+
+
+
+def test_round_trip_and_reopen(tmp_path):
+    store = fst.FeatureStore(str(tmp_path), model_signature = 'vgg:1')
+    features = np.arange(12, dtype = np.float32).reshape(3, 4)
+    store.put([[fst.get_id_key(1, 10), fst.get_content_key(b'a')], [fst.get_content_key(b'b')], [fst.get_id_key(3, 30)]],
+              features)
+
+    found_features, found = store.lookup([[fst.get_content_key(b'a')], [fst.get_content_key(b'unknown')], [fst.get_id_key(3, 30)]])
+
+    assert found.tolist() == [True, False, True]
+    assert np.array_equal(found_features[0], features[0]) and np.array_equal(found_features[2], features[2])
+    assert not found_features[1].any()
+
+    store.sync()
+    reopened = fst.FeatureStore(str(tmp_path), model_signature = 'vgg:1')
+    assert reopened.dim == 4
+    assert np.array_equal(reopened.lookup([[fst.get_id_key(1, 10)]])[0][0], features[0])
+
+
+
+def test_store_of_another_model_is_refused(tmp_path):
+    fst.FeatureStore(str(tmp_path), dim = 4, model_signature = 'vgg:1')
+
+    with pytest.raises(ValueError):
+        fst.FeatureStore(str(tmp_path), model_signature = 'vgg:2')
+
+    assert fst.get_store_directory('store', 'vgg:1') != fst.get_store_directory('store', 'vgg:2')
+
+
+
+def test_size_bound(tmp_path):
+    store = fst.FeatureStore(str(tmp_path), max_rows = 3)
+    store.put([['a'], ['b']], np.ones((2, 2)))
+    store.put([['c'], ['d']], np.ones((2, 2)))
+    store.put([['e']], np.ones((1, 2)))
+
+    assert len(store) == 3
+    assert store.lookup([['c'], ['d'], ['e']])[1].tolist() == [True, False, False]
+    assert store.get_stats()['not_written'] == 2
+
+
+
+def test_fsync_is_batched(tmp_path):
+    store = fst.FeatureStore(str(tmp_path), sync_rows = 4, sync_interval = 3600)
+    for i in range(6):
+        store.put([['key %d' %i]], np.full((1, 2), i))
+
+    assert store.get_stats()['syncs'] == 1
+    store.sync()
+    assert store.get_stats()['syncs'] == 2
+
+
+
+def test_index_past_the_end_of_the_features_is_ignored(tmp_path):
+    store = fst.FeatureStore(str(tmp_path))
+    store.put([['a']], np.ones((1, 2)))
+
+    ## rows lost by a power failure after the index was written
+    with open(store.index_file, 'a') as index:
+        index.write('b\t5\n')
+
+    reopened = fst.FeatureStore(str(tmp_path))
+    assert reopened.lookup([['a'], ['b']])[1].tolist() == [True, False]
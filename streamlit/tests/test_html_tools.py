@@ -0,0 +1,53 @@
+import pytest
+
+import html_tools as htt
+
+pytest.importorskip('bs4')
+pytest.importorskip('lxml')
+
+
+
+## (text, path expected from get_path)
+FIXTURES = [('Livre de cuisine', 'plain'),
+            ('  \n\tJeu de société  ', 'plain'),
+            ('', 'plain'),
+            ('   ', 'plain'),
+            ('Caf&eacute; cr&egrave;me &amp; gla&ccedil;on &oelig;uf', 'stripped'),
+            ('Prix : 10&#8364; ou 12&#x24;', 'stripped'),
+            ('<p>Console <b>portable</b></p><ul><li>écran</li><li>manette</li></ul>', 'stripped'),
+            ('Taille<br />42<br>cm<hr/>fin', 'stripped'),
+            ('<a href="x?a=1&amp;b=2" title="a > b">lien</a> suite', 'stripped'),
+            ('<div><span>unclosed <i>italique</div>', 'lxml'),
+            ('<table><tr><td>a</td><td>b</td></tr></table>', 'lxml'),
+            ('avant<script>var x = "<b>";</script>après', 'lxml'),
+            ('texte <!-- commentaire --> fin', 'lxml'),
+            ('3 < 5 et 7 > 2', 'lxml'),
+            ('R&D &copy &unknown; &#0;', 'lxml'),
+            ('ligne\r\nsuivante', 'stripped'),
+            ('\ufeffbyte order mark', 'lxml'),
+            ('contrôle\x07 caractère', 'lxml'),
+            ('<P>MAJUSCULES <B>Gras</B></P>', 'stripped')]
+
+
+
+@pytest.mark.parametrize('text, path', FIXTURES)
+def test_parse_html_matches_beautifulsoup(text, path):
+    from bs4 import BeautifulSoup
+
+    assert htt.parse_html([text], lower = False) == [BeautifulSoup(text, 'lxml').get_text()]
+    assert htt.parse_html([text]) == [BeautifulSoup(text, 'lxml').get_text().lower()]
+
+
+
+@pytest.mark.parametrize('text, path', FIXTURES)
+def test_each_fixture_takes_its_path(text, path):
+    assert htt.get_path(text) == path
+
+
+
+def test_check_parity_report():
+    report = htt.check_parity([text for text, _ in FIXTURES], verbose = False)
+
+    assert report['mismatches'] == []
+    assert sum(report['paths'].values()) == len(FIXTURES)
+    assert all(report['paths'][path] > 0 for path in ['plain', 'stripped', 'lxml'])
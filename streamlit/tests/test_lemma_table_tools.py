@@ -0,0 +1,66 @@
+import pickle
+
+import lemma_table_tools as ltt
+
+
+
+class FakeLemmatizer:
+    '''
+    Drops a final 's', counts its calls.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+
+    def lemmatize(self, token):
+        self.calls += 1
+        return token[:-1] if token.endswith('s') else token
+
+
+
+def test_lemmas_are_computed_once_per_token():
+    lemmatizer = FakeLemmatizer()
+    table = ltt.LemmaTable(lemmatizer = lemmatizer)
+
+    assert table.lemmatize_tokens(['livres', 'jeux', 'livres', 'livre']) == ['livre', 'jeux', 'livre', 'livre']
+    assert lemmatizer.calls == 3
+    assert len(table) == 3 and table.get_stats()['added'] == 3
+
+
+
+def test_frozen_table_does_not_grow():
+    lemmatizer = FakeLemmatizer()
+    table = ltt.LemmaTable({'livres' : 'livre'}, lemmatizer = lemmatizer).freeze()
+
+    assert table.lemmatize_tokens(['livres', 'consoles', 'consoles']) == ['livre', 'console', 'console']
+    assert len(table) == 1
+    assert lemmatizer.calls == 2
+    assert table.get_stats()['unknown'] == 2
+
+
+
+def test_added_lemmas_can_be_merged_into_another_table():
+    worker = ltt.LemmaTable({'a' : 'a'}, lemmatizer = FakeLemmatizer())
+    size = len(worker)
+    worker.lemmatize_tokens(['bus', 'cars'])
+
+    parent = ltt.LemmaTable({'a' : 'a'})
+    parent.merge(worker.get_added_since(size))
+
+    assert parent.lemmas == {'a' : 'a', 'bus' : 'bu', 'cars' : 'car'}
+
+
+
+def test_lemmatizer_is_not_pickled(tmp_path):
+    table = ltt.LemmaTable({'livres' : 'livre'}, lemmatizer = FakeLemmatizer())
+
+    copy = pickle.loads(pickle.dumps(table))
+
+    assert copy.lemmatizer is None and copy.lemmas == table.lemmas
+
+
+
+def test_load_missing_table(tmp_path):
+    table = ltt.load_lemma_table(str(tmp_path / 'missing'), frozen = True)
+
+    assert len(table) == 0 and table.frozen
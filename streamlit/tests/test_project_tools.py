@@ -0,0 +1,80 @@
+import numpy as np
+
+import project_tools as pt
+
+import fakes
+
+
+
+def test_single_modality_timings_use_head_stage(monkeypatch):
+    monkeypatch.setattr(pt, 'get_text_hl_model_output', lambda title, description: np.zeros((1, 4)))
+    monkeypatch.setattr(pt, 'get_head_pred_vectors', lambda modality, hl_output, batch_size = 256: np.eye(3)[:1])
+    monkeypatch.setattr(pt, 'get_decoded_predictions_with_confidence',
+                        lambda pred_vector, num = 3: ([10], ['livre'], [1.0]))
+
+    *_, timings = pt.get_single_modality_predictions('text', 'a title', '', None, return_timings = True)
+
+    assert timings['fusion'] == 0.0
+    assert timings['text_head'] >= 0.0
+    assert 'image_head' not in timings
+
+
+
+def test_registered_model_is_not_replaced_by_its_file(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'trained_models').mkdir()
+    model = object()
+
+    try:
+        pt.register_trained_model('fusion', model)
+        (tmp_path / 'trained_models' / pt.TRAINED_MODELS['fusion']).write_bytes(b'weights')
+
+        assert pt.get_trained_model('fusion') is model
+    finally:
+        pt._model_registry.evict('fusion')
+
+
+
+def test_products_frame_without_images_is_text_only():
+    data = pt.get_products_frame(['a title', 'another'], ['', 'description'])
+
+    assert list(data.columns) == ['title', 'description', 'image']
+    assert data['image'].isna().all()
+    assert [pt.get_product_modality(*row) for row in data.itertuples(index = False)] == ['text', 'text']
+
+
+
+def test_modality_predictions_of_empty_products(monkeypatch):
+    fakes.patch_modality_heads(monkeypatch, pt)
+
+    predictions = pt.get_modality_predictions(['a title', '', ''], ['', '', ''], [None, None, b'jpeg'], use_cascade = True)
+
+    assert list(predictions['modalities']) == ['text', 'none', 'image']
+    assert str(predictions['pred_code_1'].dtype) == 'Int64'
+    assert predictions['pred_code_1'].tolist()[0] == 11 and predictions['pred_code_1'].tolist()[2] == 21
+    assert predictions['pred_code_1'].isna().tolist() == [False, True, False]
+    assert predictions['cascade_stage'].isna().all()
+
+
+
+def test_feature_store_is_off_by_default_and_bound_to_the_model_file(tmp_path, monkeypatch):
+    assert pt.get_feature_store() is None
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'trained_models').mkdir()
+    model_file = tmp_path / 'trained_models' / pt.TRAINED_MODELS['hl_img_model']
+    model_file.write_bytes(b'weights v1')
+
+    try:
+        pt.configure_feature_store(path = str(tmp_path / 'store'), enabled = True)
+        first = pt.get_feature_store()
+        first.put([['a']], np.ones((1, 2)))
+
+        ## retrained model saved under the same name
+        model_file.write_bytes(b'weights v2, retrained')
+        second = pt.get_feature_store()
+
+        assert second is not first and second.path != first.path
+        assert not second.lookup([['a']])[1].any()
+    finally:
+        pt.configure_feature_store(enabled = False)
@@ -0,0 +1,73 @@
+import os
+
+import registry_tools as rt
+
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+
+def test_resource_is_loaded_once(tmp_path):
+    registry = rt.ResourceRegistry('test')
+    path = str(tmp_path / 'model')
+    write(path, 'v1')
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return read(path)
+
+    assert registry.get('model', loader, path = path) == 'v1'
+    assert registry.get('model', loader, path = path) == 'v1'
+    assert len(loads) == 1
+
+
+
+def test_resource_is_reloaded_when_its_file_changes(tmp_path):
+    registry = rt.ResourceRegistry('test')
+    path = str(tmp_path / 'model')
+    write(path, 'v1')
+    registry.get('model', lambda: read(path), path = path)
+
+    write(path, 'version 2')
+    os.utime(path, ns = (0, 10 ** 9))
+
+    assert registry.refresh() == ['model']
+    assert registry.get('model', lambda: read(path), path = path) == 'version 2'
+    assert registry.report()['resources']['model']['reloads'] == 0
+
+
+
+def test_missing_file_keeps_the_loaded_resource(tmp_path):
+    registry = rt.ResourceRegistry('test')
+    path = str(tmp_path / 'model')
+    write(path, 'v1')
+    registry.get('model', lambda: read(path), path = path)
+
+    os.remove(path)
+
+    assert registry.get('model', lambda: 'reloaded', path = path) == 'v1'
+
+
+
+def test_registered_resource_is_never_stale(tmp_path):
+    registry = rt.ResourceRegistry('test')
+    path = str(tmp_path / 'model')
+
+    registry.register('model', 'in memory')
+    write(path, 'on disk')
+
+    assert registry.get('model', lambda: read(path), path = path) == 'in memory'
+    assert registry.refresh() == []
+
+    registry.evict('model')
+    assert registry.get('model', lambda: read(path), path = path) == 'on disk'
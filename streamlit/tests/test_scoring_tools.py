@@ -0,0 +1,47 @@
+import pandas as pd
+
+import project_tools as pt
+import scoring_tools as sct
+
+import fakes
+
+
+
+def write_feed(path, image_dir):
+    ## rows 0-1: text only (first chunk), rows 2-3: no text and no image file (second chunk)
+    feed = pd.DataFrame({'designation' : ['piscine', 'livre', None, None],
+                         'description' : ['', 'roman', None, None],
+                         'productid' : [1, 2, 3, 4],
+                         'imageid' : [11, 12, 13, 14]})
+    feed.to_csv(path)
+    image_dir.mkdir()
+
+
+
+def test_output_schema_is_the_same_for_every_chunk(tmp_path, monkeypatch):
+    fakes.patch_modality_heads(monkeypatch, pt)
+    input_file, output_file = str(tmp_path / 'feed.csv'), str(tmp_path / 'predictions.csv')
+    write_feed(input_file, tmp_path / 'images')
+
+    sct.score_file(input_file, str(tmp_path / 'images'), output_file, chunk_size = 2, use_cascade = True, verbose = False)
+
+    output = pd.read_csv(output_file, index_col = 0)
+
+    assert list(output.columns) == sct.get_output_columns(3, use_cascade = True)
+    assert list(output['productid']) == [1, 2, 3, 4]
+    assert list(output['modalities']) == ['text', 'text', 'none', 'none']
+
+    ## codes written as integers, empty for the products with nothing to classify
+    codes = pd.read_csv(output_file, index_col = 0, dtype = str, keep_default_na = False)['pred_code_1']
+    assert list(codes) == ['11', '11', '', '']
+
+
+
+def test_score_chunk_columns_and_code_dtype(tmp_path, monkeypatch):
+    fakes.patch_modality_heads(monkeypatch, pt)
+    chunk = pd.DataFrame({'designation' : [None], 'description' : [None], 'productid' : [1], 'imageid' : [2]})
+
+    predictions = sct.score_chunk(chunk, str(tmp_path), num = 2)
+
+    assert list(predictions.columns) == sct.get_output_columns(2)
+    assert str(predictions['pred_code_1'].dtype) == 'Int64'
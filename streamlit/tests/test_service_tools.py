@@ -0,0 +1,110 @@
+import threading
+import urllib.error
+
+import pandas as pd
+
+import pytest
+
+import service_tools as st
+
+
+
+def test_micro_batcher_groups_concurrent_items():
+    batches = []
+
+    def predict_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = st.MicroBatcher(predict_batch, max_batch_size = 8, max_wait = 0.2)
+    try:
+        futures = [batcher.submit(i) for i in range(5)]
+        assert [future.result(timeout = 5) for future in futures] == [0, 2, 4, 6, 8]
+    finally:
+        batcher.stop()
+
+    assert batches == [[0, 1, 2, 3, 4]]
+
+
+
+def test_micro_batcher_failure_only_reaches_faulty_item():
+
+    def predict_batch(items):
+        if 'corrupt' in items:
+            raise ValueError('cannot decode image')
+        return [item.upper() for item in items]
+
+    batcher = st.MicroBatcher(predict_batch, max_batch_size = 8, max_wait = 0.2)
+    try:
+        futures = [batcher.submit(item) for item in ['a', 'corrupt', 'b']]
+
+        assert futures[0].result(timeout = 5) == 'A'
+        assert futures[2].result(timeout = 5) == 'B'
+        with pytest.raises(ValueError):
+            futures[1].result(timeout = 5)
+
+        stats = batcher.get_stats()
+    finally:
+        batcher.stop()
+
+    assert stats['errors'] == 1
+    assert stats['retried_batches'] == 1
+
+
+
+def fake_predictions(products):
+    return [{'pred_codes' : [len(product['title'])], 'pred_classes' : ['class'], 'confidences' : [1.0]}
+            for product in products]
+
+
+
+def test_cache_misses_of_a_request_share_one_batch():
+    batches = []
+
+    def predict_batch(products):
+        batches.append(len(products))
+        return fake_predictions(products)
+
+    server, base_url = st.start_server_in_thread(port = 0, predict_batch_fn = predict_batch, max_batch_size = 32,
+                                                 max_wait = 0.05, degrade = False)
+    try:
+        client = st.PredictionClient(base_url)
+        products = [{'title' : 'product %d' %i, 'description' : ''} for i in range(10)]
+
+        first = client.predict_many(products)
+        second = client.predict_many(products)
+        cache_stats = server.cache.get_stats()
+    finally:
+        server.shutdown()
+        server.batcher.stop()
+
+    assert batches == [10]
+    assert first == second
+    assert cache_stats['misses'] == 10 and cache_stats['hits'] == 10
+
+
+
+def test_products_without_text_nor_image_are_rejected():
+    server, base_url = st.start_server_in_thread(port = 0, predict_batch_fn = fake_predictions, degrade = False)
+    try:
+        client = st.PredictionClient(base_url)
+        with pytest.raises(urllib.error.HTTPError) as error:
+            client.predict_many([{'title' : 'a title'}, {'title' : '', 'description' : '  '}])
+    finally:
+        server.shutdown()
+        server.batcher.stop()
+
+    assert error.value.code == 400
+
+
+
+def test_empty_prediction_records():
+    predictions = pd.DataFrame({'pred_code_1' : pd.array([10, None], dtype = 'Int64'),
+                                'pred_class_1' : ['livre', None],
+                                'confidence_1' : [0.9, None],
+                                'modalities' : ['text', 'none']})
+
+    records = st.table_to_records(predictions, num = 1)
+
+    assert records[0] == {'pred_codes' : [10], 'pred_classes' : ['livre'], 'confidences' : [0.9], 'modalities' : 'text'}
+    assert records[1] == {'pred_codes' : [], 'pred_classes' : [], 'confidences' : [], 'modalities' : 'none'}
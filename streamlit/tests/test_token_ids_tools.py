@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+import token_ids_tools as tit
+import FusionModel_withVGG_tools as fm
+
+
+
+TOKEN_LISTS = [['livre', 'jeu', 'livre', 'le', 'enfant', 'jeu'],
+               [],
+               ['the', 'book', 'book', 'kid'],
+               ['console', 'le', 'the', 'console', 'manette']]
+
+LANGUAGES = ['fr', 'fr', 'en', 'de']
+
+STOP_WORDS = {'fr' : ['le', 'la'], 'en' : ['the'], None : ['le', 'the']}
+
+
+
+def test_round_trip_keeps_the_lists():
+    tokens = tit.from_lists(TOKEN_LISTS)
+
+    assert len(tokens) == 4
+    assert tokens.to_lists() == TOKEN_LISTS
+    assert tokens.ids.dtype == np.int32 and tokens.offsets.tolist() == [0, 6, 6, 10, 15]
+
+
+
+def test_shared_vocabulary_gives_the_same_ids():
+    train = tit.from_lists([['a', 'b']])
+    test = tit.from_lists([['b', 'c']], vocabulary = train.vocabulary)
+
+    assert test.ids.tolist() == [1, 2]
+    assert test.to_lists() == [['b', 'c']]
+
+
+
+def test_dedupe_keeps_the_first_occurrences_in_order():
+    expected = [sorted(set(tokens), key = tokens.index) for tokens in TOKEN_LISTS]
+
+    assert tit.dedupe(tit.from_lists(TOKEN_LISTS)).to_lists() == expected
+
+
+
+def test_stop_words_of_each_row_language():
+    result = tit.remove_stop_words(tit.from_lists(TOKEN_LISTS), LANGUAGES, STOP_WORDS)
+
+    ## 'de' has no entry: the stop words under None are used
+    assert result.to_lists() == [['livre', 'jeu', 'livre', 'enfant', 'jeu'],
+                                 [],
+                                 ['book', 'book', 'kid'],
+                                 ['console', 'console', 'manette']]
+
+
+
+def test_lengths():
+    assert tit.get_lengths(tit.from_lists(TOKEN_LISTS)).tolist() == [len(tokens) for tokens in TOKEN_LISTS]
+
+
+
+def test_pool_by_category_in_row_order():
+    pools, categories = tit.pool_by_category(tit.from_lists(TOKEN_LISTS), [20, 10, 20, 30], categories = [20, 10, 40])
+
+    assert categories == [20, 10, 40]
+    assert pools.to_lists() == [TOKEN_LISTS[0] + TOKEN_LISTS[2], [], []]
+
+
+
+def test_empty_input():
+    tokens = tit.from_lists([])
+
+    assert len(tokens) == 0 and tokens.to_lists() == []
+    assert tit.dedupe(tokens).to_lists() == []
+    assert tit.remove_stop_words(tokens, [], STOP_WORDS).to_lists() == []
+    assert tit.get_lengths(tokens).tolist() == []
+
+
+
+def test_stages_on_ids_match_the_stages_on_lists(monkeypatch):
+    monkeypatch.setattr(fm, 'import_stop_words', lambda language : STOP_WORDS.get(language, STOP_WORDS[None]))
+
+    class Tokenizer:
+        def tokenize(self, text):
+            return text.split()
+
+    class Lemmatizer:
+        def lemmatize(self, token):
+            return token
+
+    df = pd.DataFrame({'text' : [' '.join(tokens) for tokens in TOKEN_LISTS], 'language' : LANGUAGES},
+                      index = [3, 5, 8, 9])
+
+    ## columns of lists at every stage
+    expected = df.copy()
+    fm.get_lemmatized_tokens(expected, 'text', Tokenizer(), 'lemma_tokens', Lemmatizer(), uniques = True, verbose = False)
+    fm.remove_stop_words(expected, 'lemma_tokens', 'lemma_tokens', 'language')
+    fm.get_token_length(expected, 'lemma_tokens', 'text_token_len')
+
+    ## token ids from one stage to the next, lists built once
+    result = df.copy()
+    tokens = fm.get_lemmatized_tokens(result, 'text', Tokenizer(), 'lemma_tokens', Lemmatizer(), uniques = True,
+                                      verbose = False, to_lists = False)
+    tokens = fm.remove_stop_words(result, 'lemma_tokens', 'lemma_tokens', 'language', tokens = tokens, to_lists = False)
+    fm.get_token_length(result, 'lemma_tokens', 'text_token_len', tokens = tokens)
+
+    assert 'lemma_tokens' not in result
+    assert tokens.to_lists() == list(expected['lemma_tokens'])
+    assert result['text_token_len'].tolist() == expected['text_token_len'].tolist()
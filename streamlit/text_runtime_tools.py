@@ -0,0 +1,268 @@
+'''
+Preloaded text preprocessing runtime for the serving path.
+
+FusionModel_withVGG_tools.preprocess_text_data sets everything up again on every call: nltk.download
+of wordnet (network and disk check), a new tokenizer and lemmatizer, two langid identifiers built from
+the model string (the whole langid model is decoded each time) and the spaCy stop-word imports of every
+row. TextPreprocessor does all of it once and gives the same output:
+
+    import text_runtime_tools as trt
+    runtime = trt.TextPreprocessor()
+    text_preprocessed = runtime.process(text_df)
+
+The resources are checked offline: a missing wordnet corpus raises LookupError instead of downloading it
+during a request (allow_download = True to fetch it at initialization).
+'''
+
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+import timing_tools as tt
+import html_tools as htt
+import lemma_table_tools as ltt
+
+
+
+def check_nltk_resource(resource = 'corpora/wordnet', package = 'wordnet', allow_download = False):
+    '''
+    Find an nltk resource on disk without touching the network. If it is missing,
+    download it when allow_download = True, otherwise raise LookupError.
+    '''
+    import nltk
+
+    try:
+        return nltk.data.find(resource)
+    except LookupError:
+        if not allow_download:
+            raise LookupError("nltk resource '%s' is not installed. Run nltk.download('%s') once "
+                              "(or TextPreprocessor(allow_download = True))." %(resource, package))
+
+    nltk.download(package, quiet = True)
+
+    return nltk.data.find(resource)
+
+
+
+def load_stop_words():
+    '''
+    Stop words of the top 4 languages of the dataset as frozen sets, with the FR + EN set under None
+    for the other languages (see fm.import_stop_words).
+    '''
+    from spacy.lang.fr.stop_words import STOP_WORDS as stop_fr
+    from spacy.lang.en.stop_words import STOP_WORDS as stop_en
+    from spacy.lang.de.stop_words import STOP_WORDS as stop_de
+    from spacy.lang.it.stop_words import STOP_WORDS as stop_it
+
+    return {'fr' : frozenset(stop_fr),
+            'en' : frozenset(stop_en),
+            'de' : frozenset(stop_de),
+            'it' : frozenset(stop_it),
+            None : frozenset(stop_fr) | frozenset(stop_en)}
+
+
+
+class TextPreprocessor:
+    '''
+    Text preprocessing of preprocess_text_data with its resources loaded once: tokenizer, lemma table
+    (wordnet loaded for the tokens it does not know yet), langid identifiers (all languages, and FR / EN
+    for low confidence detections) and stop-word sets. process() can be called concurrently from
+    several threads.
+    '''
+
+    def __init__(self, allow_download = False, lemma_table = None):
+        t0 = time.perf_counter()
+
+        check_nltk_resource('corpora/wordnet', 'wordnet', allow_download = allow_download)
+
+        from nltk.tokenize import RegexpTokenizer
+        from nltk.stem import WordNetLemmatizer
+
+        self.tokenizer = RegexpTokenizer(r'\w{3,}')
+        self.lemmatizer = lemma_table if lemma_table is not None else ltt.LemmaTable()
+        if self.lemmatizer.lemmatizer is None:
+            self.lemmatizer.lemmatizer = WordNetLemmatizer()
+        self.lemmatizer.get_lemmatizer().lemmatize('produits')     # wordnet is read on the first call
+
+        from langid.langid import LanguageIdentifier, model
+
+        self.identifier = LanguageIdentifier.from_modelstring(model, norm_probs = True)
+        self.identifier_fr_en = LanguageIdentifier.from_modelstring(model, norm_probs = True)
+        self.identifier_fr_en.set_languages(langs = ['fr', 'en'])
+
+        self.stop_words = load_stop_words()
+
+        self.init_time = time.perf_counter() - t0
+
+
+    def parse_html(self, texts):
+        return htt.parse_html(texts)
+
+
+    def get_lemma_tokens(self, texts):
+        '''
+        Unique lemmatized tokens of each text, in order of first appearance.
+        '''
+        lemma_tokens = []
+        for text in texts:
+            lemmas = self.lemmatizer.lemmatize_tokens(self.tokenizer.tokenize(text))
+            lemma_tokens.append(list(dict.fromkeys(lemmas)))
+
+        return lemma_tokens
+
+
+    def get_languages(self, texts, correct = True):
+        '''
+        Main language of each text, detected again among FR / EN when the confidence is below 0.9999.
+        '''
+        languages = []
+        for text in texts:
+            language, probability = self.identifier.classify(text)
+            if correct and probability < 0.9999:
+                language, probability = self.identifier_fr_en.classify(text)
+            languages.append(str(language))
+
+        return languages
+
+
+    def remove_stop_words(self, lemma_tokens, languages):
+        return [[token for token in tokens if token not in self.stop_words.get(language, self.stop_words[None])]
+                for tokens, language in zip(lemma_tokens, languages)]
+
+
+    def process(self, texts):
+        '''
+        Same output as fm.preprocess_text_data(texts, verbose = False) for a text dataframe
+        (columns 'title' or 'designation', and 'description'). A list of strings is taken as titles
+        with empty descriptions.
+        '''
+        if isinstance(texts, pd.DataFrame):
+            df = texts.rename({'designation' : 'title'}, axis = 1)
+        else:
+            df = pd.DataFrame({'title' : list(texts), 'description' : [''] * len(texts)})
+
+        nb_rows = df.shape[0]
+
+        with tt.stage('concatenate_variables', items = nb_rows):
+            df['title'] = df['title'].fillna('')
+            df['description'] = df['description'].fillna('')
+            df['title_descr'] = df['title'] + ' \n ' + df['description']
+
+        with tt.stage('html_parsing', items = nb_rows):
+            df['title_descr'] = self.parse_html(df['title_descr'])
+
+        with tt.stage('tokenize_lemmatize', items = nb_rows):
+            lemma_tokens = self.get_lemma_tokens(df['title_descr'])
+            df['lemma_tokens'] = pd.Series(lemma_tokens, index = df.index, dtype = object)
+
+        with tt.stage('get_language', items = nb_rows):
+            df['language'] = self.get_languages(df['title_descr'])
+
+        with tt.stage('remove_stop_words', items = nb_rows):
+            lemma_tokens = self.remove_stop_words(lemma_tokens, df['language'])
+            df['lemma_tokens'] = pd.Series(lemma_tokens, index = df.index, dtype = object)
+
+        with tt.stage('get_token_length', items = nb_rows):
+            df['text_token_len'] = [len(tokens) for tokens in lemma_tokens]
+
+        return df
+
+
+
+def check_parity(text_df, runtime = None):
+    '''
+    True if TextPreprocessor.process and fm.preprocess_text_data give the same tokens, languages
+    and token lengths on text_df.
+    '''
+    import FusionModel_withVGG_tools as fm
+
+    runtime = runtime if runtime is not None else TextPreprocessor()
+
+    expected = fm.preprocess_text_data(text_df, verbose = False)
+    result = runtime.process(text_df)
+
+    return (list(expected['lemma_tokens']) == list(result['lemma_tokens'])
+            and list(expected['language']) == list(result['language'])
+            and np.array_equal(expected['text_token_len'].values, result['text_token_len'].values))
+
+
+
+## TextPreprocessor of each worker process of preprocess_text_parallel
+_worker_runtime = None
+
+
+
+def _init_worker(allow_download, lemma_table):
+    global _worker_runtime
+
+    _worker_runtime = TextPreprocessor(allow_download = allow_download, lemma_table = lemma_table)
+
+
+
+def _process_chunk(chunk):
+    '''
+    Preprocessed chunk, and the lemmas the worker had to compute for it.
+    '''
+    nb_lemmas = len(_worker_runtime.lemmatizer)
+    df = _worker_runtime.process(chunk)
+
+    return df, _worker_runtime.lemmatizer.get_added_since(nb_lemmas)
+
+
+
+def get_chunks(df, nb_workers, chunk_size = None):
+    '''
+    Consecutive row slices of df. By default 4 chunks per worker, so that a slow chunk
+    (long descriptions) does not leave the other workers idle at the end.
+    '''
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(df.shape[0] / (4 * nb_workers)))
+
+    return [df.iloc[start : start + chunk_size] for start in range(0, max(1, df.shape[0]), chunk_size)]
+
+
+
+def preprocess_text_parallel(text_df, nb_workers = None, chunk_size = None, allow_download = False,
+                             lemma_table = None, start_method = None, verbose = False):
+    '''
+    preprocess_text_data on nb_workers processes (all the cores by default). The rows are split in
+    chunks, every worker preprocesses its chunks with its own TextPreprocessor (resources loaded once
+    per worker) and the chunks are put back together in the original order: the output is the same
+    as the single process one, whatever the number of workers and the chunk size.
+    The workers start from a copy of lemma_table; the lemmas they add are merged back into it
+    (unless it is frozen).
+    '''
+    import multiprocessing as mp
+
+    if nb_workers is None:
+        import runtime_tools as rtt
+        nb_workers = rtt.get_cpu_count()
+
+    chunks = get_chunks(text_df, nb_workers, chunk_size)
+    nb_workers = max(1, min(nb_workers, len(chunks)))
+
+    t0 = time.perf_counter()
+
+    with tt.stage('preprocess_text_parallel', items = text_df.shape[0]):
+        if nb_workers == 1:
+            runtime = TextPreprocessor(allow_download = allow_download, lemma_table = lemma_table)
+            results = [runtime.process(chunk) for chunk in chunks]
+        else:
+            context = mp.get_context(start_method)
+            with context.Pool(nb_workers, initializer = _init_worker, initargs = (allow_download, lemma_table)) as pool:
+                ## imap returns the chunks in submission order
+                results = []
+                for df, lemmas in pool.imap(_process_chunk, chunks):
+                    results.append(df)
+                    if lemma_table is not None and not lemma_table.frozen:
+                        lemma_table.merge(lemmas)
+
+        df = pd.concat(results)
+
+    if verbose:
+        print("%d rows preprocessed in %d chunks on %d processes in %0.2f seconds"
+              %(text_df.shape[0], len(chunks), nb_workers, time.perf_counter() - t0))
+
+    return df